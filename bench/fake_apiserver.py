@@ -0,0 +1,365 @@
+"""A minimal in-process Kubernetes API server for load testing the operator.
+
+Implements just enough of the core/v1 and storage.k8s.io/v1 REST API for kopf and the
+kubernetes client: discovery, list/watch (replaying from a resourceVersion), get, create,
+merge/json patches, and deletes that honour finalizers. It also plays the part of the PV
+controller by binding a claim to the `pvc-<uid>` volume the operator creates for it.
+
+Every request made over HTTP is counted in `api_calls`. The load test drives the server
+directly through create/patch/delete, which are not counted.
+"""
+import asyncio
+import collections
+import copy
+import json
+import uuid
+from datetime import datetime, timezone
+
+from aiohttp import web
+
+# (group/version, plural) -> (kind, namespaced)
+RESOURCES = {
+    ("v1", "namespaces"): ("Namespace", False),
+    ("v1", "nodes"): ("Node", False),
+    ("v1", "persistentvolumes"): ("PersistentVolume", False),
+    ("v1", "persistentvolumeclaims"): ("PersistentVolumeClaim", True),
+    ("v1", "configmaps"): ("ConfigMap", True),
+    ("v1", "secrets"): ("Secret", True),
+    ("v1", "events"): ("Event", True),
+    ("v1", "pods"): ("Pod", True),
+    ("storage.k8s.io/v1", "storageclasses"): ("StorageClass", False),
+    ("apiextensions.k8s.io/v1", "customresourcedefinitions"): ("CustomResourceDefinition", False),
+}
+STATUS_SUBRESOURCES = { "namespaces", "nodes", "persistentvolumes", "persistentvolumeclaims", "pods" }
+VERBS = [ "create", "delete", "get", "list", "patch", "update", "watch" ]
+
+class ConflictError(Exception):
+    pass
+
+class PatchTestError(Exception):
+    pass
+
+def now():
+    return datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
+
+def merge_patch(target, patch):
+    """RFC 7386 merge patch. Strategic merge patches are applied the same way"""
+    if not isinstance(patch, dict):
+        return copy.deepcopy(patch)
+
+    result = dict(target) if isinstance(target, dict) else {}
+    for key, value in patch.items():
+        if value is None:
+            result.pop(key, None)
+        else:
+            result[key] = merge_patch(result.get(key), value)
+    return result
+
+def json_patch(target, operations):
+    """RFC 6902 json patch (add, replace, remove, and test)"""
+    result = copy.deepcopy(target)
+    for operation in operations:
+        keys = [ key.replace("~1", "/").replace("~0", "~") for key in operation["path"].split("/")[1:] ]
+        parent = result
+        for key in keys[:-1]:
+            parent = parent[int(key)] if isinstance(parent, list) else parent.setdefault(key, {})
+
+        last = keys[-1]
+        if isinstance(parent, list):
+            last = len(parent) if last == "-" else int(last)
+
+        if operation["op"] == "remove":
+            del parent[last]
+        elif operation["op"] == "test":
+            try:
+                matches = parent[last] == operation["value"]
+            except (KeyError, IndexError):
+                matches = False
+            if not matches:
+                raise PatchTestError(f"the server rejected our request due to an error in our request: test operation failed for {operation['path']}")
+        elif operation["op"] == "add" and isinstance(parent, list):
+            parent.insert(last, operation["value"])
+        else:
+            parent[last] = operation["value"]
+    return result
+
+def status(code, reason, message):
+    return web.json_response({ "kind": "Status", "apiVersion": "v1", "status": "Failure", "reason": reason, "message": message, "code": code }, status=code)
+
+class FakeApiServer:
+    def __init__(self):
+        self.objects = {} # (group/version, plural, namespace, name) -> object
+        self.claims_by_uid = {} # pvc uid -> key
+        self.resource_version = 0
+        self.history = [] # (resource version, group/version, plural, namespace, event)
+        self.watchers = set()
+        self.listeners = []
+        self.api_calls = collections.Counter()
+        self.runner = None
+        self.port = None
+
+    async def start(self, host="127.0.0.1", port=0):
+        app = web.Application(client_max_size=16 * 1024 ** 2)
+        app.router.add_route("*", "/{path:.*}", self.dispatch)
+        self.runner = web.AppRunner(app, access_log=None)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, host, port)
+        await site.start()
+        self.port = site._server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        for queue in [ watcher[3] for watcher in self.watchers ]:
+            queue.put_nowait(None)
+        await self.runner.cleanup()
+
+    # object store
+
+    def get(self, group_version, plural, namespace, name):
+        return self.objects.get((group_version, plural, namespace, name))
+
+    def list(self, group_version, plural, namespace=None, label_selector=None):
+        selector = dict(term.split("=", 1) for term in label_selector.split(",") if "=" in term) if label_selector else {}
+        return [ obj for (gv, p, ns, _), obj in self.objects.items()
+            if gv == group_version and p == plural and (namespace is None or ns == namespace)
+            and all(obj["metadata"].get("labels", {}).get(key) == value for key, value in selector.items()) ]
+
+    def create(self, group_version, plural, obj, namespace=None):
+        kind, namespaced = RESOURCES[(group_version, plural)]
+        obj = copy.deepcopy(obj)
+        metadata = obj.setdefault("metadata", {})
+        if namespaced:
+            metadata["namespace"] = namespace or metadata.get("namespace", "default")
+        else:
+            metadata.pop("namespace", None)
+
+        if not metadata.get("name") and metadata.get("generateName"):
+            metadata["name"] = metadata["generateName"] + uuid.uuid4().hex[:5]
+
+        key = (group_version, plural, metadata.get("namespace"), metadata["name"])
+        if key in self.objects:
+            return None
+
+        obj["kind"] = kind
+        obj["apiVersion"] = group_version
+        metadata["uid"] = str(uuid.uuid4())
+        metadata["creationTimestamp"] = now()
+        metadata["generation"] = 1
+        if plural == "persistentvolumeclaims":
+            obj.setdefault("status", { "phase": "Pending" })
+            self.claims_by_uid[metadata["uid"]] = key
+
+        # events are only counted
+        if plural != "events":
+            self.objects[key] = obj
+            self._emit("ADDED", key, obj)
+        return obj
+
+    def patch(self, group_version, plural, namespace, name, patch, subresource=None):
+        key = (group_version, plural, namespace, name)
+        obj = self.objects.get(key)
+        if obj is None:
+            return None
+
+        # a resourceVersion in a merge patch is a precondition, like on the real api server
+        if isinstance(patch, dict) and patch.get("metadata", {}).get("resourceVersion") not in (None, obj["metadata"].get("resourceVersion")):
+            raise ConflictError()
+
+        if isinstance(patch, list):
+            patched = json_patch(obj, patch)
+        else:
+            if subresource == "status":
+                patch = { "status": patch.get("status") }
+            patched = merge_patch(copy.deepcopy(obj), patch)
+
+        if patched.get("spec") != obj.get("spec"):
+            patched["metadata"]["generation"] = obj["metadata"].get("generation", 1) + 1
+
+        return self._update(key, patched)
+
+    def delete(self, group_version, plural, namespace, name):
+        key = (group_version, plural, namespace, name)
+        obj = self.objects.get(key)
+        if obj is None:
+            return None
+
+        if obj["metadata"].get("deletionTimestamp"):
+            return obj
+
+        obj = copy.deepcopy(obj)
+        obj["metadata"]["deletionTimestamp"] = now()
+        return self._update(key, obj)
+
+    def _update(self, key, obj):
+        metadata = obj["metadata"]
+        if metadata.get("deletionTimestamp") and not metadata.get("finalizers"):
+            del self.objects[key]
+            self.claims_by_uid.pop(metadata["uid"], None)
+            self._emit("DELETED", key, obj)
+        else:
+            self.objects[key] = obj
+            self._emit("MODIFIED", key, obj)
+        return obj
+
+    def _emit(self, event_type, key, obj):
+        self.resource_version += 1
+        obj["metadata"]["resourceVersion"] = str(self.resource_version)
+
+        group_version, plural, namespace, _ = key
+        event = { "type": event_type, "object": obj }
+        self.history.append((self.resource_version, group_version, plural, namespace, event))
+        for watcher in self.watchers:
+            if watcher[:2] == (group_version, plural) and watcher[2] in (None, namespace):
+                watcher[3].put_nowait(event)
+
+        for listener in self.listeners:
+            listener(event_type, plural, obj)
+
+        if plural == "persistentvolumes" and event_type == "ADDED":
+            self._bind_volume(obj)
+
+    def _bind_volume(self, pv):
+        """Bind the claim a provisioned volume was named after, like the PV controller would"""
+        pv_name = pv["metadata"]["name"]
+        claim_key = self.claims_by_uid.get(pv_name.removeprefix("pvc-"))
+        if not pv_name.startswith("pvc-") or claim_key is None:
+            return
+
+        pvc = self.objects[claim_key]
+        if pvc["spec"].get("volumeName"):
+            return
+
+        claim_ref = { "kind": "PersistentVolumeClaim", "apiVersion": "v1", "namespace": claim_key[2], "name": claim_key[3], "uid": pvc["metadata"]["uid"] }
+        self.patch("v1", "persistentvolumes", None, pv_name, { "spec": { "claimRef": claim_ref }, "status": { "phase": "Bound" } })
+        self.patch("v1", "persistentvolumeclaims", claim_key[2], claim_key[3], {
+            "spec": { "volumeName": pv_name },
+            "status": { "phase": "Bound", "accessModes": pv["spec"].get("accessModes"), "capacity": pv["spec"].get("capacity") }
+        })
+
+    # http api
+
+    def _discovery(self, path):
+        if path == "version":
+            return { "major": "1", "minor": "30", "gitVersion": "v1.30.0-labdisk-fake", "platform": "linux/amd64" }
+        if path == "api":
+            return { "kind": "APIVersions", "versions": [ "v1" ], "serverAddressByClientCIDRs": [] }
+        if path == "apis":
+            groups = sorted(set(gv for gv, _ in RESOURCES if "/" in gv))
+            return { "kind": "APIGroupList", "apiVersion": "v1", "groups": [ {
+                "name": gv.split("/")[0],
+                "versions": [ { "groupVersion": gv, "version": gv.split("/")[1] } ],
+                "preferredVersion": { "groupVersion": gv, "version": gv.split("/")[1] },
+            } for gv in groups ] }
+
+        group_version = path.removeprefix("api/").removeprefix("apis/")
+        resources = []
+        for (gv, plural), (kind, namespaced) in RESOURCES.items():
+            if gv != group_version:
+                continue
+            resources.append({ "name": plural, "singularName": kind.lower(), "namespaced": namespaced, "kind": kind, "verbs": VERBS })
+            if plural in STATUS_SUBRESOURCES:
+                resources.append({ "name": f"{plural}/status", "singularName": "", "namespaced": namespaced, "kind": kind, "verbs": [ "get", "patch", "update" ] })
+
+        if not resources:
+            return None
+        return { "kind": "APIResourceList", "apiVersion": "v1", "groupVersion": group_version, "resources": resources }
+
+    def _parse_path(self, path):
+        parts = path.split("/")
+        if parts[0] == "api" and len(parts) > 2:
+            group_version, rest = parts[1], parts[2:]
+        elif parts[0] == "apis" and len(parts) > 3:
+            group_version, rest = "/".join(parts[1:3]), parts[3:]
+        else:
+            return None
+
+        namespace = None
+        if len(rest) >= 3 and rest[0] == "namespaces" and (group_version, rest[2]) in RESOURCES:
+            namespace, rest = rest[1], rest[2:]
+
+        plural, name, subresource = (rest + [ None, None ])[:3]
+        if (group_version, plural) not in RESOURCES:
+            return None
+        return group_version, plural, namespace, name, subresource
+
+    async def dispatch(self, request):
+        path = request.match_info["path"].strip("/")
+        parsed = self._parse_path(path)
+        if parsed is None:
+            self.api_calls[f"discovery /{path}"] += 1
+            body = self._discovery(path)
+            return web.json_response(body) if body else status(404, "NotFound", f"/{path} not found")
+
+        group_version, plural, namespace, name, subresource = parsed
+        resource = f"{plural}/{subresource}" if subresource else plural
+        watch = request.query.get("watch") in ("true", "1")
+        verb = {
+            "GET": "watch" if watch else ("get" if name else "list"),
+            "POST": "create",
+            "PATCH": "patch",
+            "PUT": "update",
+            "DELETE": "delete",
+        }.get(request.method, request.method.lower())
+        self.api_calls[f"{verb} {resource}"] += 1
+
+        if verb == "watch":
+            return await self._watch(request, group_version, plural, namespace)
+
+        if verb == "list":
+            items = self.list(group_version, plural, namespace, request.query.get("labelSelector"))
+            return web.json_response({
+                "kind": f"{RESOURCES[(group_version, plural)][0]}List",
+                "apiVersion": group_version,
+                "metadata": { "resourceVersion": str(self.resource_version) },
+                "items": items
+            })
+
+        if verb == "create":
+            obj = self.create(group_version, plural, await request.json(), namespace)
+            if obj is None:
+                return status(409, "AlreadyExists", f"{plural} already exists")
+            return web.json_response(obj, status=201)
+
+        try:
+            if verb == "get":
+                obj = self.get(group_version, plural, namespace, name)
+            elif verb == "patch":
+                obj = self.patch(group_version, plural, namespace, name, await request.json(), subresource)
+            elif verb == "update":
+                obj = self.get(group_version, plural, namespace, name) and self.patch(group_version, plural, namespace, name, await request.json(), subresource)
+            elif verb == "delete":
+                obj = self.delete(group_version, plural, namespace, name)
+            else:
+                return status(405, "MethodNotAllowed", f"{request.method} is not supported")
+        except ConflictError:
+            return status(409, "Conflict", f"{plural} \"{name}\" has been modified")
+        except PatchTestError as ex:
+            # like the real api server, a failed json patch test is the client's fault
+            return status(422, "Invalid", str(ex))
+
+        if obj is None:
+            return status(404, "NotFound", f"{plural} \"{name}\" not found")
+        return web.json_response(obj)
+
+    async def _watch(self, request, group_version, plural, namespace):
+        since = int(request.query.get("resourceVersion") or 0)
+        timeout = request.query.get("timeoutSeconds")
+
+        # register before replaying so nothing is missed in between
+        queue = asyncio.Queue()
+        watcher = (group_version, plural, namespace, queue)
+        self.watchers.add(watcher)
+        for resource_version, gv, p, ns, event in self.history:
+            if resource_version > since and (gv, p) == (group_version, plural) and namespace in (None, ns):
+                queue.put_nowait(event)
+
+        response = web.StreamResponse(headers={ "Content-Type": "application/json" })
+        await response.prepare(request)
+        try:
+            async with asyncio.timeout(float(timeout) if timeout else None):
+                while (event := await queue.get()) is not None:
+                    await response.write(json.dumps(event).encode() + b"\n")
+        except (TimeoutError, ConnectionResetError):
+            pass
+        finally:
+            self.watchers.discard(watcher)
+        return response
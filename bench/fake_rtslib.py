@@ -0,0 +1,298 @@
+"""In-memory stand-in for the parts of rtslib-fb that LabDisk uses.
+
+Every attribute that rtslib would read from configfs goes through ``_configfs_read`` so
+benchmarks can count the reads an operation does and give them a configurable cost.
+Call ``install()`` before importing ``iscsi``.
+"""
+import sys
+import time
+import types
+
+# cost of a single configfs read/write in seconds and the number of reads done so far
+read_latency = 0.0
+reads = 0
+saves = 0
+
+def _configfs_read():
+    global reads
+    reads += 1
+    if read_latency:
+        time.sleep(read_latency)
+
+class RTSLibError(Exception):
+    pass
+
+class RTSLibNotInCFSError(RTSLibError):
+    pass
+
+# objects live under a path that doesn't exist so the raw configfs calls LabDisk makes can't touch a real target
+CONFIGFS_DIR = "/nonexistent/labdisk-fake-configfs"
+
+class CFSNode:
+    """Like rtslib, delete() only removes the object's own configfs entry"""
+    @property
+    def exists(self):
+        _configfs_read()
+        return self._exists()
+
+    def delete(self):
+        _configfs_read()
+        if self._exists():
+            self._remove()
+
+storage_objects = {}
+
+class _Backstore:
+    def delete(self):
+        _configfs_read()
+
+class BlockStorageObject(CFSNode):
+    def __init__(self, name, dev=None):
+        _configfs_read()
+        if dev is None:
+            if name not in storage_objects:
+                raise RTSLibNotInCFSError(f"No such storage object: {name}")
+        elif name in storage_objects:
+            raise RTSLibError(f"Storage object {name} already exists")
+        else:
+            storage_objects[name] = dev
+
+        self._name = name
+        self._backstore = _Backstore()
+        self.wwn = None
+
+    @property
+    def path(self):
+        return f"{CONFIGFS_DIR}/core/iblock_0/{self._name}"
+
+    def _exists(self):
+        return self._name in storage_objects
+
+    def _remove(self):
+        # configfs refuses to remove a storage object that a LUN links to
+        if any(lun._storage_object._name == self._name for tpg in TPG.instances for lun in tpg._luns.values()):
+            raise OSError(f"Storage object {self._name} is in use")
+        del storage_objects[self._name]
+
+    @property
+    def name(self):
+        _configfs_read()
+        return self._name
+
+    @property
+    def plugin(self):
+        _configfs_read()
+        return "block"
+
+    def delete(self):
+        _configfs_read()
+        storage_objects.pop(self._name, None)
+        for tpg in TPG.instances:
+            for lun_idx, lun in list(tpg._luns.items()):
+                if lun._storage_object is self or lun._storage_object._name == self._name:
+                    lun.delete()
+
+class LUN(CFSNode):
+    def __init__(self, parent_tpg, lun, storage_object):
+        self.parent_tpg = parent_tpg
+        self._lun = lun
+        self._storage_object = storage_object
+
+    @property
+    def lun(self):
+        return self._lun
+
+    @property
+    def path(self):
+        return f"{CONFIGFS_DIR}/iscsi/{self.parent_tpg.parent_target.wwn}/tpgt_{self.parent_tpg.tag}/lun/lun_{self._lun}"
+
+    @property
+    def alias(self):
+        _configfs_read()
+        if not self._exists():
+            raise RTSLibNotInCFSError(f"No such LUN: {self._lun}")
+        return "fake_link"
+
+    def _exists(self):
+        return self.parent_tpg._luns.get(self._lun) is self
+
+    def _remove(self):
+        # configfs refuses to remove a LUN that is still mapped for an initiator
+        if any(mapped_lun.tpg_lun is self for node_acl in self.parent_tpg._node_acls.values() for mapped_lun in node_acl._mapped_luns.values()):
+            raise OSError(f"LUN {self._lun} is still mapped")
+        del self.parent_tpg._luns[self._lun]
+
+    @property
+    def storage_object(self):
+        _configfs_read()
+        return self._storage_object
+
+    def delete(self):
+        _configfs_read()
+        if self.parent_tpg._luns.get(self._lun) is not self:
+            raise RTSLibNotInCFSError(f"No such LUN: {self._lun}")
+
+        # like rtslib, scan every ACL for mapped LUNs pointing at us
+        for node_acl in self.parent_tpg._node_acls.values():
+            for mapped_lun in list(node_acl._mapped_luns.values()):
+                _configfs_read()
+                if mapped_lun.tpg_lun is self:
+                    mapped_lun.delete()
+
+        del self.parent_tpg._luns[self._lun]
+
+class MappedLUN:
+    def __init__(self, parent_nodeacl, mapped_lun, tpg_lun):
+        self.parent_nodeacl = parent_nodeacl
+        self.mapped_lun = mapped_lun
+        self.tpg_lun = tpg_lun
+
+    def delete(self):
+        _configfs_read()
+        self.parent_nodeacl._mapped_luns.pop(self.mapped_lun, None)
+
+class NodeACL:
+    def __init__(self, parent_tpg, node_wwn):
+        self.parent_tpg = parent_tpg
+        self.node_wwn = node_wwn
+        self._mapped_luns = {}
+        self.chap_userid = None
+        self.chap_password = None
+        self.chap_mutual_userid = None
+        self.chap_mutual_password = None
+
+    @property
+    def mapped_luns(self):
+        for mapped_lun in list(self._mapped_luns.values()):
+            _configfs_read()
+            yield mapped_lun
+
+    def mapped_lun(self, mapped_lun, tpg_lun=None, write_protect=None):
+        _configfs_read()
+        if tpg_lun is None:
+            if mapped_lun not in self._mapped_luns:
+                raise RTSLibNotInCFSError(f"No such mapped LUN: {mapped_lun}")
+            return self._mapped_luns[mapped_lun]
+
+        if mapped_lun in self._mapped_luns:
+            raise RTSLibError(f"Mapped LUN {mapped_lun} already exists")
+
+        self._mapped_luns[mapped_lun] = MappedLUN(self, mapped_lun, tpg_lun)
+        return self._mapped_luns[mapped_lun]
+
+    def delete(self):
+        _configfs_read()
+        for mapped_lun in list(self._mapped_luns.values()):
+            mapped_lun.delete()
+        del self.parent_tpg._node_acls[self.node_wwn]
+
+class Target:
+    def __init__(self, fabric_module, wwn):
+        self.fabric_module = fabric_module
+        self.wwn = wwn
+
+class TPG:
+    instances = []
+
+    def __init__(self, parent_target, tag):
+        self.parent_target = parent_target
+        self.tag = tag
+        self.enable = False
+        self.chap_userid = None
+        self.chap_password = None
+        self.chap_mutual_userid = None
+        self.chap_mutual_password = None
+        self._luns = {}
+        self._node_acls = {}
+        self._attributes = {}
+        TPG.instances.append(self)
+
+    @property
+    def luns(self):
+        for lun in list(self._luns.values()):
+            _configfs_read()
+            yield lun
+
+    @property
+    def node_acls(self):
+        for node_acl in list(self._node_acls.values()):
+            _configfs_read()
+            yield node_acl
+
+    def lun(self, lun, storage_object=None, alias=None):
+        _configfs_read()
+        if lun is None:
+            # rtslib picks the lowest free index by listing every LUN
+            used = [ tpg_lun.lun for tpg_lun in self.luns ]
+            lun = next(index for index in range(65536) if index not in used)
+
+        if storage_object is None:
+            if lun not in self._luns:
+                raise RTSLibNotInCFSError(f"No such LUN: {lun}")
+            return self._luns[lun]
+
+        if lun in self._luns:
+            raise RTSLibError(f"LUN {lun} already exists")
+
+        self._luns[lun] = LUN(self, lun, storage_object)
+        return self._luns[lun]
+
+    def node_acl(self, node_wwn, mode="any"):
+        _configfs_read()
+        if node_wwn not in self._node_acls:
+            if mode == "lookup":
+                raise RTSLibNotInCFSError(f"No such node ACL: {node_wwn}")
+            self._node_acls[node_wwn] = NodeACL(self, node_wwn)
+        return self._node_acls[node_wwn]
+
+    def network_portal(self, ip_address, port, mode="any"):
+        _configfs_read()
+
+    def set_attribute(self, attribute, value):
+        _configfs_read()
+        self._attributes[attribute] = value
+
+class ISCSIFabricModule:
+    def __init__(self):
+        self.discovery_userid = None
+        self.discovery_password = None
+        self.discovery_mutual_userid = None
+        self.discovery_mutual_password = None
+        self.discovery_enable_auth = False
+
+class RTSRoot:
+    def save_to_file(self, save_file=None, so_path=None):
+        global saves
+        saves += 1
+        # saving serializes the whole tree
+        for tpg in TPG.instances:
+            for lun in tpg.luns:
+                lun.storage_object
+
+def reset():
+    global reads, saves
+    reads = 0
+    saves = 0
+    storage_objects.clear()
+    TPG.instances.clear()
+
+def install():
+    modules = {
+        "rtslib": types.ModuleType("rtslib"),
+        "rtslib.node": types.ModuleType("rtslib.node"),
+        "rtslib.root": types.ModuleType("rtslib.root"),
+        "rtslib.target": types.ModuleType("rtslib.target"),
+        "rtslib.tcm": types.ModuleType("rtslib.tcm"),
+        "rtslib.fabric": types.ModuleType("rtslib.fabric"),
+        "rtslib.utils": types.ModuleType("rtslib.utils"),
+    }
+    modules["rtslib.node"].CFSNode = CFSNode
+    modules["rtslib.root"].RTSRoot = RTSRoot
+    modules["rtslib.target"].Target = Target
+    modules["rtslib.target"].TPG = TPG
+    modules["rtslib.tcm"].BlockStorageObject = BlockStorageObject
+    modules["rtslib.tcm"].RTSLibNotInCFSError = RTSLibNotInCFSError
+    modules["rtslib.fabric"].ISCSIFabricModule = ISCSIFabricModule
+    modules["rtslib.utils"].RTSLibError = RTSLibError
+    modules["rtslib.utils"].RTSLibNotInCFSError = RTSLibNotInCFSError
+    sys.modules.update(modules)
@@ -0,0 +1,230 @@
+#!/usr/bin/env -S python3 -S
+"""Fake lvm, filesystem, and nfs tools for benchmarking.
+
+A single script that acts as lvs, vgs, pvs, lvcreate, lvconvert, lvextend, lvremove, lvrename, mkfs.*, mount,
+umount, dd, xfs_admin, blkid, exportfs, and showmount depending on the name it is invoked as. The
+benchmarks symlink it into a temporary bin directory that is put first on the PATH.
+It runs without site-packages (python3 -S) to keep the startup cost of every call low.
+
+Environment:
+    FAKE_LVM_STATE  json file holding the volume groups and logical volumes
+    FAKE_ETAB       etab file that exportfs edits and showmount reads
+    FAKE_LATENCY    seconds every invocation sleeps before doing anything
+"""
+import fcntl
+import json
+import os
+import sys
+import time
+import uuid
+
+UNITS = { "k": 1024, "m": 1024 ** 2, "g": 1024 ** 3, "t": 1024 ** 4 }
+
+def load_state():
+    with open(os.environ["FAKE_LVM_STATE"], "r") as f:
+        return json.load(f)
+
+def save_state(state):
+    with open(os.environ["FAKE_LVM_STATE"], "w") as f:
+        json.dump(state, f)
+
+def parse_size(size):
+    size = size.lower().removesuffix("b")
+    if size[-1] in UNITS:
+        return int(float(size[:-1]) * UNITS[size[-1]])
+    return int(size)
+
+def get_option(args, name, default=None):
+    if name in args:
+        return args[args.index(name) + 1]
+    return default
+
+def positional(args):
+    result = []
+    skip = False
+    for arg in args:
+        if skip:
+            skip = False
+        elif arg.startswith("-"):
+            skip = arg not in ("--yes", "--nosuffix", "--resizefs", "--uncache", "-f", "-a", "-r", "--no-headers")
+        else:
+            result.append(arg)
+    return result
+
+def report(kind, rows, fields):
+    print(json.dumps({ "report": [ { kind: [ { field: row.get(field, "") for field in fields } for row in rows ] } ] }))
+
+def vg_row(name, vg):
+    return { "vg_name": name, "vg_size": str(vg["size"]), "vg_free": str(vg["free"]), "vg_extent_size": str(vg["extent_size"]) }
+
+def lvs(args):
+    state = load_state()
+    fields = get_option(args, "-o", "vg_name,lv_name,lv_size").split(",")
+    targets = positional(args)
+    # only "-S segtype=..." and "-S segtype=~^..." selections are supported
+    segtype = get_option(args, "-S", "segtype=").split("=", 1)[1]
+
+    rows = []
+    for key, lv in state["lvs"].items():
+        if targets and key not in targets and key.split("/")[0] not in targets:
+            continue
+        if segtype.startswith("~^") and not lv.get("segtype", "linear").startswith(segtype[2:]):
+            continue
+        if segtype and not segtype.startswith("~") and lv.get("segtype", "linear") != segtype:
+            continue
+        vg_name, lv_name = key.split("/")
+        rows.append({
+            "lv_name": lv_name, "lv_size": str(lv["size"]), "lv_attr": "-wi-a-----", "segtype": lv.get("segtype", "linear"),
+            "pool_lv": lv.get("pool", ""), "origin": lv.get("origin", ""), "data_percent": str(lv.get("data_percent", "")), "metadata_percent": str(lv.get("metadata_percent", "")),
+            "sync_percent": "100.00" if lv.get("segtype", "").startswith("raid") else "", "raid_mismatch_count": "0" if lv.get("segtype", "").startswith("raid") else "",
+            "cache_mode": lv.get("cache_mode", ""), **({ "cache_total_blocks": "1000", "cache_used_blocks": "0", "cache_dirty_blocks": "0" } if "cache_mode" in lv else {}),
+            **vg_row(vg_name, state["vgs"][vg_name]),
+        })
+    report("lv", rows, fields)
+
+def vgs(args):
+    state = load_state()
+    fields = get_option(args, "-o", "vg_name,vg_size,vg_free").split(",")
+    targets = positional(args)
+    report("vg", [ vg_row(name, vg) for name, vg in state["vgs"].items() if not targets or name in targets ], fields)
+
+def pvs(args):
+    state = load_state()
+    # every volume group is a single fake disk
+    report("pv", [ { "pv_name": f"/dev/fake-{name}", "vg_name": name } for name in state["vgs"] ], get_option(args, "-o", "pv_name,vg_name").split(","))
+
+def lvconvert(args):
+    state = load_state()
+    key = positional(args)[-1]
+    lv = state["lvs"][key]
+    if "--uncache" in args:
+        # the cache pool is removed along with the cache
+        state["vgs"][key.split("/")[0]]["free"] += lv.pop("cache_size")
+        lv.update(segtype="linear", pool="")
+        del lv["cache_mode"]
+    else:
+        # the cache pool is hidden once it is attached
+        cache_pool = state["lvs"].pop(get_option(args, "--cachepool"))
+        lv.update(segtype="cache", pool=get_option(args, "--cachepool").split("/")[1], cache_mode=get_option(args, "--cachemode"), cache_size=cache_pool["size"])
+    save_state(state)
+
+def lvcreate(args):
+    state = load_state()
+    # lvcreate VG [PV...] or lvcreate --snapshot VG/LV
+    vg_name = positional(args)[-1].split("/")[0] if "--snapshot" in args else positional(args)[0]
+    key = f"{vg_name}/{get_option(args, '--name')}"
+    if key in state["lvs"]:
+        sys.exit(f"Logical volume {key} already exists")
+
+    if "--snapshot" in args:
+        origin_key = positional(args)[-1]
+        origin = state["lvs"][origin_key]
+        # thin snapshots share the pool, classic ones set aside space for changes
+        state["lvs"][key] = { **origin, "origin": origin_key.split("/")[1] }
+        if origin.get("segtype") != "thin":
+            state["lvs"][key] = { "size": origin["size"], "segtype": "linear", "origin": origin_key.split("/")[1] }
+            state["lvs"][key]["reserved"] = parse_size(get_option(args, "--size"))
+            state["vgs"][vg_name]["free"] -= state["lvs"][key]["reserved"]
+        save_state(state)
+        return
+
+    segtype = get_option(args, "--type", "linear")
+    if segtype == "thin":
+        # thin volumes take their space from the pool as they are written to
+        state["lvs"][key] = { "size": parse_size(get_option(args, "--virtualsize")), "segtype": "thin", "pool": get_option(args, "--thinpool"), "data_percent": 0.0 }
+        save_state(state)
+        return
+
+    size = parse_size(get_option(args, "--size"))
+    if size > state["vgs"][vg_name]["free"]:
+        sys.exit("Insufficient free space")
+
+    state["lvs"][key] = { "size": size, "segtype": segtype }
+    if segtype == "thin-pool":
+        state["lvs"][key].update(data_percent=0.0, metadata_percent=0.0)
+    state["vgs"][vg_name]["free"] -= size
+    save_state(state)
+
+def lvextend(args):
+    state = load_state()
+    # lvextend LV [PV...]
+    key = positional(args)[0].replace("/dev/", "")
+    size = parse_size(get_option(args, "--size"))
+    vg_name = key.split("/")[0]
+    if state["lvs"][key].get("segtype") != "thin":
+        state["vgs"][vg_name]["free"] -= size - state["lvs"][key]["size"]
+    state["lvs"][key]["size"] = size
+    save_state(state)
+
+def lvremove(args):
+    state = load_state()
+    key = positional(args)[0]
+    lv = state["lvs"].pop(key)
+    if lv.get("segtype") != "thin":
+        state["vgs"][key.split("/")[0]]["free"] += lv.get("reserved", lv["size"])
+    save_state(state)
+
+def lvrename(args):
+    state = load_state()
+    vg_name, old_name, new_name = positional(args)
+    state["lvs"][f"{vg_name}/{new_name}"] = state["lvs"].pop(f"{vg_name}/{old_name}")
+    save_state(state)
+
+def exportfs(args):
+    etab = os.environ["FAKE_ETAB"]
+    options = get_option(args, "-o", "rw")
+    exports = [ arg.split(":", 1) for arg in positional(args) ]
+
+    with open(etab, "r") as f:
+        lines = f.readlines()
+
+    if "-u" in args:
+        removed = set(f"{path}\t{client}(" for client, path in exports)
+        lines = [ line for line in lines if not any(line.startswith(prefix) for prefix in removed) ]
+    else:
+        lines.extend(f"{path}\t{client}({options})\n" for client, path in exports)
+
+    with open(etab, "w") as f:
+        f.writelines(lines)
+
+def showmount(args):
+    clients = {}
+    with open(os.environ["FAKE_ETAB"], "r") as f:
+        for line in f:
+            path, client = line.split()[0], line.split()[1].split("(")[0]
+            clients.setdefault(path, []).append(client)
+    for path, path_clients in clients.items():
+        print(f"{path} {','.join(path_clients)}")
+
+def blkid(args):
+    print("xfs" if "TYPE" in args else uuid.uuid4())
+
+TOOLS = {
+    "lvs": lvs,
+    "vgs": vgs,
+    "pvs": pvs,
+    "lvcreate": lvcreate,
+    "lvconvert": lvconvert,
+    "lvextend": lvextend,
+    "lvremove": lvremove,
+    "lvrename": lvrename,
+    "exportfs": exportfs,
+    "showmount": showmount,
+    "blkid": blkid,
+}
+
+# every name the script is linked as
+TOOL_NAMES = [ *TOOLS, "mkfs.xfs", "mkfs.ext4", "mount", "umount", "dd", "xfs_admin" ]
+
+def main():
+    time.sleep(float(os.environ.get("FAKE_LATENCY", "0")))
+    name = os.path.basename(sys.argv[0])
+
+    # the load test runs many tools at once. only one may touch the state files at a time
+    with open(os.environ["FAKE_LVM_STATE"], "a") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        # mkfs, mount, umount, dd, and xfs_admin only cost time
+        TOOLS.get(name, lambda args: None)(sys.argv[1:])
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,409 @@
+#!/usr/bin/env python3
+"""End-to-end load test of the LabDisk operator against a fake Kubernetes API server.
+
+Starts bench/fake_apiserver.py in this process, runs the real operator (through
+bench/operator_shim.py, with the fake lvm/exportfs tools and rtslib) as a child process,
+and replays a stream of PVC creates, resizes, and deletes against it. Reports
+time-to-bound, resize and delete latency, handler queue depth, API calls by verb and
+resource, and the CPU and RSS of the operator process.
+
+The stream is either generated (--pvcs over --duration, mixed by --mix) or replayed
+from a JSON lines trace (--trace). Every line of a trace is an event like:
+    {"at": 1.5, "op": "create", "name": "claim-1", "type": "nfs", "size": "1Gi"}
+    {"at": 9.0, "op": "resize", "name": "claim-1", "size": "2Gi"}
+    {"at": 20.0, "op": "delete", "name": "claim-1"}
+Resizes and deletes wait for the claim to be bound first. Use --record to save a
+generated stream as a trace.
+
+Usage:
+    python bench/load_test.py [--pvcs 2000] [--duration 60] [--mix nfs=2,iscsi=2,shared-nfs=1]
+        [--resizes 0.1] [--deletes 0.5] [--trace FILE] [--record FILE] [--config KEY=VALUE ...]
+        [--sc-param KEY=VALUE ...]
+"""
+import argparse
+import asyncio
+import collections
+import json
+import os
+import random
+import shutil
+import socket
+import sys
+import tempfile
+import time
+
+import aiohttp
+from prometheus_client.parser import text_string_to_metric_families
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+sys.path.insert(0, BENCH_DIR)
+
+import fake_tools
+from fake_apiserver import FakeApiServer
+from config import Constants
+
+NODE_NAME = "load-node-0"
+NAMESPACE = "default"
+VOLUME_GROUP = "vg-load"
+CONFIGMAP = "lab-disk-config"
+PROVISIONER = "ragdollphysics.org/lab-disk"
+SAMPLE_INTERVAL = 0.5
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def generate_events(args):
+    rng = random.Random(args.seed)
+    mix = { name: float(weight) for name, weight in (item.split("=") for item in args.mix.split(",")) }
+
+    events = []
+    for i in range(args.pvcs):
+        at = i * args.duration / args.pvcs
+        name = f"load-{i}"
+        volume_type = rng.choices(list(mix), weights=list(mix.values()))[0]
+        events.append({ "at": round(at, 3), "op": "create", "name": name, "type": volume_type, "size": "1Gi" })
+
+        # shared volumes are directories, they can't be resized
+        if volume_type != Constants.VOLUME_TYPE_SHARED and rng.random() < args.resizes:
+            events.append({ "at": round(at + rng.uniform(5, 15), 3), "op": "resize", "name": name, "size": "2Gi" })
+        if rng.random() < args.deletes:
+            events.append({ "at": round(at + rng.uniform(20, 40), 3), "op": "delete", "name": name })
+
+    return sorted(events, key=lambda event: event["at"])
+
+class LoadTest:
+    def __init__(self, args, work_dir):
+        self.args = args
+        self.work_dir = work_dir
+        self.server = FakeApiServer()
+        self.server.listeners.append(self.on_change)
+        self.operator = None
+        self.liveness_port = free_port()
+        self.metrics_port = free_port()
+
+        self.claims = {} # name -> { "uid", "type", "created", "bound" (event) }
+        self.pending = collections.Counter() # op -> outstanding requests
+        self.expected_sizes = {} # uid -> (size, resize start)
+        self.deleting = {} # uid -> delete start
+        self.latencies = collections.defaultdict(list) # metric -> seconds
+        self.samples = collections.defaultdict(list) # metric -> sampled values
+        self.placement_rng = random.Random(args.seed)
+
+    # cluster setup
+
+    def seed_cluster(self):
+        cluster_config = {
+            "provisioner": PROVISIONER,
+            "lvm_group": VOLUME_GROUP,
+            "shared_nfs_root": os.path.join(self.work_dir, "shared"),
+            "shared_nfs_nodes": NODE_NAME,
+            "nfs_access_cidr": "10.0.0.0/8",
+            "iscsi_portal_addr": "0.0.0.0:3260",
+            "supported_namespaces": NAMESPACE,
+            "allow_destructive_actions": "true",
+            "metrics_port": str(self.metrics_port),
+        }
+        if self.args.unplaced:
+            cluster_config["automatic_placement"] = "true"
+        cluster_config.update(item.split("=", 1) for item in self.args.config)
+
+        self.server.create("v1", "configmaps", { "metadata": { "name": CONFIGMAP }, "data": cluster_config }, "kube-system")
+        for namespace in [ "default", "kube-system" ]:
+            self.server.create("v1", "namespaces", { "metadata": { "name": namespace } })
+        for i in range(self.args.nodes):
+            self.server.create("v1", "nodes", { "metadata": { "name": f"load-node-{i}" } })
+
+        sc_params = dict(item.split("=", 1) for item in self.args.sc_param)
+        for volume_type in [ Constants.VOLUME_TYPE_NFS, Constants.VOLUME_TYPE_ISCSI, Constants.VOLUME_TYPE_SHARED ]:
+            self.server.create("storage.k8s.io/v1", "storageclasses", {
+                "metadata": { "name": f"lab-disk-{volume_type}" },
+                "provisioner": PROVISIONER,
+                "parameters": { "type": volume_type, **(sc_params if volume_type != Constants.VOLUME_TYPE_SHARED else {}) },
+                "reclaimPolicy": "Delete",
+                "allowVolumeExpansion": True,
+            })
+
+        lvs = {}
+        if "thin_pool" in sc_params:
+            lvs[f"{VOLUME_GROUP}/{sc_params['thin_pool']}"] = { "size": 1024 ** 5, "segtype": "thin-pool", "data_percent": 0.0, "metadata_percent": 0.0 }
+
+        with open(os.environ["FAKE_LVM_STATE"], "w") as f:
+            json.dump({ "vgs": { VOLUME_GROUP: { "size": 1024 ** 6, "free": 1024 ** 6, "extent_size": 4 * 1024 ** 2 } }, "lvs": lvs }, f)
+        open(os.environ["FAKE_ETAB"], "w").close()
+        open(os.path.join(self.work_dir, "fstab"), "w").close()
+
+    def setup_environment(self):
+        bin_dir = os.path.join(self.work_dir, "bin")
+        os.makedirs(bin_dir)
+        for tool in fake_tools.TOOL_NAMES:
+            os.symlink(os.path.join(BENCH_DIR, "fake_tools.py"), os.path.join(bin_dir, tool))
+
+        kubeconfig = os.path.join(self.work_dir, "kubeconfig")
+        with open(kubeconfig, "w") as f:
+            json.dump({
+                "apiVersion": "v1",
+                "kind": "Config",
+                "clusters": [ { "name": "fake", "cluster": { "server": f"http://127.0.0.1:{self.server.port}" } } ],
+                "users": [ { "name": "fake", "user": { "token": "fake" } } ],
+                "contexts": [ { "name": "fake", "context": { "cluster": "fake", "user": "fake", "namespace": "kube-system" } } ],
+                "current-context": "fake",
+            }, f)
+
+        os.environ.update({
+            "PATH": f"{bin_dir}:{os.environ['PATH']}",
+            "KUBECONFIG": kubeconfig,
+            "LAB_DISK_CONFIGMAP": CONFIGMAP,
+            "LAB_DISK_NAMESPACE": "kube-system",
+            "LAB_DISK_NODE_IP": "127.0.0.1",
+            "LAB_DISK_NODE_NAME": NODE_NAME,
+            "LOADTEST_WORK_DIR": self.work_dir,
+            "FAKE_LVM_STATE": os.path.join(self.work_dir, "lvm.json"),
+            "FAKE_ETAB": os.path.join(self.work_dir, "etab"),
+            "FAKE_LATENCY": str(self.args.latency),
+        })
+
+    async def start_operator(self):
+        log = open(self.args.operator_log or os.path.join(self.work_dir, "operator.log"), "w")
+        self.operator = await asyncio.create_subprocess_exec(
+            sys.executable, os.path.join(BENCH_DIR, "operator_shim.py"), f"http://127.0.0.1:{self.liveness_port}/healthz",
+            stdout=log, stderr=log
+        )
+
+        # kopf only serves the liveness endpoint once the startup handlers are done
+        start_time = time.monotonic()
+        async with aiohttp.ClientSession() as session:
+            while self.operator.returncode is None:
+                try:
+                    async with session.get(f"http://127.0.0.1:{self.liveness_port}/healthz") as response:
+                        if response.status == 200:
+                            return time.monotonic() - start_time
+                except aiohttp.ClientError:
+                    pass
+                await asyncio.sleep(0.1)
+
+        raise RuntimeError(f"The operator exited during startup with status {self.operator.returncode}")
+
+    async def stop_operator(self):
+        if self.operator.returncode is None:
+            self.operator.terminate()
+            try:
+                await asyncio.wait_for(self.operator.wait(), 30)
+            except TimeoutError:
+                self.operator.kill()
+
+    # replaying events
+
+    def on_change(self, event_type, plural, obj):
+        now = time.monotonic()
+        metadata = obj["metadata"]
+
+        if plural == "persistentvolumeclaims":
+            claim = self.claims.get(metadata["name"])
+            if claim is None or claim["uid"] != metadata["uid"]:
+                return
+
+            if obj.get("status", {}).get("phase") == "Bound" and not claim["bound"].is_set():
+                claim["bound"].set()
+                self.pending["create"] -= 1
+                self.latencies[f"time-to-bound ({claim['type']})"].append(now - claim["created"])
+
+            # kopf stores the last handled spec once every handler for a change succeeded
+            expected = self.expected_sizes.get(metadata["uid"])
+            handled = json.loads(metadata.get("annotations", {}).get(Constants.LAST_HANDLED_ANNOTATION_KEY, "{}"))
+            if expected and handled.get("spec", {}).get("resources", {}).get("requests", {}).get("storage") == expected[0]:
+                del self.expected_sizes[metadata["uid"]]
+                self.pending["resize"] -= 1
+                self.latencies["resize handled"].append(now - expected[1])
+
+        if event_type == "DELETED" and plural in ("persistentvolumeclaims", "persistentvolumes"):
+            uid = metadata["uid"] if plural == "persistentvolumeclaims" else metadata["name"].removeprefix("pvc-")
+            # a delete is done once both the claim and its volume are gone
+            if uid in self.deleting and not self.server.get("v1", "persistentvolumes", None, f"pvc-{uid}") and uid not in self.server.claims_by_uid:
+                self.pending["delete"] -= 1
+                self.latencies["delete completed"].append(now - self.deleting.pop(uid))
+
+    async def apply(self, event):
+        if event["op"] == "create":
+            annotations = {}
+            # the rest is left for the operator to place
+            if self.placement_rng.random() >= self.args.unplaced:
+                annotations[Constants.PVC_NODE_SELECTOR_ANNOTATION_KEY] = NODE_NAME
+            access_modes = [ "ReadWriteOnce" ]
+            if event["type"] == Constants.VOLUME_TYPE_SHARED:
+                annotations[Constants.SHARED_STORAGE_PATH_ANNOTATION_KEY] = event["name"]
+                access_modes = [ "ReadWriteMany" ]
+
+            claim = { "uid": None, "type": event["type"], "created": time.monotonic(), "bound": asyncio.Event() }
+            self.claims[event["name"]] = claim
+            self.pending["create"] += 1
+            pvc = self.server.create("v1", "persistentvolumeclaims", {
+                "metadata": { "name": event["name"], "annotations": annotations },
+                "spec": {
+                    "storageClassName": f"lab-disk-{event['type']}",
+                    "accessModes": access_modes,
+                    "volumeMode": "Filesystem",
+                    "resources": { "requests": { "storage": event["size"] } },
+                }
+            }, NAMESPACE)
+            claim["uid"] = pvc["metadata"]["uid"]
+            return
+
+        claim = self.claims[event["name"]]
+        await claim["bound"].wait()
+
+        if event["op"] == "resize":
+            self.pending["resize"] += 1
+            self.expected_sizes[claim["uid"]] = (event["size"], time.monotonic())
+            self.server.patch("v1", "persistentvolumeclaims", NAMESPACE, event["name"], { "spec": { "resources": { "requests": { "storage": event["size"] } } } })
+        elif event["op"] == "delete":
+            self.pending["delete"] += 1
+            self.deleting[claim["uid"]] = time.monotonic()
+            self.server.delete("v1", "persistentvolumeclaims", NAMESPACE, event["name"])
+
+    async def replay(self, events):
+        start_time = time.monotonic()
+        tasks = []
+        for event in events:
+            delay = start_time + event["at"] - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            tasks.append(asyncio.create_task(self.apply(event)))
+
+        await asyncio.gather(*tasks)
+
+        # wait for the operator to finish everything that was requested
+        while sum(self.pending.values()) > 0 and time.monotonic() - start_time < self.args.timeout:
+            await asyncio.sleep(SAMPLE_INTERVAL)
+
+        return time.monotonic() - start_time
+
+    # sampling
+
+    def read_process_usage(self):
+        with open(f"/proc/{self.operator.pid}/stat", "r") as f:
+            fields = f.read().rsplit(")", 1)[1].split()
+        cpu_seconds = (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+        # the fake tools the operator ran. counted separately so they don't inflate the operator's usage
+        tool_cpu_seconds = (int(fields[13]) + int(fields[14])) / os.sysconf("SC_CLK_TCK")
+
+        with open(f"/proc/{self.operator.pid}/status", "r") as f:
+            rss_kb = next(int(line.split()[1]) for line in f if line.startswith("VmRSS:"))
+        return cpu_seconds, tool_cpu_seconds, rss_kb * 1024
+
+    async def sample(self):
+        last_cpu, last_tool_cpu, _ = self.read_process_usage()
+        last_time = time.monotonic()
+        async with aiohttp.ClientSession() as session:
+            while True:
+                await asyncio.sleep(SAMPLE_INTERVAL)
+                cpu_seconds, tool_cpu_seconds, rss = self.read_process_usage()
+                now = time.monotonic()
+                self.samples["cpu cores"].append((cpu_seconds - last_cpu) / (now - last_time))
+                self.samples["fake tool cpu cores"].append((tool_cpu_seconds - last_tool_cpu) / (now - last_time))
+                self.samples["rss MiB"].append(rss / 1024 ** 2)
+                self.samples["outstanding requests"].append(sum(self.pending.values()))
+                last_cpu, last_tool_cpu, last_time = cpu_seconds, tool_cpu_seconds, now
+
+                try:
+                    async with session.get(f"http://127.0.0.1:{self.metrics_port}/metrics") as response:
+                        families = text_string_to_metric_families(await response.text())
+                        self.samples["handlers in progress"].append(sum(sample.value
+                            for family in families if family.name == "labdisk_handlers_in_progress" for sample in family.samples))
+                except aiohttp.ClientError:
+                    pass
+
+    async def run(self, events):
+        await self.server.start()
+        self.setup_environment()
+        self.seed_cluster()
+
+        try:
+            startup_time = await self.start_operator()
+            print(f"operator ready after {startup_time:.2f}s, replaying {len(events)} events", flush=True)
+
+            sampler = asyncio.create_task(self.sample())
+            duration = await self.replay(events)
+            sampler.cancel()
+            cpu_seconds = self.read_process_usage()[0]
+        finally:
+            if self.operator:
+                await self.stop_operator()
+            await self.server.stop()
+
+        self.report(events, duration, cpu_seconds)
+
+    def report(self, events, duration, cpu_seconds):
+        print(f"\nreplayed {len(events)} events in {duration:.1f}s, operator used {cpu_seconds:.1f}s of cpu")
+        unfinished = { op: count for op, count in self.pending.items() if count }
+        if unfinished:
+            print(f"timed out waiting for: {unfinished}")
+
+        print(f"\n{'latency':<44} {'count':>6} {'p50 s':>9} {'p95 s':>9} {'p99 s':>9} {'max s':>9}")
+        for name, durations in sorted(self.latencies.items()):
+            durations = sorted(durations)
+            p50, p95, p99 = [ durations[min(len(durations) - 1, int(p * len(durations)))] for p in (0.5, 0.95, 0.99) ]
+            print(f"{name:<44} {len(durations):>6} {p50:>9.2f} {p95:>9.2f} {p99:>9.2f} {durations[-1]:>9.2f}")
+
+        print(f"\n{'sample':<44} {'mean':>10} {'peak':>10}")
+        for name, values in self.samples.items():
+            if values:
+                print(f"{name:<44} {sum(values) / len(values):>10.2f} {max(values):>10.2f}")
+
+        claims = len(self.claims) or 1
+        print(f"\n{'api calls':<44} {'count':>10} {'per pvc':>10}")
+        for call, count in sorted(self.server.api_calls.items(), key=lambda item: -item[1]):
+            print(f"{call:<44} {count:>10} {count / claims:>10.2f}")
+        print(f"{'total':<44} {sum(self.server.api_calls.values()):>10} {sum(self.server.api_calls.values()) / claims:>10.2f}")
+
+        if self.args.report:
+            with open(self.args.report, "w") as f:
+                json.dump({
+                    "duration": duration,
+                    "cpu_seconds": cpu_seconds,
+                    "unfinished": unfinished,
+                    "latencies": self.latencies,
+                    "samples": self.samples,
+                    "api_calls": self.server.api_calls,
+                }, f)
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--pvcs", type=int, default=2000, help="number of claims to create")
+    parser.add_argument("--duration", type=float, default=60, help="seconds over which the claims are created")
+    parser.add_argument("--mix", default="nfs=2,iscsi=2,shared-nfs=1", help="relative weights of the volume types")
+    parser.add_argument("--resizes", type=float, default=0.1, help="fraction of claims that are resized")
+    parser.add_argument("--deletes", type=float, default=0.5, help="fraction of claims that are deleted")
+    parser.add_argument("--seed", type=int, default=0, help="random seed for the generated events")
+    parser.add_argument("--trace", help="replay the events from this JSON lines file instead of generating them")
+    parser.add_argument("--record", help="write the replayed events to this JSON lines file")
+    parser.add_argument("--nodes", type=int, default=3, help="number of nodes in the cluster (iSCSI initiators)")
+    parser.add_argument("--unplaced", type=float, default=0.0, help="fraction of claims created without a disk-node annotation")
+    parser.add_argument("--latency", type=float, default=0.0, help="extra seconds every fake tool invocation takes")
+    parser.add_argument("--timeout", type=float, default=600, help="seconds to wait for the operator to catch up")
+    parser.add_argument("--config", action="append", default=[], metavar="KEY=VALUE", help="override a LabDisk config option")
+    parser.add_argument("--sc-param", action="append", default=[], metavar="KEY=VALUE", help="add a parameter to the nfs and iscsi storage classes (ex: thin_pool=thin, warm_pool=1Gi:xfs:8)")
+    parser.add_argument("--operator-log", help="write the operator's log to this file")
+    parser.add_argument("--report", help="write the raw results to this json file")
+    args = parser.parse_args()
+
+    if args.trace:
+        with open(args.trace, "r") as f:
+            events = [ json.loads(line) for line in f if line.strip() ]
+    else:
+        events = generate_events(args)
+
+    if args.record:
+        with open(args.record, "w") as f:
+            f.writelines(json.dumps(event) + "\n" for event in events)
+
+    work_dir = tempfile.mkdtemp(prefix="labdisk-load-")
+    try:
+        await LoadTest(args, work_dir).run(events)
+    finally:
+        shutil.rmtree(work_dir)
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,40 @@
+#!/usr/bin/env python3
+"""Runs the real LabDisk operator (handler.py) against the fake tools and rtslib.
+
+Started by bench/load_test.py, which provides the kubeconfig and LabDisk environment
+variables. Host paths (nfs mounts, fstab, etab) are redirected into LOADTEST_WORK_DIR.
+
+Usage:
+    python bench/operator_shim.py LIVENESS_URL
+"""
+import os
+import sys
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+sys.path.insert(0, BENCH_DIR)
+
+import fake_rtslib
+fake_rtslib.install()
+
+import kopf
+
+import fstab
+import nfs
+import util
+
+work_dir = os.environ["LOADTEST_WORK_DIR"]
+nfs.ETAB_PATH = os.environ["FAKE_ETAB"]
+nfs.VOLUME_ROOT = os.path.join(work_dir, "nfs")
+fstab.FSTAB_PATH = os.path.join(work_dir, "fstab")
+
+# the fake tools don't create device nodes
+async def device_exists(device_path, timeout):
+    pass
+util.wait_for_device = device_exists
+
+# registers the handlers
+import handler
+
+if __name__ == "__main__":
+    kopf.run(standalone=True, clusterwide=True, liveness_endpoint=sys.argv[1])
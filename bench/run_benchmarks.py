@@ -0,0 +1,156 @@
+#!/usr/bin/env python3
+"""Microbenchmarks for the lvm, nfs, and iscsi subsystems against local stand-ins.
+
+The lvm and nfs tools are replaced by bench/fake_tools.py and rtslib by an in-memory
+fake (bench/fake_rtslib.py) so this runs on a laptop without root, LVM, or LIO. Each
+benchmark is repeated with the number of existing LVs/exports/LUNs scaled up so that
+O(n) regressions show up as throughput dropping with size.
+
+Usage:
+    python bench/run_benchmarks.py [--sizes 10,100,1000,5000] [--ops 50]
+        [--latency SECONDS] [--configfs-latency SECONDS]
+"""
+import argparse
+import asyncio
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+import types
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+sys.path.insert(0, BENCH_DIR)
+
+import fake_rtslib
+import fake_tools
+fake_rtslib.install()
+
+import config
+import util
+import lvm
+import nfs
+import iscsi
+
+VOLUME_GROUP = "vg-bench"
+NFS_CLIENT = "10.0.0.0/8"
+NODES = [ f"node-{i}" for i in range(3) ]
+
+def setup_environment(work_dir, latency):
+    bin_dir = os.path.join(work_dir, "bin")
+    os.makedirs(bin_dir)
+    for tool in fake_tools.TOOL_NAMES:
+        os.symlink(os.path.join(BENCH_DIR, "fake_tools.py"), os.path.join(bin_dir, tool))
+
+    os.environ["PATH"] = f"{bin_dir}:{os.environ['PATH']}"
+    os.environ["FAKE_LVM_STATE"] = os.path.join(work_dir, "lvm.json")
+    os.environ["FAKE_ETAB"] = os.path.join(work_dir, "etab")
+    os.environ["FAKE_LATENCY"] = str(latency)
+
+    nfs.ETAB_PATH = os.environ["FAKE_ETAB"]
+    config.config = types.SimpleNamespace(allow_destructive_actions=True, device_timeout=5.0, thin_pool_fill_threshold=90.0, thin_pool_max_overcommit=0)
+
+    # the fake tools don't create device nodes
+    async def device_exists(device_path, timeout):
+        pass
+    util.wait_for_device = device_exists
+
+def summarize(name, size, durations, configfs_reads=None):
+    durations = sorted(durations)
+    def percentile(p):
+        return durations[min(len(durations) - 1, int(p * len(durations)))] * 1000
+
+    line = f"{name:<36} {size:>6} {len(durations) / sum(durations):>10.1f} {percentile(0.5):>9.2f} {percentile(0.95):>9.2f} {percentile(0.99):>9.2f}"
+    if configfs_reads is not None:
+        line += f" {configfs_reads / len(durations):>10.1f}"
+    print(line, flush=True)
+
+async def measure(ops, operation):
+    durations = []
+    for i in range(ops):
+        start_time = time.perf_counter()
+        result = operation(i)
+        if asyncio.iscoroutine(result):
+            await result
+        durations.append(time.perf_counter() - start_time)
+    return durations
+
+async def bench_lvm(size, ops):
+    lvs = { f"{VOLUME_GROUP}/existing-{i}": { "size": 1024 ** 3 } for i in range(size) }
+    lvs[f"{VOLUME_GROUP}/thin"] = { "size": 1024 ** 4, "segtype": "thin-pool", "data_percent": 0.0, "metadata_percent": 0.0 }
+    with open(os.environ["FAKE_LVM_STATE"], "w") as f:
+        json.dump({ "vgs": { VOLUME_GROUP: { "size": 1024 ** 5, "free": 1024 ** 5 - size * 1024 ** 3, "extent_size": 4 * 1024 ** 2 } }, "lvs": lvs }, f)
+
+    lvm.invalidate_inventory()
+    summarize("lvm.create_volume", size, await measure(ops, lambda i: lvm.create_volume(VOLUME_GROUP, f"bench-{i}", "xfs", False, "1Gi")))
+    summarize("lvm.volume_exists", size, await measure(ops, lambda i: lvm.volume_exists(VOLUME_GROUP, f"existing-{i % max(size, 1)}")))
+    summarize("lvm.delete_volume", size, await measure(ops, lambda i: lvm.delete_volume(VOLUME_GROUP, f"bench-{i}")))
+    summarize("lvm.create_volume (thin)", size, await measure(ops, lambda i: lvm.create_volume(VOLUME_GROUP, f"bench-thin-{i}", "xfs", False, "1Gi", thin_pool="thin")))
+
+async def bench_nfs(size, ops):
+    with open(os.environ["FAKE_ETAB"], "w") as f:
+        f.writelines(f"{nfs.VOLUME_ROOT}/existing-{i}\t{NFS_CLIENT}(rw,sync)\n" for i in range(size))
+
+    with nfs.export_table_lock:
+        nfs.export_table = None
+
+    summarize("nfs.export_share", size, await measure(ops, lambda i: nfs.export_share(f"{nfs.VOLUME_ROOT}/bench-{i}", NFS_CLIENT)))
+    summarize("nfs.get_exported_filesystems", size, await measure(ops, lambda i: (f"{nfs.VOLUME_ROOT}/existing-{i}", NFS_CLIENT) in nfs.get_exported_filesystems()))
+    summarize("nfs.refresh_exported_filesystems", size, await measure(ops, lambda i: nfs.refresh_exported_filesystems()))
+    summarize("nfs.un_export_share", size, await measure(ops, lambda i: nfs.un_export_share(f"{nfs.VOLUME_ROOT}/bench-{i}", NFS_CLIENT)))
+
+async def bench_iscsi(size, ops):
+    fake_rtslib.reset()
+    iscsi.init_iscsi("bench-node", "0.0.0.0:3260")
+
+    for i in range(size):
+        so = fake_rtslib.BlockStorageObject(f"{VOLUME_GROUP}:existing-{i}", dev=f"/dev/{VOLUME_GROUP}/existing-{i}")
+        lun = iscsi.tpg.lun(i, storage_object=so)
+        for node in NODES:
+            iscsi.tpg.node_acl(iscsi.node_iqn(node)).mapped_lun(i, tpg_lun=lun)
+
+    iscsi.rebuild_lun_index()
+    iscsi.cluster_nodes = set(NODES)
+
+    async def run(name, operation):
+        fake_rtslib.reads = 0
+        durations = await measure(ops, operation)
+        summarize(name, size, durations, fake_rtslib.reads)
+        return fake_rtslib.reads / ops
+
+    await run("iscsi.create_lun_from_volume", lambda i: iscsi.create_lun_from_volume(VOLUME_GROUP, f"bench-{i}"))
+    await run("iscsi.find_lun_for_volume", lambda i: iscsi.find_lun_for_volume(VOLUME_GROUP, f"existing-{i % max(size, 1)}"))
+    await run("iscsi.export_disk", lambda i: iscsi.export_disk(VOLUME_GROUP, f"bench-{ops + i}", None))
+    teardown_reads = await run("iscsi.un_export_disk", lambda i: iscsi.un_export_disk(VOLUME_GROUP, f"bench-{ops + i}"))
+    iscsi.flush_iscsi_config()
+    return teardown_reads
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", default="10,100,1000,5000", help="comma separated counts of existing LVs/exports/LUNs")
+    parser.add_argument("--ops", type=int, default=50, help="operations measured per benchmark and size")
+    parser.add_argument("--latency", type=float, default=0.0, help="extra seconds every fake tool invocation takes")
+    parser.add_argument("--configfs-latency", type=float, default=0.0, help="seconds every fake configfs read takes")
+    args = parser.parse_args()
+
+    fake_rtslib.read_latency = args.configfs_latency
+    work_dir = tempfile.mkdtemp(prefix="labdisk-bench-")
+    try:
+        setup_environment(work_dir, args.latency)
+
+        print(f"{'benchmark':<36} {'size':>6} {'ops/sec':>10} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'cfs reads':>10}")
+        teardown_reads = {}
+        for size in [ int(size) for size in args.sizes.split(",") ]:
+            await bench_lvm(size, args.ops)
+            await bench_nfs(size, args.ops)
+            teardown_reads[size] = await bench_iscsi(size, args.ops)
+
+        # tearing down a LUN must not look at the other LUNs
+        assert len(set(teardown_reads.values())) == 1, f"iscsi.un_export_disk configfs reads per call grow with the number of LUNs: {teardown_reads}"
+    finally:
+        shutil.rmtree(work_dir)
+
+if __name__ == "__main__":
+    asyncio.run(main())
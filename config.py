@@ -12,18 +12,25 @@ class Constants:
     SHARED_STORAGE_PATH_ANNOTATION_KEY = f"{PERSISTENCE_ANNOTATION_KEY_PREFIX}/shared-storage-path"
     FILESYSTEM_ANNOTATION_KEY = f"{PERSISTENCE_ANNOTATION_KEY_PREFIX}/filesystem"
     MIRROR_ANNOTATION_KEY = f"{PERSISTENCE_ANNOTATION_KEY_PREFIX}/mirror"
+    RAID_ANNOTATION_KEY = f"{PERSISTENCE_ANNOTATION_KEY_PREFIX}/raid"
     PVC_FINALIZER_KEY = f"{PERSISTENCE_ANNOTATION_KEY_PREFIX}/disk-finalizer"
     PV_ASSIGNED_NODE_ANNOTATION_KEY = f"{PERSISTENCE_ANNOTATION_KEY_PREFIX}/lab-disk-node"
     IMPORTED_LVM_NAME_ANNOTATION_KEY = f"{PERSISTENCE_ANNOTATION_KEY_PREFIX}/lvm-disk-to-import"
+    SNAPSHOT_VOLUME_ANNOTATION_KEY = f"{PERSISTENCE_ANNOTATION_KEY_PREFIX}/snapshot-volume"
+    LAST_HANDLED_ANNOTATION_KEY = f"{PERSISTENCE_ANNOTATION_KEY_PREFIX}/last-handled-configuration"
+    NODE_CAPACITY_ANNOTATION_KEY = f"{PERSISTENCE_ANNOTATION_KEY_PREFIX}/capacity"
+
+    SNAPSHOT_API_GROUP = "snapshot.storage.k8s.io"
 
     VOLUME_TYPE_NFS = "nfs"
     VOLUME_TYPE_ISCSI = "iscsi"
     VOLUME_TYPE_SHARED = "shared-nfs"
 
     NFS_MOUNT_FLAGS = "rw,sync,no_subtree_check,insecure,no_root_squash"
+    FS_MOUNT_FLAGS = "defaults,noatime"
 
-    # support more raid modes?
-    LVM_RAID1_FLAGS = [ "--type", "raid1", "--mirrors", "1", "--nosync" ]
+    # raid type -> fewest stripes it can have (raid5 and raid6 stripe counts don't include the parity disks)
+    LVM_RAID_TYPES = { "raid1": 1, "raid10": 2, "raid5": 2, "raid6": 3 }
 
 class Config:
     def __init__(self):
@@ -69,6 +76,34 @@ class Config:
         logger.info(f"Shared Volumes Enabled: {self.shared_volumes_enabled}")
         logger.info(f"Individual Volumes Enabled: {self.individual_volumes_enabled}")
 
+        self.max_concurrent_operations = int(config.get("max_concurrent_operations", "16"))
+        self.max_concurrent_processes = int(config.get("max_concurrent_processes", "32"))
+        self.process_timeout = float(config.get("process_timeout", "600"))
+        self.device_timeout = float(config.get("device_timeout", "30"))
+        self.metrics_port = int(config.get("metrics_port", "9100"))
+
+        self.thin_pool_fill_threshold = float(config.get("thin_pool_fill_threshold", "90"))
+        self.thin_pool_max_overcommit = float(config.get("thin_pool_max_overcommit", "10"))
+        self.thin_pool_monitor_interval = float(config.get("thin_pool_monitor_interval", "60"))
+        self.cache_monitor_interval = float(config.get("cache_monitor_interval", "60"))
+        self.raid_monitor_interval = float(config.get("raid_monitor_interval", "60"))
+        self.snapshot_reserve_percent = float(config.get("snapshot_reserve_percent", "20"))
+        self.warm_pool_refill_interval = float(config.get("warm_pool_refill_interval", "5"))
+
+        self.automatic_placement = config.get("automatic_placement", "false").lower() == "true"
+        self.capacity_publish_interval = float(config.get("capacity_publish_interval", "30"))
+
+        self.nfsd_autoscale_interval = float(config.get("nfsd_autoscale_interval", "0"))
+        self.nfsd_min_threads = int(config.get("nfsd_min_threads", "8"))
+        self.nfsd_max_threads = int(config.get("nfsd_max_threads", "64"))
+        self.nfsd_scale_up_threshold = float(config.get("nfsd_scale_up_threshold", "5"))
+        self.nfsd_scale_down_threshold = float(config.get("nfsd_scale_down_threshold", "0.5"))
+
+        self.trace_file = config.get("trace_file")
+        self.trace_otlp_endpoint = config.get("trace_otlp_endpoint")
+        self.slow_process_threshold = float(config.get("slow_process_threshold", "10"))
+        self.slow_process_log = config.get("slow_process_log")
+
         self.allow_destructive_actions = config.get("allow_destructive_actions", "false").lower() == "true"
 
         if self.allow_destructive_actions:
@@ -0,0 +1,200 @@
+import fcntl
+import logging
+import os
+import re
+import threading
+
+import nfs
+
+logger = logging.getLogger(__name__)
+
+# the host's fstab, mounted into the container
+FSTAB_PATH = "/app/hostetc/fstab"
+MOUNTINFO_PATH = "/proc/self/mountinfo"
+
+# LabDisk only edits the lines between these markers. the rest of the file is left as is
+BLOCK_BEGIN = "# BEGIN LabDisk managed mounts. Do not edit by hand."
+BLOCK_END = "# END LabDisk managed mounts"
+
+# indexed view of the managed block as mount_point -> (block_device, fs_type, options). loaded from
+# the file once and kept up to date in memory. the file is rewritten from it after every change
+entries_lock = threading.Lock()
+entries = None
+# bumped on every change. a write covers every change made before it started so changes
+# that queue up behind a write in progress are all written by the next one
+generation = 0
+written_generation = 0
+write_lock = threading.Lock()
+
+def _unescape(value):
+    # fstab and mountinfo escape whitespace in paths as octal sequences (ex: \040)
+    return re.sub(r"\\([0-7]{3})", lambda m: chr(int(m.group(1), 8)), value)
+
+def _escape(value):
+    return re.sub(r"[\s\\]", lambda m: f"\\{ord(m.group(0)):03o}", value)
+
+def _is_volume_mount(mount_point):
+    return mount_point.startswith(f"{nfs.VOLUME_ROOT}/")
+
+def _parse_entry(line):
+    fields = line.split()
+    if len(fields) < 4 or fields[0].startswith("#"):
+        return None
+    return _unescape(fields[1]), (_unescape(fields[0]), fields[2], fields[3])
+
+def _format_entry(mount_point, entry):
+    block_device, fs_type, options = entry
+    return f"{_escape(block_device)} {_escape(mount_point)} {fs_type} {options} 0 0\n" # dump and fsck disabled
+
+def _split_file(lines):
+    """Split the lines of the fstab into the managed entries and everything else. Volume mounts outside of
+    the block were added by older versions of LabDisk and are moved into it."""
+    managed = {}
+    unmanaged = []
+    in_block = False
+    for line in lines:
+        stripped = line.strip()
+        if stripped == BLOCK_BEGIN:
+            in_block = True
+        elif stripped == BLOCK_END:
+            in_block = False
+        else:
+            parsed = _parse_entry(line)
+            if in_block or (parsed and _is_volume_mount(parsed[0])):
+                if parsed:
+                    managed[parsed[0]] = parsed[1]
+            else:
+                unmanaged.append(line if line.endswith("\n") else line + "\n")
+
+    return managed, unmanaged
+
+def _read_lines():
+    try:
+        with open(FSTAB_PATH, "r") as f:
+            return f.readlines()
+    except FileNotFoundError:
+        return []
+
+def load_entries():
+    """Load the index from the file. Called once on startup, before any mounts are changed"""
+    global entries
+
+    with entries_lock:
+        entries = _split_file(_read_lines())[0]
+        count = len(entries)
+
+    logger.debug(f"Loaded {count} managed mounts from {FSTAB_PATH}")
+
+def _ensure_entries():
+    """Load the index if it wasn't loaded yet. Must be called with entries_lock held so a load
+    can't replace entries that were added while the file was being read"""
+    global entries
+
+    if entries is None:
+        entries = _split_file(_read_lines())[0]
+
+def get_entries():
+    with entries_lock:
+        _ensure_entries()
+        return dict(entries)
+
+def _write_file():
+    """Rewrite the managed block with the current entries. The file is replaced atomically
+    and a lock file keeps other LabDisk processes on the host from writing at the same time."""
+    global written_generation
+
+    with write_lock:
+        with entries_lock:
+            if written_generation == generation:
+                return
+            target_generation = generation
+            block = [ _format_entry(mount_point, entry) for mount_point, entry in entries.items() ]
+
+        with open(f"{FSTAB_PATH}.lock", "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+
+            # the rest of the file could have been edited by someone else in the meantime
+            _, unmanaged = _split_file(_read_lines())
+            content = "".join(unmanaged) + f"{BLOCK_BEGIN}\n" + "".join(block) + f"{BLOCK_END}\n"
+
+            temp_path = f"{FSTAB_PATH}.labdisk"
+            with open(temp_path, "w") as f:
+                f.write(content)
+                f.flush()
+                os.fsync(f.fileno())
+
+            try:
+                os.chmod(temp_path, os.stat(FSTAB_PATH).st_mode & 0o7777)
+            except FileNotFoundError:
+                pass
+
+            os.replace(temp_path, FSTAB_PATH)
+
+            dir_fd = os.open(os.path.dirname(FSTAB_PATH) or ".", os.O_RDONLY)
+            try:
+                os.fsync(dir_fd)
+            finally:
+                os.close(dir_fd)
+
+        written_generation = target_generation
+
+def _update(mount_point, entry):
+    global generation
+
+    with entries_lock:
+        _ensure_entries()
+        if entries.get(mount_point) == entry:
+            return
+        if entry:
+            entries[mount_point] = entry
+        else:
+            entries.pop(mount_point, None)
+        generation += 1
+
+    _write_file()
+
+def add_entry(block_device, mount_point, fs_type, options):
+    """Persist a mount so it comes back after a reboot"""
+    _update(mount_point, (block_device, fs_type, options))
+
+def remove_entry(mount_point):
+    if mount_point in get_entries():
+        _update(mount_point, None)
+
+def read_mountinfo():
+    """The current mounts as mount_point -> (source, fs_type, options)"""
+    mounts = {}
+    with open(MOUNTINFO_PATH, "r") as f:
+        for line in f:
+            # id parent major:minor root mount_point options [optional fields...] - fs_type source super_options
+            fields = line.split()
+            separator = fields.index("-")
+            mounts[_unescape(fields[4])] = (_unescape(fields[separator + 2]), fields[separator + 1], fields[5])
+
+    return mounts
+
+def reconcile_entries(mounts=None):
+    """Compare the managed block against the mounts in a single pass. Volume mounts without an entry get
+    one so they survive a reboot. Returns the entries whose volume is not mounted as mount_point -> entry"""
+    global generation
+
+    if mounts is None:
+        mounts = read_mountinfo()
+
+    with entries_lock:
+        _ensure_entries()
+        added = 0
+        for mount_point, (source, fs_type, options) in mounts.items():
+            if _is_volume_mount(mount_point) and mount_point not in entries:
+                entries[mount_point] = (source, fs_type, options)
+                added += 1
+        if added:
+            generation += 1
+
+        missing = { mount_point: entry for mount_point, entry in entries.items() if mount_point not in mounts }
+
+    if added:
+        logger.info(f"Added {added} mounted volumes that were missing from {FSTAB_PATH}")
+        _write_file()
+
+    return missing
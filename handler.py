@@ -1,5 +1,7 @@
+import asyncio
 import logging
 import os
+import time
 from functools import lru_cache
 from copy import deepcopy
 
@@ -10,9 +12,15 @@ import kubernetes
 import config
 from config import Constants
 import util
+import fstab
 import nfs
+import nfsd
 import lvm
 import iscsi
+import warmpool
+import metrics
+import placement
+import tracing
 
 util.setup_kube_client()
 
@@ -25,6 +33,18 @@ config.setup()
 
 registered_storage_classes = []
 
+# limits how many volume operations run at once. created on startup
+operation_semaphore = None
+
+# background tasks that keep the thin pool usage, cache statistics, and raid status current, the warm pool filled, the nfsd thread count sized,
+# and the node capacity published
+thin_pool_monitor = None
+cache_monitor = None
+raid_monitor = None
+warm_pool_refill = None
+nfsd_autoscaler = None
+placement_loop = None
+
 @kopf.on.login()
 def api_login(**kwargs):
     return kopf.login_via_client(**kwargs)
@@ -54,17 +74,232 @@ def validate_and_register_storage_class(name, sc):
         logger.info(f"Ignoring storage class '{name}' because it does not apply to this node.")
         return
 
+    try:
+        get_volume_options(sc.parameters)
+        lvm.parse_cache_options(sc.parameters)
+        lvm.parse_layout_options(sc.parameters)
+    except ValueError as ex:
+        logger.error(f"Ignoring storage class '{name}' because of invalid volume options: {ex}")
+        return
+
     logger.info(f"Found valid LabDisk storage class {name}. Registering PVC Handlers.")
     registered_storage_classes.append(name)
 
+    if sc_type.lower() != Constants.VOLUME_TYPE_SHARED:
+        warmpool.register_storage_class(name, sc.parameters)
+
 @kopf.on.create("storageclass", field="provisioner", value=config.get().provisioner_name)
 def new_storageclass(name, **kwargs):
     storage_api = kubernetes.client.StorageV1Api()
     sc = storage_api.read_storage_class(name)
     validate_and_register_storage_class(name, sc)
 
+def get_volume_options(sc_params):
+    """The mkfs arguments, mount options, and NFS export options volumes of a storage class are set up with"""
+    mkfs_options = lvm.parse_mkfs_options(sc_params.get("mkfs_options"))
+    mount_options = lvm.validate_mount_options(sc_params.get("fs_mount_options"))
+    export_options = nfs.validate_export_options(sc_params.get("nfs_export_options"))
+    return mkfs_options, mount_options, export_options
+
+def list_assigned_volumes():
+    core_api = kubernetes.client.CoreV1Api()
+    volumes = core_api.list_persistent_volume(label_selector="component=lab-disk")
+
+    current_node_name = config.get().current_node_name
+    return [ pv for pv in volumes.items if (pv.metadata.annotations or {}).get(Constants.PV_ASSIGNED_NODE_ANNOTATION_KEY) == current_node_name ]
+
+def get_iscsi_auth_update(spec, auth_config):
+    """Returns an updated copy of the PV spec if its CHAP settings don't match the config"""
+    updated_spec = None
+    if auth_config and "secretRef" not in spec["iscsi"]:
+        # add auth config to spec
+        updated_spec = deepcopy(spec)
+        updated_spec["iscsi"]["chapAuthDiscovery"] = True
+        updated_spec["iscsi"]["chapAuthSession"] = True
+        updated_spec["iscsi"]["secretRef"] = { "name": auth_config.chap_credentials_secret }
+    elif not auth_config and "secretRef" in spec["iscsi"]:
+        # remove auth config from spec
+        updated_spec = deepcopy(spec)
+        del updated_spec["iscsi"]["chapAuthDiscovery"]
+        del updated_spec["iscsi"]["chapAuthSession"]
+        del updated_spec["iscsi"]["secretRef"]
+
+    return updated_spec
+
+async def patch_persistent_volume_spec(name, namespace, labels, annotations, spec):
+    body = kubernetes.client.V1PersistentVolume(
+        api_version='v1',
+        spec=spec,
+        metadata=kubernetes.client.V1ObjectMeta(
+            name=name, 
+            namespace=namespace,
+            labels=labels,
+            annotations=annotations
+        ),
+        kind="PersistentVolume"
+    )
+
+    core_api = kubernetes.client.CoreV1Api()
+    await asyncio.to_thread(core_api.patch_persistent_volume, name, body)
+
+@tracing.traced("export_iscsi_volume")
+async def export_iscsi_volume(lvm_group, pv_name, auth_config, lun_idx):
+    try:
+        await util.wait_for_device(f"/dev/{lvm_group}/{pv_name}", config.get().device_timeout)
+    except TimeoutError as ex:
+        raise kopf.TemporaryError(str(ex))
+
+    await asyncio.to_thread(iscsi.export_disk, lvm_group, pv_name, auth_config, desired_lun_idx=lun_idx)
+
+async def gather_bounded(coroutines, semaphore):
+    """Run coroutines concurrently while holding the semaphore. Exceptions are returned, not raised"""
+    async def run(coroutine):
+        async with semaphore:
+            return await coroutine
+
+    return await asyncio.gather(*[ run(coroutine) for coroutine in coroutines ], return_exceptions=True)
+
+# volumes that were re-exported in bulk on startup. the resume handler skips these
+resumed_volumes = set()
+
+async def resume_iscsi_volumes(lvm_group, volumes, auth_config, semaphore):
+    serialize = kubernetes.client.ApiClient().sanitize_for_serialization
+
+    # send all of the CHAP setting patches as one batch before exporting anything
+    patches = []
+    for pv in volumes:
+        updated_spec = get_iscsi_auth_update(serialize(pv.spec), auth_config)
+        if updated_spec:
+            patches.append(patch_persistent_volume_spec(pv.metadata.name, pv.metadata.namespace, pv.metadata.labels, pv.metadata.annotations, updated_spec))
+
+    for result in await gather_bounded(patches, semaphore):
+        if isinstance(result, Exception):
+            logger.warning("Failed to update the CHAP settings of a volume", exc_info=result)
+
+    results = await gather_bounded([ export_iscsi_volume(lvm_group, pv.metadata.name, auth_config, pv.spec.iscsi.lun) for pv in volumes ], semaphore)
+    for pv, result in zip(volumes, results):
+        if isinstance(result, Exception):
+            # the resume handler will retry it
+            logger.warning(f"Failed to re-export iSCSI volume '{pv.metadata.name}'", exc_info=result)
+        else:
+            resumed_volumes.add(pv.metadata.name)
+
+    logger.info(f"Re-exported {len(volumes)} iSCSI volumes from {lvm_group}")
+
+async def mount_nfs_volume(pv_name, lvm_group, mount_options, mounts, mounted_devices):
+    """Make sure the volume of an NFS pv is mounted where it is exported from. Returns True if it had to be mounted again"""
+    mount_point = f"{nfs.VOLUME_ROOT}/{pv_name}"
+    if lvm.is_mounted(lvm_group, pv_name, mount_point, mounted_devices):
+        return False
+
+    # don't hide whatever is mounted there now
+    if mount_point in mounts:
+        raise RuntimeError(f"{mounts[mount_point][0]} is mounted at {mount_point} instead of {lvm_group}/{pv_name}")
+
+    await lvm.remount_volume(lvm_group, pv_name, mount_point, mount_options)
+    return True
+
+async def resume_nfs_volumes(volumes, semaphore):
+    """Mount the NFS volumes that lost their mount, from a single read of the mount table. Returns the volumes that are mounted"""
+    mounts = await asyncio.to_thread(fstab.read_mountinfo)
+    mounted_devices = await asyncio.to_thread(lvm.get_mounted_devices, mounts)
+
+    # volumes that are mounted but not in fstab get an entry so they are mounted again after a reboot
+    try:
+        missing_entries = await asyncio.to_thread(fstab.reconcile_entries, mounts)
+    except Exception as ex:
+        logger.warning("Failed to reconcile fstab with the current mounts", exc_info=ex)
+        missing_entries = {}
+
+    coroutines = []
+    for pv in volumes:
+        sc_params = await asyncio.to_thread(get_storage_class_params, pv.spec.storage_class_name)
+        lvm_group = sc_params.get("lvm_group", config.get().lvm_group)
+        coroutines.append(mount_nfs_volume(pv.metadata.name, lvm_group, get_volume_options(sc_params)[1], mounts, mounted_devices))
+
+    mounted = []
+    failed = []
+    remounted = 0
+    for pv, result in zip(volumes, await gather_bounded(coroutines, semaphore)):
+        if isinstance(result, Exception):
+            # exporting the empty mount point would look like a volume that lost its data
+            logger.error(f"Failed to mount NFS volume '{pv.metadata.name}'. It will not be exported.", exc_info=result)
+            await asyncio.to_thread(lvm.post_volume_event, pv.metadata.name, "Warning", "VolumeNotMounted", f"Failed to mount the volume, so it is not exported: {result}", pv.metadata.uid)
+            failed.append(pv.metadata.name)
+        else:
+            mounted.append(pv)
+            remounted += result
+
+    if remounted:
+        logger.info(f"Mounted {remounted} NFS volumes that were not mounted")
+    if failed:
+        logger.error(f"Could not recover the mounts of {len(failed)} NFS volumes: {', '.join(failed)}")
+
+    assigned = { f"{nfs.VOLUME_ROOT}/{pv.metadata.name}" for pv in volumes }
+    stale_entries = [ mount_point for mount_point in missing_entries if mount_point not in assigned ]
+    if stale_entries:
+        logger.warning(f"{len(stale_entries)} volumes in fstab are not mounted and don't belong to a volume on this node: {', '.join(stale_entries)}")
+
+    return mounted
+
+async def resume_volumes():
+    """Re-export every volume on this node before the operator starts reporting ready"""
+    start_time = time.monotonic()
+    volumes = await asyncio.to_thread(list_assigned_volumes)
+
+    # group the volumes by type and volume group
+    groups = {}
+    for pv in volumes:
+        storage_class = pv.spec.storage_class_name
+        if storage_class not in registered_storage_classes:
+            continue
+
+        sc_params = await asyncio.to_thread(get_storage_class_params, storage_class)
+        lvm_group = sc_params.get("lvm_group", config.get().lvm_group)
+        groups.setdefault((sc_params["type"], lvm_group), []).append(pv)
+
+    # every volume is resumed in parallel on one bounded pool
+    semaphore = asyncio.Semaphore(config.get().max_concurrent_operations)
+
+    # every NFS volume has to be mounted before anything is exported
+    nfs_volumes = [ pv for (volume_type, _), pvs in groups.items() if volume_type == Constants.VOLUME_TYPE_NFS for pv in pvs ]
+    nfs_volumes = await resume_nfs_volumes(nfs_volumes, semaphore)
+
+    # NFS exports are applied in one exportfs pass per set of export options
+    mounts = { f"{nfs.VOLUME_ROOT}/{pv.metadata.name}": get_volume_options(await asyncio.to_thread(get_storage_class_params, pv.spec.storage_class_name))[2] for pv in nfs_volumes }
+    added, removed, missing = await nfs.reconcile_exports(mounts, config.get().nfs_access_cidr)
+    # the resume handler retries the ones that failed to export
+    resumed_volumes.update(pv.metadata.name for pv in nfs_volumes if f"{nfs.VOLUME_ROOT}/{pv.metadata.name}" not in missing)
+    logger.info(f"Reconciled {len(mounts)} NFS exports ({added} added, {removed} removed, {len(missing)} failed)")
+
+    # get chap auth if it is enabled
+    auth_config = None
+    if config.get().iscsi_chap_auth_enabled:
+        auth_config = config.get_auth()
+
+    await asyncio.gather(*[ resume_iscsi_volumes(lvm_group, pvs, auth_config, semaphore)
+        for (volume_type, lvm_group), pvs in groups.items() if volume_type == Constants.VOLUME_TYPE_ISCSI ])
+
+    logger.info(f"Resumed {len(resumed_volumes)} volumes in {time.monotonic() - start_time:.2f}s")
+
 @kopf.on.startup()
 async def operator_startup(settings: kopf.OperatorSettings, **kwargs):
+    global operation_semaphore, thin_pool_monitor, cache_monitor, raid_monitor, warm_pool_refill, nfsd_autoscaler, placement_loop
+    start_time = time.monotonic()
+
+    operation_semaphore = asyncio.Semaphore(config.get().max_concurrent_operations)
+    util.setup_process_limits(config.get().max_concurrent_processes, config.get().process_timeout)
+
+    if config.get().metrics_port:
+        metrics.start_metrics_server(config.get().metrics_port)
+
+    tracing.setup(
+        trace_file=config.get().trace_file,
+        otlp_endpoint=config.get().trace_otlp_endpoint,
+        node_name=config.get().current_node_name,
+        slow_threshold=config.get().slow_process_threshold,
+        slow_log=config.get().slow_process_log
+    )
 
     # overwrite default persistence settings
     settings.persistence.finalizer = f"{Constants.PVC_FINALIZER_KEY}-{config.get().current_node_name}"
@@ -84,21 +319,74 @@ async def operator_startup(settings: kopf.OperatorSettings, **kwargs):
     if config.get().shared_volumes_enabled:
         logger.info("Starting shared NFS export...")
         # make sure the main nfs share that backs shared volumes is exported
-        nfs.export_share(config.get().shared_nfs_root, config.get().nfs_access_cidr)
+        await nfs.export_share(config.get().shared_nfs_root, config.get().nfs_access_cidr)
     else:
         logger.info("Shared volume subsystem will be disabled.")
     
     if config.get().individual_volumes_enabled:
         logger.info("Starting individual volumes subsystem...")
+        lvm.refresh_inventory()
+        # load the fstab index before anything can add a mount, even if the mount table can't be read later
+        fstab.load_entries()
+        if config.get().thin_pool_monitor_interval:
+            thin_pool_monitor = asyncio.create_task(lvm.monitor_thin_pools(config.get().thin_pool_monitor_interval))
+        if config.get().cache_monitor_interval:
+            cache_monitor = asyncio.create_task(lvm.monitor_caches(config.get().cache_monitor_interval))
+        if config.get().raid_monitor_interval:
+            raid_monitor = asyncio.create_task(lvm.monitor_raid(config.get().raid_monitor_interval))
+        warm_pool_refill = warmpool.start_refill(config.get().warm_pool_refill_interval)
+
         auth_config = None
         if config.get().iscsi_chap_auth_enabled:
             auth_config = config.get_auth()
         iscsi.init_iscsi(config.get().current_node_name, config.get().iscsi_portal_addr, auth_config)
+
+        logger.info("Resuming existing volumes...")
+        await resume_volumes()
     else:
         logger.info("Individual volume subsystem will be disabled.")
 
+    if config.get().nfsd_autoscale_interval and (config.get().shared_volumes_enabled or config.get().individual_volumes_enabled):
+        logger.info(f"Autoscaling nfsd threads between {config.get().nfsd_min_threads} and {config.get().nfsd_max_threads}")
+        nfsd_autoscaler = asyncio.create_task(nfsd.autoscale_threads(config.get().nfsd_autoscale_interval))
+
+    if config.get().automatic_placement and (config.get().shared_volumes_enabled or config.get().individual_volumes_enabled):
+        logger.info("Publishing node capacity for automatic volume placement")
+        placement_loop = asyncio.create_task(run_placement(config.get().capacity_publish_interval))
+
+    logger.info(f"LabDisk startup completed in {time.monotonic() - start_time:.2f}s")
+
+@kopf.on.cleanup()
+def operator_cleanup(**kwargs):
+    if config.get().individual_volumes_enabled and iscsi.root:
+        logger.info("Saving iSCSI target config...")
+        iscsi.flush_iscsi_config()
+
+@kopf.on.event("nodes")
+def node_event(event, name, **kwargs):
+    if event["type"] == "DELETED":
+        placement.forget_node(name)
+    else:
+        placement.update_node(name, event["object"]["metadata"].get("annotations"))
+
+    if not config.get().individual_volumes_enabled:
+        return
+
+    auth_config = None
+    if config.get().iscsi_chap_auth_enabled:
+        auth_config = config.get_auth()
+
+    if event["type"] == "DELETED":
+        logger.info(f"Removing iSCSI exports for deleted node '{name}'")
+        iscsi.remove_cluster_node(name)
+    elif event["type"] in (None, "ADDED") or name not in iscsi.get_cluster_nodes():
+        # new nodes (and every node on the initial listing) get all existing LUNs mapped
+        logger.debug(f"Mapping iSCSI exports for node '{name}'")
+        iscsi.add_cluster_node(name, auth_config)
+
 @kopf.on.resume("persistentvolume", annotations={Constants.PV_ASSIGNED_NODE_ANNOTATION_KEY: config.get().current_node_name})
-def register_existing_volumes(spec: Spec, meta: Meta, **kwargs):
+@metrics.timed("register_existing_volumes")
+async def register_existing_volumes(spec: Spec, meta: Meta, **kwargs):
     storage_class = spec["storageClassName"]
     pv_name = meta.name
 
@@ -107,14 +395,27 @@ def register_existing_volumes(spec: Spec, meta: Meta, **kwargs):
         logger.debug(f"Not registering volume {pv_name} because it is not a lab-disk volume")
         return
 
-    sc_params = get_storage_class_params(storage_class)
+    if pv_name in resumed_volumes:
+        logger.debug(f"Volume {pv_name} was already registered on startup")
+        return
+
+    sc_params = await asyncio.to_thread(get_storage_class_params, storage_class)
     volume_type = sc_params["type"]
 
     if volume_type == Constants.VOLUME_TYPE_NFS:
         # re-mount individual NFS exports
-        mount_point = f"/srv/nfs/{pv_name}"
+        mount_point = f"{nfs.VOLUME_ROOT}/{pv_name}"
+        _, mount_options, export_options = get_volume_options(sc_params)
+        lvm_group = sc_params.get("lvm_group", config.get().lvm_group)
+
+        mounts = await asyncio.to_thread(fstab.read_mountinfo)
+        try:
+            await mount_nfs_volume(pv_name, lvm_group, mount_options, mounts, await asyncio.to_thread(lvm.get_mounted_devices, mounts))
+        except Exception as ex:
+            raise kopf.TemporaryError(f"Failed to mount the volume of {pv_name}: {ex}", delay=60)
+
         logger.debug(f"Exporting NFS share for {mount_point}")
-        nfs.export_share(mount_point, config.get().nfs_access_cidr)
+        await nfs.export_share(mount_point, config.get().nfs_access_cidr, export_options)
     elif volume_type == Constants.VOLUME_TYPE_ISCSI:
         # re-export iscsi targets
         lvm_group = sc_params.get("lvm_group", config.get().lvm_group)
@@ -126,37 +427,13 @@ def register_existing_volumes(spec: Spec, meta: Meta, **kwargs):
         if config.get().iscsi_chap_auth_enabled:
             auth_config = config.get_auth()
 
-        updated_spec= None
-        if auth_config and "secretRef" not in spec["iscsi"]:
-            # add auth config to spec
-            updated_spec = deepcopy(spec)
-            updated_spec["iscsi"]["chapAuthDiscovery"] = True
-            updated_spec["iscsi"]["chapAuthSession"] = True
-            updated_spec["iscsi"]["secretRef"] = { "name": auth_config.chap_credentials_secret }
-        elif not auth_config and "secretRef" in spec["iscsi"]:
-            # remove auth config from spec
-            updated_spec = deepcopy(spec)
-            del updated_spec["iscsi"]["chapAuthDiscovery"]
-            del updated_spec["iscsi"]["chapAuthSession"]
-            del updated_spec["iscsi"]["secretRef"]
-        
+        updated_spec = get_iscsi_auth_update(spec, auth_config)
         if updated_spec:
-            body = kubernetes.client.V1PersistentVolume(
-                api_version='v1',
-                spec=updated_spec,
-                metadata=kubernetes.client.V1ObjectMeta(
-                    name=meta.name, 
-                    namespace=meta.namespace,
-                    labels=meta.labels,
-                    annotations=meta.annotations
-                ),
-                kind="PersistentVolume"
-            )
-
-            core_api = kubernetes.client.CoreV1Api()
-            core_api.patch_persistent_volume(meta.name, body)
+            await patch_persistent_volume_spec(meta.name, meta.namespace, meta.labels, meta.annotations, updated_spec)
         
-        iscsi.export_disk(lvm_group, pv_name, auth_config, desired_lun_idx=lun_idx)
+        pvc_uid = spec.get("claimRef", {}).get("uid", meta.uid)
+        with tracing.trace("register_existing_volumes", pvc_uid, pv=pv_name):
+            await export_iscsi_volume(lvm_group, pv_name, auth_config, lun_idx)
 
     logger.info(f"Successfully registered existing pv '{pv_name}'")
 
@@ -189,13 +466,90 @@ def validate_pvc_spec(spec: Spec, meta: Meta, update=False):
         raise kopf.PermanentError(f"LabDisk only supports ReadWriteMany/ReadOnlyMany volumes using the '{Constants.VOLUME_TYPE_SHARED}' disk type")
     
     if Constants.PVC_NODE_SELECTOR_ANNOTATION_KEY not in meta.annotations:
-        raise kopf.PermanentError(f"No node was selected to store the volume. (PVC missing annotation '{Constants.PVC_NODE_SELECTOR_ANNOTATION_KEY}'")
+        if config.get().automatic_placement:
+            raise kopf.PermanentError(f"No node was selected to store the volume. (PVC missing annotation '{Constants.PVC_NODE_SELECTOR_ANNOTATION_KEY}' and it was not placed automatically yet)")
+        raise kopf.PermanentError(f"No node was selected to store the volume. (PVC missing annotation '{Constants.PVC_NODE_SELECTOR_ANNOTATION_KEY}' and automatic placement is disabled)")
     
     return storage_class_params
 
+def get_requested_bytes(pvc):
+    try:
+        return lvm.size_to_bytes(lvm.format_volume_size(pvc.spec.resources.requests["storage"]))
+    except (KeyError, TypeError, ValueError):
+        return 0
+
+async def place_claim(uid):
+    """Pick a node for a claim without the disk-node annotation. Every instance picks the same node,
+    and only the instance on that node assigns the claim to itself."""
+    if uid not in placement.unplaced_claims:
+        return
+
+    namespace, name = placement.unplaced_claims[uid]
+    core_api = kubernetes.client.CoreV1Api()
+    try:
+        pvc = await asyncio.to_thread(core_api.read_namespaced_persistent_volume_claim, name, namespace)
+    except kubernetes.client.ApiException as ex:
+        if ex.status != 404:
+            raise
+        placement.unplaced_claims.pop(uid, None)
+        return
+
+    annotations = pvc.metadata.annotations or {}
+    if pvc.metadata.uid != uid or Constants.PVC_NODE_SELECTOR_ANNOTATION_KEY in annotations or pvc.spec.volume_name or pvc.metadata.deletion_timestamp:
+        placement.unplaced_claims.pop(uid, None)
+        return
+
+    sc_params = await asyncio.to_thread(get_storage_class_params, pvc.spec.storage_class_name)
+    node_name = placement.choose_node(uid, sc_params, get_requested_bytes(pvc))
+    if node_name is None:
+        logger.warning(f"No node can currently store the volume for PVC {namespace}/{name}")
+        return
+
+    # stays in the list until it is placed in case that node stops publishing before it claims it
+    if node_name != config.get().current_node_name:
+        return
+
+    if await asyncio.to_thread(placement.claim_for_node, name, namespace, pvc.metadata.resource_version, node_name):
+        logger.info(f"Placed PVC {namespace}/{name} on this node")
+    placement.unplaced_claims.pop(uid, None)
+
+async def run_placement(interval):
+    """Publish the capacity of this node and retry the claims that could not be placed yet"""
+    while True:
+        try:
+            await asyncio.to_thread(placement.publish_capacity)
+        except Exception as ex:
+            logger.warning("Failed to publish the capacity of this node", exc_info=ex)
+
+        for uid in list(placement.unplaced_claims):
+            try:
+                await place_claim(uid)
+            except Exception as ex:
+                logger.warning(f"Failed to place claim {uid}", exc_info=ex)
+
+        await asyncio.sleep(interval)
+
+@kopf.on.event("persistentvolumeclaim", annotations={Constants.PVC_NODE_SELECTOR_ANNOTATION_KEY: kopf.ABSENT})
+async def place_volume_claim(event, spec, meta, **kwargs):
+    if not config.get().automatic_placement:
+        return
+
+    if event["type"] == "DELETED" or spec.get("volumeName") or spec.get("storageClassName") not in registered_storage_classes:
+        placement.unplaced_claims.pop(meta.uid, None)
+        return
+
+    placement.unplaced_claims[meta.uid] = (meta.namespace, meta.name)
+    await place_claim(meta.uid)
+
 @kopf.on.create("persistentvolumeclaim", annotations={Constants.PVC_NODE_SELECTOR_ANNOTATION_KEY: config.get().current_node_name})
-def create_volume(meta: Meta, spec: Spec, **kwargs):
-    sc_params = validate_pvc_spec(spec, meta)
+@metrics.timed("create_volume")
+async def create_volume(meta: Meta, spec: Spec, **kwargs):
+    with tracing.trace("create_volume", meta.uid, pvc=f"{meta.namespace}/{meta.name}"):
+        async with operation_semaphore:
+            await provision_volume(meta, spec)
+
+async def provision_volume(meta: Meta, spec: Spec):
+    sc_params = await asyncio.to_thread(validate_pvc_spec, spec, meta)
     if not sc_params:
         return
 
@@ -210,8 +564,8 @@ def create_volume(meta: Meta, spec: Spec, **kwargs):
     volume_type = sc_params["type"]
     pv_name = f"pvc-{meta.uid}"
     fs_type = meta.annotations.get(Constants.FILESYSTEM_ANNOTATION_KEY, "xfs")
-    mirror_disk = Constants.MIRROR_ANNOTATION_KEY in meta.annotations
     imported_pv_name = meta.annotations.get(Constants.IMPORTED_LVM_NAME_ANNOTATION_KEY)
+    data_source = spec.get("dataSourceRef") or spec.get("dataSource")
 
     if not desired_volume_size:
         raise kopf.PermanentError("No volume size provided")
@@ -232,55 +586,187 @@ def create_volume(meta: Meta, spec: Spec, **kwargs):
         os.makedirs(volume_directory, exist_ok=True)
 
         # create the pv object using the main nfs share and the subpath for this volume
-        nfs.create_persistent_volume(pv_name, current_node_name, access_modes, desired_volume_size, config.get().current_node_ip, volume_directory, spec["storageClassName"], spec["volumeMode"])
+        await asyncio.to_thread(nfs.create_persistent_volume, pv_name, current_node_name, access_modes, desired_volume_size, config.get().current_node_ip, volume_directory, spec["storageClassName"], spec["volumeMode"])
     else:
         if not config.get().individual_volumes_enabled:
             raise kopf.PermanentError("This instance of LabDisk does not have individual volumes configured")      
 
+        try:
+            layout = lvm.parse_layout_options(sc_params, meta.annotations)
+            cache = lvm.parse_cache_options(sc_params)
+        except ValueError as ex:
+            raise kopf.PermanentError(f"Invalid volume options: {ex}")
+        mirror_disk = layout is not None and layout["raid"] is not None
+
+        if data_source and layout:
+            raise kopf.PermanentError("Cloned volumes can't be mirrored or striped")
+
         lvm_group = sc_params.get("lvm_group", config.get().lvm_group)
+        thin_pool = sc_params.get("thin_pool")
+        mkfs_options, mount_options, export_options = get_volume_options(sc_params)
 
         if volume_type == Constants.VOLUME_TYPE_ISCSI:
             if config.get().import_mode:
                 # import lvm volume
-                pv_name = lvm.import_volume(lvm_group, imported_pv_name)
+                pv_name = await lvm.import_volume(lvm_group, imported_pv_name)
+            elif data_source:
+                # copy the source volume or snapshot
+                fs_type = await clone_from_data_source(meta, data_source, lvm_group, pv_name, desired_volume_size)
             else:
                 # provision lvm volume
-                lvm.create_volume(lvm_group, pv_name, fs_type, mirror_disk, desired_volume_size)
+                await provision_lvm_volume(lvm_group, pv_name, fs_type, mirror_disk, desired_volume_size, thin_pool=thin_pool, mkfs_options=mkfs_options, cache=cache, layout=layout)
 
             # get chap auth if it is enabled
             auth_config = None
             if config.get().iscsi_chap_auth_enabled:
                 auth_config = config.get_auth()
 
+            try:
+                with tracing.span("wait_for_device"):
+                    await util.wait_for_device(f"/dev/{lvm_group}/{pv_name}", config.get().device_timeout)
+            except TimeoutError as ex:
+                raise kopf.TemporaryError(str(ex))
+
             # setup iscsi exports using rtstlib-fb
-            iscsi_lun = iscsi.export_disk(lvm_group, pv_name, auth_config)
+            iscsi_lun = await asyncio.to_thread(iscsi.export_disk, lvm_group, pv_name, auth_config)
 
             # create the pv object using the iscsi share info
             iscsi_portal = f"{config.get().current_node_ip}:{config.get().iscsi_portal_port}"
-            iscsi_target = f"iqn.2003-01.org.linux-iscsi.ragdollphysics:{config.get().current_node_name}"
-            iscsi.create_persistent_volume(pv_name, current_node_name, access_modes, desired_volume_size, iscsi_portal, iscsi_target, iscsi_lun, fs_type, spec["storageClassName"], spec["volumeMode"], auth_config)
+            iscsi_target = iscsi.node_iqn(config.get().current_node_name)
+            await asyncio.to_thread(iscsi.create_persistent_volume, pv_name, current_node_name, access_modes, desired_volume_size, iscsi_portal, iscsi_target, iscsi_lun, fs_type, spec["storageClassName"], spec["volumeMode"], auth_config)
 
         if volume_type == Constants.VOLUME_TYPE_NFS:
-            mount_point = f"/srv/nfs/{pv_name}"
+            mount_point = f"{nfs.VOLUME_ROOT}/{pv_name}"
 
             if config.get().import_mode:
                 # import lvm volume then mount it for NFS exporting
-                pv_name = lvm.import_volume(lvm_group, imported_pv_name, mount_point)
+                pv_name = await lvm.import_volume(lvm_group, imported_pv_name, mount_point, mount_options)
+            elif data_source:
+                # copy the source volume or snapshot then mount it for NFS exporting
+                await clone_from_data_source(meta, data_source, lvm_group, pv_name, desired_volume_size, mount_point, mount_options)
             else:
                 # provision lvm volume then locally mount it where NFS can access it and the set up a NFS share
-                lvm.create_volume(lvm_group, pv_name, fs_type, mirror_disk, desired_volume_size, mount_point)
+                await provision_lvm_volume(lvm_group, pv_name, fs_type, mirror_disk, desired_volume_size, mount_point, thin_pool, mkfs_options, mount_options, cache, layout)
 
             # export the share
-            nfs.export_share(mount_point, config.get().nfs_access_cidr)
+            await nfs.export_share(mount_point, config.get().nfs_access_cidr, export_options)
 
             # create the pv object using the share we just exported
-            nfs.create_persistent_volume(pv_name, current_node_name, access_modes, desired_volume_size, config.get().current_node_ip, mount_point, spec["storageClassName"], spec["volumeMode"])
+            await asyncio.to_thread(nfs.create_persistent_volume, pv_name, current_node_name, access_modes, desired_volume_size, config.get().current_node_ip, mount_point, spec["storageClassName"], spec["volumeMode"])
 
     logger.info(f"Successfully provisioned volume for claim {meta.name}")
 
+async def provision_lvm_volume(lvm_group, pv_name, fs_type, mirror_disk, volume_size, mount_point=None, thin_pool=None, mkfs_options=(), mount_options=None, cache=None, layout=None):
+    """Serve the volume from the warm pool if there is a matching spare, otherwise create it"""
+    if not cache and not layout and not await asyncio.to_thread(lvm.volume_exists, lvm_group, pv_name):
+        if await warmpool.take_spare(lvm_group, thin_pool, pv_name, fs_type, volume_size, mount_point, mkfs_options, mount_options):
+            return
+
+    await lvm.create_volume(lvm_group, pv_name, fs_type, mirror_disk, volume_size, mount_point, thin_pool, mkfs_options, mount_options, cache, layout)
+
+def resolve_data_source(meta: Meta, data_source, lvm_group):
+    """Find the LVM volume on this node that backs the PVC or VolumeSnapshot a claim is cloned from"""
+    kind = data_source.get("kind")
+    name = data_source["name"]
+    namespace = data_source.get("namespace", meta.namespace)
+    current_node_name = config.get().current_node_name
+
+    if kind == "PersistentVolumeClaim":
+        core_api = kubernetes.client.CoreV1Api()
+        pvc = core_api.read_namespaced_persistent_volume_claim(name, namespace)
+
+        if (pvc.metadata.annotations or {}).get(Constants.PVC_NODE_SELECTOR_ANNOTATION_KEY) != current_node_name:
+            raise kopf.PermanentError(f"Cannot clone claim '{name}' because it is not stored on this node")
+
+        if pvc.spec.storage_class_name not in registered_storage_classes or get_storage_class_params(pvc.spec.storage_class_name)["type"] == Constants.VOLUME_TYPE_SHARED:
+            raise kopf.PermanentError(f"Cannot clone claim '{name}'. Only LabDisk '{Constants.VOLUME_TYPE_NFS}' and '{Constants.VOLUME_TYPE_ISCSI}' volumes can be cloned")
+
+        if not pvc.spec.volume_name:
+            raise kopf.TemporaryError(f"The claim '{name}' to clone has not been provisioned yet")
+
+        source_group = get_storage_class_params(pvc.spec.storage_class_name).get("lvm_group", config.get().lvm_group)
+        source_volume = pvc.spec.volume_name
+
+    elif kind == "VolumeSnapshot":
+        custom_api = kubernetes.client.CustomObjectsApi()
+        snapshot = custom_api.get_namespaced_custom_object(Constants.SNAPSHOT_API_GROUP, "v1", namespace, "volumesnapshots", name)
+        annotations = snapshot["metadata"].get("annotations") or {}
+
+        if annotations.get(Constants.PV_ASSIGNED_NODE_ANNOTATION_KEY) != current_node_name:
+            raise kopf.PermanentError(f"Cannot restore snapshot '{name}' because it is not a LabDisk snapshot on this node")
+
+        if not snapshot.get("status", {}).get("readyToUse"):
+            raise kopf.TemporaryError(f"The snapshot '{name}' is not ready yet")
+
+        source_group, source_volume = annotations[Constants.SNAPSHOT_VOLUME_ANNOTATION_KEY].split("/")
+
+    else:
+        raise kopf.PermanentError(f"Unsupported data source kind '{kind}'")
+
+    # snapshots can't cross volume groups
+    if source_group != lvm_group:
+        raise kopf.PermanentError(f"Cannot clone '{name}' from volume group '{source_group}' into '{lvm_group}'")
+
+    return source_volume
+
+async def clone_from_data_source(meta: Meta, data_source, lvm_group, pv_name, volume_size, mount_point=None, mount_options=None):
+    """Provision a volume from the claim's dataSource and return its filesystem type"""
+    source_volume = await asyncio.to_thread(resolve_data_source, meta, data_source, lvm_group)
+    logger.info(f"Cloning {lvm_group}/{source_volume} for claim {meta.name}")
+    return await lvm.clone_volume(lvm_group, source_volume, pv_name, volume_size, mount_point, mount_options)
+
+@kopf.on.create(Constants.SNAPSHOT_API_GROUP, "v1", "volumesnapshots")
+@metrics.timed("create_snapshot")
+async def create_snapshot(spec: Spec, meta: Meta, namespace, patch: kopf.Patch, **kwargs):
+    pvc_name = spec.get("source", {}).get("persistentVolumeClaimName")
+    if not pvc_name:
+        return # pre-provisioned snapshots are not ours
+
+    core_api = kubernetes.client.CoreV1Api()
+    pvc = await asyncio.to_thread(core_api.read_namespaced_persistent_volume_claim, pvc_name, namespace)
+
+    # only snapshot volumes that we manage on this node
+    if (pvc.metadata.annotations or {}).get(Constants.PVC_NODE_SELECTOR_ANNOTATION_KEY) != config.get().current_node_name:
+        return
+
+    if pvc.spec.storage_class_name not in registered_storage_classes:
+        return
+
+    sc_params = await asyncio.to_thread(get_storage_class_params, pvc.spec.storage_class_name)
+    if sc_params["type"] == Constants.VOLUME_TYPE_SHARED:
+        raise kopf.PermanentError(f"Cannot snapshot '{pvc_name}'. '{Constants.VOLUME_TYPE_SHARED}' volumes are not backed by their own LVM volume")
+
+    if not pvc.spec.volume_name:
+        raise kopf.TemporaryError(f"The claim '{pvc_name}' has not been provisioned yet")
+
+    lvm_group = sc_params.get("lvm_group", config.get().lvm_group)
+    snapshot_name = f"snapshot-{meta.uid}"
+
+    with tracing.trace("create_snapshot", meta.uid, snapshot=f"{namespace}/{meta.name}"):
+        async with operation_semaphore:
+            await lvm.snapshot_volume(lvm_group, pvc.spec.volume_name, snapshot_name)
+
+    patch.metadata.annotations[Constants.PV_ASSIGNED_NODE_ANNOTATION_KEY] = config.get().current_node_name
+    patch.metadata.annotations[Constants.SNAPSHOT_VOLUME_ANNOTATION_KEY] = f"{lvm_group}/{snapshot_name}"
+    patch.status["readyToUse"] = True
+    patch.status["creationTime"] = time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())
+    patch.status["restoreSize"] = (pvc.status.capacity or {}).get("storage")
+
+    logger.info(f"Successfully created snapshot {meta.name} of claim {pvc_name}")
+
+@kopf.on.delete(Constants.SNAPSHOT_API_GROUP, "v1", "volumesnapshots", annotations={Constants.PV_ASSIGNED_NODE_ANNOTATION_KEY: config.get().current_node_name})
+@metrics.timed("delete_snapshot")
+async def delete_snapshot(meta: Meta, **kwargs):
+    lvm_group, snapshot_name = meta.annotations[Constants.SNAPSHOT_VOLUME_ANNOTATION_KEY].split("/")
+
+    with tracing.trace("delete_snapshot", meta.uid, snapshot=f"{meta.namespace}/{meta.name}"):
+        async with operation_semaphore:
+            await lvm.delete_volume(lvm_group, snapshot_name)
+
 @kopf.on.update("persistentvolumeclaim", annotations={Constants.PVC_NODE_SELECTOR_ANNOTATION_KEY: config.get().current_node_name})
-def update_volume_claim(spec: Spec, meta: Meta, old: BodyEssence, new: BodyEssence, **kwargs):
-    sc_params = validate_pvc_spec(spec, meta, update=True)
+@metrics.timed("update_volume_claim")
+async def update_volume_claim(spec: Spec, meta: Meta, old: BodyEssence, new: BodyEssence, **kwargs):
+    sc_params = await asyncio.to_thread(validate_pvc_spec, spec, meta, update=True)
     if not sc_params:
         return
 
@@ -294,11 +780,19 @@ def update_volume_claim(spec: Spec, meta: Meta, old: BodyEssence, new: BodyEssen
         if not sc_params["allow_volume_expansion"]:
             raise kopf.PermanentError(f"Cannot resize Volume. The storageclass {spec['storageClassName']} does not allow it.")
         
-        lvm.resize_volume(lvm_group, pv_name, old_volume_size, new_volume_size)
+        try:
+            cache = lvm.parse_cache_options(sc_params)
+            layout = lvm.parse_layout_options(sc_params, meta.annotations)
+        except ValueError as ex:
+            raise kopf.PermanentError(f"Invalid volume options: {ex}")
+
+        with tracing.trace("update_volume_claim", meta.uid, pvc=f"{meta.namespace}/{meta.name}"):
+            async with operation_semaphore:
+                await lvm.resize_volume(lvm_group, pv_name, old_volume_size, new_volume_size, cache, layout)
 
 
 @kopf.on.delete("persistentvolumeclaim", annotations={Constants.PVC_NODE_SELECTOR_ANNOTATION_KEY: config.get().current_node_name})
-def delete_volume_claim(spec: Spec, meta: Meta, **kwargs):
+async def delete_volume_claim(spec: Spec, meta: Meta, **kwargs):
     storage_class = spec["storageClassName"]
     pvc_name = meta.name
 
@@ -307,7 +801,7 @@ def delete_volume_claim(spec: Spec, meta: Meta, **kwargs):
         logger.debug(f"Not deleting volume {pvc_name} because it is not a lab-disk volume")
         return
     
-    sc_params = get_storage_class_params(spec["storageClassName"])
+    sc_params = await asyncio.to_thread(get_storage_class_params, spec["storageClassName"])
     
     if "volumeName" not in spec:
         logger.info(f"Deleting a PVC that never provisioned '{meta.name}")
@@ -322,13 +816,20 @@ def delete_volume_claim(spec: Spec, meta: Meta, **kwargs):
         logger.info(f"Deleting PV after deleting PVC '{meta.name}")
 
         core_api = kubernetes.client.CoreV1Api()
-        core_api.delete_persistent_volume(volume_name)
+        await asyncio.to_thread(core_api.delete_persistent_volume, volume_name)
 
 
 @kopf.on.delete("persistentvolume", annotations={Constants.PV_ASSIGNED_NODE_ANNOTATION_KEY: config.get().current_node_name})
-def delete_volume(spec: Spec, meta: Meta, **kwargs):
+@metrics.timed("delete_volume")
+async def delete_volume(spec: Spec, meta: Meta, **kwargs):
+    pvc_uid = spec.get("claimRef", {}).get("uid", meta.uid)
+    with tracing.trace("delete_volume", pvc_uid, pv=meta.name):
+        async with operation_semaphore:
+            await remove_volume(spec, meta)
+
+async def remove_volume(spec: Spec, meta: Meta):
     storage_class = spec["storageClassName"]
-    sc_params = get_storage_class_params(storage_class)
+    sc_params = await asyncio.to_thread(get_storage_class_params, storage_class)
     volume_type = sc_params["type"]
     pv_name = meta.name
     lvm_group = sc_params.get("lvm_group", config.get().lvm_group)
@@ -337,14 +838,14 @@ def delete_volume(spec: Spec, meta: Meta, **kwargs):
         return # nothing to do for shared volumes
 
     elif volume_type == Constants.VOLUME_TYPE_NFS:
-        mount_point = f"/srv/nfs/{pv_name}"
-        nfs.un_export_share(mount_point, config.get().nfs_access_cidr)
+        mount_point = f"{nfs.VOLUME_ROOT}/{pv_name}"
+        await nfs.un_export_share(mount_point, config.get().nfs_access_cidr)
 
         # unmount the share location
-        lvm.unmount_volume(mount_point, lvm_group, pv_name)
+        await lvm.unmount_volume(mount_point, lvm_group, pv_name)
         
     elif volume_type == Constants.VOLUME_TYPE_ISCSI:
-        iscsi.un_export_disk(lvm_group, pv_name)
+        await asyncio.to_thread(iscsi.un_export_disk, lvm_group, pv_name)
 
     # delete the volume (if destructive actions are on)
-    lvm.delete_volume(lvm_group, pv_name)
+    await lvm.delete_volume(lvm_group, pv_name)
@@ -1,14 +1,19 @@
+import os
 import threading
 import logging
+import time
 import secrets
 import base64
 
 import kubernetes
+from rtslib.node import CFSNode
 from rtslib.root import RTSRoot
 from rtslib.target import Target, TPG
 from rtslib.tcm import BlockStorageObject, RTSLibNotInCFSError
 from rtslib.fabric import ISCSIFabricModule
+from rtslib.utils import RTSLibError
 
+import tracing
 from util import run_process
 from config import Constants, AuthConfig
 
@@ -18,12 +23,127 @@ root = None
 tpg = None
 
 
+# saving serializes the entire target tree so changes are coalesced and written by a
+# background thread a short time after the first change in a burst
+SAVE_DEBOUNCE_SECONDS = 0.5
+
 iscsi_config_lock = threading.Lock()
+save_condition = threading.Condition()
+save_pending = False
+save_thread = None
+
 def update_iscsi_config():
-    iscsi_config_lock.acquire()
-    root.save_to_file()
-    iscsi_config_lock.release()
+    """Mark the target config as changed. The save is done asynchronously."""
+    global save_pending
+    with save_condition:
+        save_pending = True
+        save_condition.notify()
+
+def flush_iscsi_config():
+    """Immediately write any pending changes to the target config."""
+    global save_pending
+    with iscsi_config_lock:
+        with save_condition:
+            pending = save_pending
+            save_pending = False
+
+        if pending:
+            # rtslib writes to a temp file and renames it over the original
+            root.save_to_file()
+
+def _save_iscsi_config_loop():
+    while True:
+        with save_condition:
+            while not save_pending:
+                save_condition.wait()
+
+        # give any other changes in this burst a chance to come in
+        time.sleep(SAVE_DEBOUNCE_SECONDS)
+
+        try:
+            flush_iscsi_config()
+        except Exception as ex:
+            logger.error("Failed to save the iSCSI target config!", exc_info=ex)
+            update_iscsi_config()
+
+def start_iscsi_config_saver():
+    global save_thread
+    if save_thread is None:
+        save_thread = threading.Thread(target=_save_iscsi_config_loop, name="iscsi-config-saver", daemon=True)
+        save_thread.start()
+
+# in-memory index of the LUNs on our TPG. every attribute read on an rtslib object goes to
+# configfs so lookups are served from here and the index is updated by every create/delete
+lun_index_lock = threading.RLock()
+luns_by_storage_object = {} # storage object name -> LUN
+mapped_luns_by_acl = {} # initiator wwn -> set of mapped lun indexes
+used_lun_indexes = set()
+
+def _scan_lun_index():
+    luns = {}
+    used = set()
+    for tpg_lun in tpg.luns:
+        used.add(tpg_lun.lun)
+        storage_object = tpg_lun.storage_object
+        if storage_object.plugin == "block":
+            luns[storage_object.name] = tpg_lun
+
+    mapped = {}
+    for node_acl in tpg.node_acls:
+        mapped[node_acl.node_wwn] = set(mapped_lun.mapped_lun for mapped_lun in node_acl.mapped_luns)
+
+    return luns, mapped, used
+
+def rebuild_lun_index():
+    global luns_by_storage_object, mapped_luns_by_acl, used_lun_indexes
+
+    with lun_index_lock:
+        luns_by_storage_object, mapped_luns_by_acl, used_lun_indexes = _scan_lun_index()
+
+    logger.debug(f"Indexed {len(used_lun_indexes)} LUNs and {len(mapped_luns_by_acl)} node ACLs")
 
+def check_lun_index():
+    """Compare the LUN index against configfs and rebuild it if they have drifted apart.
+
+    Returns True if the index was consistent.
+    """
+    with lun_index_lock:
+        luns, mapped, used = _scan_lun_index()
+
+        consistent = used == used_lun_indexes and mapped == mapped_luns_by_acl and \
+            { name: lun.lun for name, lun in luns.items() } == { name: lun.lun for name, lun in luns_by_storage_object.items() }
+
+        if not consistent:
+            logger.warning("LUN index is out of sync with configfs. Rebuilding it.")
+            rebuild_lun_index()
+
+    return consistent
+
+def _index_lun(so_name, lun):
+    with lun_index_lock:
+        luns_by_storage_object[so_name] = lun
+        used_lun_indexes.add(lun.lun)
+
+def _unindex_lun(so_name, lun):
+    # deleting a LUN also deletes every mapped LUN pointing at it
+    with lun_index_lock:
+        if luns_by_storage_object.get(so_name) is lun:
+            del luns_by_storage_object[so_name]
+        used_lun_indexes.discard(lun.lun)
+        for mapped in mapped_luns_by_acl.values():
+            mapped.discard(lun.lun)
+
+def _reserve_lun_index():
+    # reserved right away so concurrent exports can't pick the same index
+    with lun_index_lock:
+        lun_idx = 0
+        while lun_idx in used_lun_indexes:
+            lun_idx += 1
+
+        used_lun_indexes.add(lun_idx)
+        return lun_idx
+
+@tracing.traced("iscsi.create_lun")
 def create_lun_from_volume(pool_name, vol_name, lun_idx=None):
     """Return a LUN for the given volume, enforcing a specific index if requested.
 
@@ -41,6 +161,16 @@ def create_lun_from_volume(pool_name, vol_name, lun_idx=None):
     exported LUN index matches the value stored in the PV spec.
     """
 
+    so_name = f"{pool_name}:{vol_name}"
+
+    # First, try to find an existing LUN for this storage object.
+    with lun_index_lock:
+        existing_lun = luns_by_storage_object.get(so_name)
+
+    if existing_lun is not None and (lun_idx is None or existing_lun.lun == lun_idx):
+        # Already exported (using the requested index if there is one).
+        return existing_lun
+
     device_path = f"/dev/{pool_name}/{vol_name}"
 
     # get serial number of volume which is consistent
@@ -48,7 +178,6 @@ def create_lun_from_volume(pool_name, vol_name, lun_idx=None):
 
     # only add new SO if it doesn't exist
     # so.name concats pool & vol names separated by ':'
-    so_name = f"{pool_name}:{vol_name}"
     try:
         # TODO: figure out why this sometimes fails even though the device exists. can we look it up by path instead?
         so = BlockStorageObject(so_name)
@@ -60,28 +189,7 @@ def create_lun_from_volume(pool_name, vol_name, lun_idx=None):
     # with ignored(RTSLibError):
     #     so.set_attribute("emulate_model_alias", "1")
 
-    # First, try to find an existing LUN for this storage object.
-    existing_lun = None
-    for tpg_lun in tpg.luns:
-        if tpg_lun.storage_object.name == so.name and tpg_lun.storage_object.plugin == "block":
-            existing_lun = tpg_lun
-            break
-
-    # If no specific index is requested, just reuse or create.
-    if lun_idx is None:
-        if existing_lun is not None:
-            return existing_lun
-        # Create a new LUN and let rtslib choose the index.
-        new_lun = tpg.lun(lun_idx, storage_object=so)
-        update_iscsi_config()
-        return new_lun
-
-    # A specific LUN index was requested.
     if existing_lun is not None:
-        if existing_lun.lun == lun_idx:
-            # Already using the requested index.
-            return existing_lun
-
         # The existing LUN has a different index. Recreate it at the
         # requested index to keep PV spec and exported LUN in sync.
         try:
@@ -90,27 +198,99 @@ def create_lun_from_volume(pool_name, vol_name, lun_idx=None):
             # If it disappeared between lookup and delete, just ignore and
             # create a fresh one below.
             pass
+        _unindex_lun(so_name, existing_lun)
+
+    # If no specific index is requested, pick the lowest free one ourselves
+    # instead of letting rtslib scan every LUN in configfs.
+    reserved = lun_idx is None
+    if reserved:
+        lun_idx = _reserve_lun_index()
 
-    # At this point, no suitable LUN exists: create one at the desired index.
-    new_lun = tpg.lun(lun_idx, storage_object=so)
+    try:
+        new_lun = tpg.lun(lun_idx, storage_object=so)
+    except:
+        if reserved:
+            with lun_index_lock:
+                used_lun_indexes.discard(lun_idx)
+        raise
+
+    _index_lun(so_name, new_lun)
     update_iscsi_config()
     return new_lun
 
 def find_lun_for_volume(pool_name, vol_name):
     # so.name concats pool & vol names separated by ':'
+    with lun_index_lock:
+        return luns_by_storage_object.get(f"{pool_name}:{vol_name}")
+
+def node_iqn(node_name):
+    return f"iqn.2003-01.org.linux-iscsi.ragdollphysics:{node_name}"
+
+# names of the nodes in the cluster. kept in sync by the node watch in the handler so
+# exports don't need to list every node in the cluster
+cluster_nodes_lock = threading.Lock()
+cluster_nodes = None
+
+def get_cluster_nodes():
+    global cluster_nodes
+    with cluster_nodes_lock:
+        if cluster_nodes is None:
+            # the watch hasn't delivered anything yet
+            core_api = kubernetes.client.CoreV1Api()
+            cluster_nodes = set(node.metadata.name for node in core_api.list_node().items)
+
+        return list(cluster_nodes)
+
+def add_cluster_node(node_name, auth_config):
+    """Start tracking a node and map every LUN on this target for its initiator."""
+    global cluster_nodes
+    with cluster_nodes_lock:
+        if cluster_nodes is None:
+            cluster_nodes = set()
+        cluster_nodes.add(node_name)
+
+    if not tpg:
+        return
+
+    with lun_index_lock:
+        luns = list(luns_by_storage_object.values())
+
+    if luns:
+        export_luns_for_initiator(node_iqn(node_name), luns, auth_config)
+
+def remove_cluster_node(node_name):
+    """Stop tracking a node and remove its initiator ACL along with all of its mapped LUNs."""
+    with cluster_nodes_lock:
+        if cluster_nodes is not None:
+            cluster_nodes.discard(node_name)
+
+    if not tpg:
+        return
+
+    initiator_wwn = node_iqn(node_name)
+    with lun_index_lock:
+        if mapped_luns_by_acl.pop(initiator_wwn, None) is None:
+            return
+
     try:
-        so = BlockStorageObject(f"{pool_name}:{vol_name}")
+        tpg.node_acl(initiator_wwn, mode="lookup").delete()
     except RTSLibNotInCFSError:
-        return None
+        pass
 
-    # only add tpg lun if it doesn't exist
-    for existing_lun in tpg.luns:
-        if existing_lun.storage_object.name == so.name and existing_lun.storage_object.plugin == "block":
-            return existing_lun
-    
-    return None
+    update_iscsi_config()
 
 def export_lun_for_initiator(initiator_wwn, lun, auth_config):
+    export_luns_for_initiator(initiator_wwn, [ lun ], auth_config)
+
+# rtslib isn't safe to use when creating the same ACL from multiple threads
+acl_lock = threading.Lock()
+
+@tracing.traced("iscsi.map_luns")
+def export_luns_for_initiator(initiator_wwn, luns, auth_config):
+    with acl_lock:
+        _export_luns_for_initiator(initiator_wwn, luns, auth_config)
+
+def _export_luns_for_initiator(initiator_wwn, luns, auth_config):
     node_acl = tpg.node_acl(initiator_wwn)
 
     if auth_config:
@@ -121,22 +301,36 @@ def export_lun_for_initiator(initiator_wwn, lun, auth_config):
         node_acl.chap_mutual_password = credentials["session_password_in"]
 
     # only create mappedlun if it doesn't already exist
-    try:
-        node_acl.mapped_lun(lun.lun)
-    except RTSLibNotInCFSError:
-        node_acl.mapped_lun(lun.lun, tpg_lun=lun)
-        update_iscsi_config()
+    with lun_index_lock:
+        mapped = mapped_luns_by_acl.setdefault(initiator_wwn, set())
+        missing_luns = [ lun for lun in luns if lun.lun not in mapped ]
+
+    if not missing_luns:
+        return
+
+    for lun in missing_luns:
+        try:
+            node_acl.mapped_lun(lun.lun, tpg_lun=lun)
+        except RTSLibError:
+            # the mapping was created outside of our index. look it up to make sure it is really there
+            node_acl.mapped_lun(lun.lun)
+
+        with lun_index_lock:
+            mapped.add(lun.lun)
+
+    update_iscsi_config()
 
 # export the disk for all nodes
 def export_disk(lvm_pool, disk_name, auth_config, desired_lun_idx=None):
-    core_api = kubernetes.client.CoreV1Api()
-    nodes = core_api.list_node()
-    lun = create_lun_from_volume(lvm_pool, disk_name, lun_idx=desired_lun_idx)
+    try:
+        lun = create_lun_from_volume(lvm_pool, disk_name, lun_idx=desired_lun_idx)
+    except RTSLibError:
+        # make sure the next attempt isn't working off of a stale index
+        check_lun_index()
+        raise
 
-    for node in nodes.items:
-        node_name = node.metadata.name
-        initiator_name = f"iqn.2003-01.org.linux-iscsi.ragdollphysics:{node_name}"
-        export_lun_for_initiator(initiator_name, lun, auth_config)
+    for node_name in get_cluster_nodes():
+        export_lun_for_initiator(node_iqn(node_name), lun, auth_config)
 
     # ``create_lun_from_volume`` guarantees that when a desired index is
     # provided, the returned LUN object will have that index.  No additional
@@ -144,6 +338,10 @@ def export_disk(lvm_pool, disk_name, auth_config, desired_lun_idx=None):
     return lun.lun
 
 def un_export_lun_for_initiator(initiator_wwn, lun):
+    with lun_index_lock:
+        if lun.lun not in mapped_luns_by_acl.get(initiator_wwn, set()):
+            return
+
     node_acl = tpg.node_acl(initiator_wwn)
     
     # delete the lun and mapped lun
@@ -153,31 +351,56 @@ def un_export_lun_for_initiator(initiator_wwn, lun):
         
     except RTSLibNotInCFSError:
         pass
+
+    with lun_index_lock:
+        mapped_luns_by_acl[initiator_wwn].discard(lun.lun)
         
+def _delete_lun(lun):
+    """Delete a LUN that is no longer mapped for any initiator. LUN.delete looks through the mapped LUNs
+    of every node ACL for ones pointing at it, so its configfs entries are removed directly instead."""
+    try:
+        # the link to the storage object has to go before the LUN itself
+        os.unlink(f"{lun.path}/{lun.alias}")
+    except (FileNotFoundError, RTSLibError):
+        pass
+
+    CFSNode.delete(lun)
+
+def _delete_storage_object(so_name):
+    """Delete a storage object by name. StorageObject.delete looks through every LUN of every target
+    for ones using it, so its configfs entries are removed directly instead. Its LUN must be gone already."""
+    try:
+        so = BlockStorageObject(so_name)
+    except RTSLibNotInCFSError:
+        return
+
+    CFSNode.delete(so)
+    # the backstore is removed along with it like StorageObject.delete does
+    so._backstore.delete()
+
 # unexport the disk for all nodes
+@tracing.traced("iscsi.un_export_disk")
 def un_export_disk(lvm_pool, disk_name):
-    core_api = kubernetes.client.CoreV1Api()
-    nodes = core_api.list_node()
     lun = find_lun_for_volume(lvm_pool, disk_name)
 
     if not lun:
         return
 
-    for node in nodes.items:
-        node_name = node.metadata.name
-        initiator_name = f"iqn.2003-01.org.linux-iscsi.ragdollphysics:{node_name}"
+    # remove it from every initiator it is mapped for, including nodes that have since left
+    with lun_index_lock:
+        initiators = [ initiator_wwn for initiator_wwn, mapped in mapped_luns_by_acl.items() if lun.lun in mapped ]
+
+    for initiator_name in initiators:
         un_export_lun_for_initiator(initiator_name, lun)
 
-    if lun.storage_object:
-        lun.storage_object.delete()
-
-    try:
-        lun.delete()
-    except RTSLibNotInCFSError:
-        pass
+    # the LUN goes first so nothing uses the storage object when it is deleted
+    _delete_lun(lun)
+    _delete_storage_object(f"{lvm_pool}:{disk_name}")
 
+    _unindex_lun(f"{lvm_pool}:{disk_name}", lun)
     update_iscsi_config()
 
+@tracing.traced("iscsi.create_persistent_volume")
 def create_persistent_volume(pv_name, node_name, access_modes, desired_capacity, iscsi_portal, iscsi_target, iscsi_lun, fs_type, sc_name, volume_mode, auth_config):
     pv = {
         "accessModes": access_modes,
@@ -316,7 +539,7 @@ def init_iscsi(node_name, portal_address, auth_config=None):
     global root, tpg
 
     root = RTSRoot()
-    tpg = TPG(Target(ISCSIFabricModule(), f"iqn.2003-01.org.linux-iscsi.ragdollphysics:{node_name}"), 1)
+    tpg = TPG(Target(ISCSIFabricModule(), node_iqn(node_name)), 1)
     tpg.enable = True
 
     if auth_config:
@@ -327,4 +550,7 @@ def init_iscsi(node_name, portal_address, auth_config=None):
     portal_address = portal_address.split(":")
     tpg.network_portal(portal_address[0], int(portal_address[1]))
 
+    rebuild_lun_index()
+
+    start_iscsi_config_saver()
     update_iscsi_config()
\ No newline at end of file
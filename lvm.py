@@ -1,70 +1,646 @@
+import asyncio
 import logging
-import time
 import json
 import os
+import re
+import shlex
+import tempfile
+import threading
 from contextlib import suppress
+from datetime import datetime, timezone
 
 import util
 import config
+import fstab
+import tracing
 import kopf
+import kubernetes
 
 logger = logging.getLogger(__name__)
 
-def volume_exists(pool_name, volume_name):
-    lines = util.run_process("lvs", "--reportformat", "json")
-    report = json.loads("".join(lines))
+# in-memory inventory of the lvm state on this node. existence, size, and free space checks
+# are served from here instead of shelling out to lvs/vgs on every call
+inventory_lock = threading.RLock()
+logical_volumes = None # (vg_name, lv_name) -> { "size", "attr", "segtype", "pool", "origin", "data_percent", "metadata_percent" }
+volume_groups = None # vg_name -> { "size", "free", "extent_size" }
+# vg_name -> bytes set aside for creates and resizes that have not allocated their space yet
+reserved_bytes = {}
+# (vg_name, thin_pool) -> virtual bytes set aside the same way for thin volumes
+reserved_thin_bytes = {}
+# (vg_name, lv_name) -> { "mode", "total_blocks", ... } for every cached volume. refreshed by monitor_caches
+cache_stats = {}
+
+CACHE_MODES = [ "writethrough", "writeback" ]
+
+# slowest copy speed (bytes per second) that clones which have to be copied block by block are given time for
+CLONE_COPY_MIN_RATE = 20 * 1024 * 1024
+
+# (vg_name, lv_name) -> { "type", "sync_percent", "sync_action", "health", "mismatches", "degraded" } for every raid volume. refreshed by monitor_raid
+raid_status = {}
+
+LV_REPORT_FIELDS = "vg_name,lv_name,lv_size,lv_attr,segtype,pool_lv,origin,data_percent,metadata_percent"
+RAID_REPORT_FIELDS = "vg_name,lv_name,segtype,sync_percent,raid_sync_action,lv_health_status,raid_mismatch_count"
+CACHE_REPORT_FIELDS = "vg_name,lv_name,cache_mode,cache_total_blocks,cache_used_blocks,cache_dirty_blocks,cache_read_hits,cache_read_misses,cache_write_hits,cache_write_misses"
+VG_REPORT_FIELDS = "vg_name,vg_size,vg_free,vg_extent_size"
+
+# characters allowed in mkfs and mount options from storage classes
+OPTION_PATTERN = re.compile(r"^[A-Za-z0-9_=,.:/+-]+$")
+
+def _run_report(command, fields, *targets):
+    lines = util.run_process(command, "--reportformat", "json", "--units", "b", "--nosuffix", "-o", fields, *targets)
+    return json.loads("".join(lines))["report"][0]
+
+def _percent(value):
+    return float(value) if value else None
+
+def _lv_entry(row):
+    return {
+        "size": int(row["lv_size"]),
+        "attr": row["lv_attr"],
+        "segtype": row["segtype"],
+        "pool": row["pool_lv"] if row["segtype"] == "thin" else None, # thin pool of a thin volume. cached volumes report their cache pool here
+        "origin": row["origin"] or None, # volume a snapshot was taken of
+        "data_percent": _percent(row["data_percent"]), # usage of thin pools and thin volumes
+        "metadata_percent": _percent(row["metadata_percent"]),
+    }
+
+def _vg_entry(row):
+    return { "size": int(row["vg_size"]), "free": int(row["vg_free"]), "extent_size": int(row["vg_extent_size"]) }
+
+def refresh_inventory():
+    global logical_volumes, volume_groups
+
+    with inventory_lock:
+        vg_report = _run_report("vgs", VG_REPORT_FIELDS)
+        lv_report = _run_report("lvs", LV_REPORT_FIELDS)
+
+        volume_groups = { row["vg_name"]: _vg_entry(row) for row in vg_report["vg"] }
+        logical_volumes = { (row["vg_name"], row["lv_name"]): _lv_entry(row) for row in lv_report["lv"] }
+
+    logger.debug(f"Loaded lvm inventory with {len(volume_groups)} volume groups and {len(logical_volumes)} volumes")
+
+def invalidate_inventory():
+    global logical_volumes, volume_groups
+
+    with inventory_lock:
+        logical_volumes = None
+        volume_groups = None
+
+def _ensure_inventory():
+    if logical_volumes is None or volume_groups is None:
+        refresh_inventory()
+
+def update_inventory(pool_name, volume_name):
+    """Re-read a single volume and its volume group after LabDisk modified it."""
+    with inventory_lock:
+        if logical_volumes is None or volume_groups is None:
+            return # loaded lazily on the next lookup
+
+        try:
+            fields = f"{LV_REPORT_FIELDS},vg_size,vg_free,vg_extent_size"
+            report = _run_report("lvs", fields, f"{pool_name}/{volume_name}")
+            for row in report["lv"]:
+                logical_volumes[(row["vg_name"], row["lv_name"])] = _lv_entry(row)
+                volume_groups[row["vg_name"]] = _vg_entry(row)
+        except Exception as ex:
+            logger.warning(f"Failed to update lvm inventory for {pool_name}/{volume_name}. Invalidating it.", exc_info=ex)
+            invalidate_inventory()
+
+def forget_volume(pool_name, volume_name):
+    """Drop a volume from the inventory after LabDisk removed it."""
+    with inventory_lock:
+        if logical_volumes is None or volume_groups is None:
+            return
+
+        entry = logical_volumes.pop((pool_name, volume_name), None)
+
+        try:
+            report = _run_report("vgs", VG_REPORT_FIELDS, pool_name)
+            for row in report["vg"]:
+                volume_groups[row["vg_name"]] = _vg_entry(row)
+
+            # removing a thin volume frees space in its thin pool instead
+            if entry and entry["pool"]:
+                update_inventory(pool_name, entry["pool"])
+        except Exception as ex:
+            logger.warning(f"Failed to update lvm inventory for {pool_name}. Invalidating it.", exc_info=ex)
+            invalidate_inventory()
+
+def get_volume(pool_name, volume_name):
+    with inventory_lock:
+        _ensure_inventory()
+        entry = logical_volumes.get((pool_name, volume_name))
+        return dict(entry) if entry else None
+
+def get_volume_group(pool_name):
+    with inventory_lock:
+        _ensure_inventory()
+        entry = volume_groups.get(pool_name)
+        return dict(entry) if entry else None
+
+def refresh_thin_pools():
+    """Re-read the usage of every thin pool. Returns { (vg_name, pool_name): entry }"""
+    with inventory_lock:
+        _ensure_inventory()
+
+        report = _run_report("lvs", LV_REPORT_FIELDS, "-S", "segtype=thin-pool")
+        pools = { (row["vg_name"], row["lv_name"]): _lv_entry(row) for row in report["lv"] }
+        logical_volumes.update(pools)
+        return { key: dict(entry) for key, entry in pools.items() }
+
+def get_thin_pool_allocated_bytes(pool_name, thin_pool):
+    """Total virtual size of the thin volumes in a thin pool"""
+    with inventory_lock:
+        _ensure_inventory()
+        return sum(entry["size"] for (vg_name, _), entry in logical_volumes.items() if vg_name == pool_name and entry["pool"] == thin_pool)
+
+def reserve_thin_pool_space(pool_name, thin_pool, requested_bytes):
+    """Make sure a thin pool can take on another requested_bytes of virtual size and set it aside until the
+    volume is created or extended, like reserve_space does for volume groups. Refuses when the pool is over
+    the fill threshold or the allocation would exceed the overcommit limit."""
+    update_inventory(pool_name, thin_pool)
+
+    with inventory_lock:
+        pool = get_volume(pool_name, thin_pool)
+        if pool is None or pool["segtype"] != "thin-pool":
+            raise kopf.PermanentError(f"Cannot find thin pool '{thin_pool}' in volume group '{pool_name}'")
+
+        fill_threshold = config.get().thin_pool_fill_threshold
+        if max(pool["data_percent"] or 0, pool["metadata_percent"] or 0) >= fill_threshold:
+            raise kopf.TemporaryError(f"Thin pool {pool_name}/{thin_pool} is over {fill_threshold}% full (data: {pool['data_percent']}%, metadata: {pool['metadata_percent']}%). Extend the pool or free up space.")
+
+        max_overcommit = config.get().thin_pool_max_overcommit
+        allocated_bytes = get_thin_pool_allocated_bytes(pool_name, thin_pool)
+        reserved = reserved_thin_bytes.get((pool_name, thin_pool), 0)
+        if max_overcommit and allocated_bytes + reserved + requested_bytes > pool["size"] * max_overcommit:
+            raise kopf.PermanentError(f"Cannot allocate {requested_bytes} bytes in thin pool {pool_name}/{thin_pool}. It already has {allocated_bytes} bytes allocated, {reserved} bytes reserved for other volumes, and the overcommit limit is {max_overcommit}x its size.")
+
+        reserved_thin_bytes[(pool_name, thin_pool)] = reserved + requested_bytes
+
+def release_thin_pool_space(pool_name, thin_pool, released_bytes, volume_name=None):
+    """Give reserved thin pool space back. The volume that used it is re-read in the same step like in release_space"""
+    with inventory_lock:
+        if volume_name:
+            update_inventory(pool_name, volume_name)
+
+        remaining = reserved_thin_bytes.get((pool_name, thin_pool), 0) - released_bytes
+        if remaining > 0:
+            reserved_thin_bytes[(pool_name, thin_pool)] = remaining
+        else:
+            reserved_thin_bytes.pop((pool_name, thin_pool), None)
+
+async def monitor_thin_pools(interval):
+    """Periodically refresh the usage of every thin pool and warn about the ones that are filling up"""
+    while True:
+        await asyncio.sleep(interval)
 
-    for entry in report["report"][0]["lv"]:
-        if entry["vg_name"] == pool_name and entry["lv_name"] == volume_name:
-            return True
+        try:
+            pools = await asyncio.to_thread(refresh_thin_pools)
+        except Exception as ex:
+            logger.warning("Failed to refresh thin pool usage", exc_info=ex)
+            continue
+
+        fill_threshold = config.get().thin_pool_fill_threshold
+        for (vg_name, pool_name), pool in pools.items():
+            if max(pool["data_percent"] or 0, pool["metadata_percent"] or 0) >= fill_threshold:
+                logger.warning(f"Thin pool {vg_name}/{pool_name} is over {fill_threshold}% full (data: {pool['data_percent']}%, metadata: {pool['metadata_percent']}%). New volumes will not be provisioned in it.")
+
+def refresh_cache_stats():
+    """Re-read the hit, miss, and dirty block counters of every cached volume"""
+    global cache_stats
+
+    report = _run_report("lvs", CACHE_REPORT_FIELDS, "-S", "segtype=cache")
+    stats = {}
+    for row in report["lv"]:
+        stats[(row["vg_name"], row["lv_name"])] = {
+            "mode": row["cache_mode"],
+            **{ field.removeprefix("cache_"): int(row[field] or 0) for field in CACHE_REPORT_FIELDS.split(",")[3:] }
+        }
+
+    with inventory_lock:
+        cache_stats = stats
+    return stats
+
+async def monitor_caches(interval):
+    """Periodically refresh the cache statistics and warn about caches that are full of dirty blocks"""
+    while True:
+        try:
+            stats = await asyncio.to_thread(refresh_cache_stats)
+        except Exception as ex:
+            logger.warning("Failed to refresh cache statistics", exc_info=ex)
+            stats = {}
+
+        for (vg_name, lv_name), cache in stats.items():
+            if cache["total_blocks"] and cache["dirty_blocks"] >= cache["total_blocks"] * 0.9:
+                logger.warning(f"The cache of {vg_name}/{lv_name} is {cache['dirty_blocks'] / cache['total_blocks']:.0%} dirty. Writes will slow down to the speed of the origin disks.")
+
+        await asyncio.sleep(interval)
+
+def refresh_raid_status():
+    """Re-read the sync progress and health of every raid volume"""
+    global raid_status
+
+    report = _run_report("lvs", RAID_REPORT_FIELDS, "-S", "segtype=~^raid")
+    status = {}
+    for row in report["lv"]:
+        status[(row["vg_name"], row["lv_name"])] = {
+            "type": row["segtype"],
+            "sync_percent": _percent(row["sync_percent"]),
+            "sync_action": row["raid_sync_action"] or "idle",
+            "health": row["lv_health_status"],
+            "mismatches": int(row["raid_mismatch_count"] or 0),
+            # a leg is missing or failed. "mismatches exist" only means a scrub found differences
+            "degraded": row["lv_health_status"] in [ "partial", "refresh needed" ],
+        }
+
+    with inventory_lock:
+        raid_status = status
+    return status
+
+def post_volume_event(volume_name, event_type, reason, message, volume_uid=None):
+    """Post an event on the persistent volume a LabDisk volume is named after. Called from the background
+    tasks where kopf.event can't be used, so the event is created through the api directly."""
+    try:
+        core_api = kubernetes.client.CoreV1Api()
+        if not volume_uid:
+            volume_uid = core_api.read_persistent_volume(volume_name).metadata.uid
+
+        now = datetime.now(timezone.utc).replace(microsecond=0)
+        # persistent volumes are cluster scoped. their events go in the default namespace like kubectl expects
+        core_api.create_namespaced_event("default", {
+            "metadata": { "generateName": f"{volume_name}." },
+            "involvedObject": { "apiVersion": "v1", "kind": "PersistentVolume", "name": volume_name, "uid": volume_uid },
+            "type": event_type,
+            "reason": reason,
+            "message": message,
+            "firstTimestamp": now,
+            "lastTimestamp": now,
+            "count": 1,
+            "source": { "component": "labdisk", "host": config.get().current_node_name },
+        })
+    except Exception as ex:
+        logger.warning(f"Failed to post {reason} event for {volume_name}", exc_info=ex)
 
-    return False
+async def monitor_raid(interval):
+    """Periodically refresh the raid volume status. Warns and posts events on the persistent volume
+    when a raid volume becomes degraded or recovers, and when it finishes its initial sync"""
+    previous = {}
+    while True:
+        try:
+            status = await asyncio.to_thread(refresh_raid_status)
+        except Exception as ex:
+            logger.warning("Failed to refresh raid status", exc_info=ex)
+            await asyncio.sleep(interval)
+            continue
+
+        for (vg_name, lv_name), volume in status.items():
+            old = previous.get((vg_name, lv_name))
+            if volume["degraded"] and not (old and old["degraded"]):
+                message = f"The {volume['type']} volume {vg_name}/{lv_name} is degraded ({volume['health']}). Replace the failed disk and run 'lvconvert --repair {vg_name}/{lv_name}'."
+                logger.warning(message)
+                await asyncio.to_thread(post_volume_event, lv_name, "Warning", "VolumeDegraded", message)
+            elif old and old["degraded"] and not volume["degraded"]:
+                logger.info(f"The {volume['type']} volume {vg_name}/{lv_name} is no longer degraded")
+                await asyncio.to_thread(post_volume_event, lv_name, "Normal", "VolumeRecovered", f"The {volume['type']} volume {vg_name}/{lv_name} is no longer degraded")
+
+            if old and (old["sync_percent"] or 0) < 100 and volume["sync_percent"] == 100:
+                logger.info(f"The {volume['type']} volume {vg_name}/{lv_name} finished syncing")
+                await asyncio.to_thread(post_volume_event, lv_name, "Normal", "VolumeSynced", f"The {volume['type']} volume {vg_name}/{lv_name} finished syncing")
+
+        previous = status
+        await asyncio.sleep(interval)
+
+def parse_cache_options(sc_params):
+    """Read the cache_pv, cache_size, and cache_mode storage class parameters.
+    Returns None if the storage class has no cache"""
+    if not sc_params.get("cache_pv"):
+        return None
+
+    cache = {
+        "pv": sc_params["cache_pv"],
+        "size": sc_params.get("cache_size", "10%"),
+        "mode": sc_params.get("cache_mode", "writethrough"),
+    }
+
+    if sc_params.get("thin_pool"):
+        raise ValueError("thin volumes can't be cached. Cache the thin pool instead")
+    if cache["mode"] not in CACHE_MODES:
+        raise ValueError(f"invalid cache mode '{cache['mode']}'. Must be one of: {', '.join(CACHE_MODES)}")
+    if not re.match(r"^(\d+%|\d+[KMGT]i?)$", cache["size"]):
+        raise ValueError(f"invalid cache size '{cache['size']}'. Must be a percent of the volume size or a size like 10Gi")
+
+    return cache
+
+def parse_layout_options(sc_params, annotations=None):
+    """Read the raid, stripes, stripe_size, and recovery rate storage class parameters. The raid
+    type can be overridden per claim with an annotation. Returns None for linear volumes"""
+    annotations = annotations or {}
+    raid = sc_params.get("raid")
+    if config.Constants.MIRROR_ANNOTATION_KEY in annotations:
+        raid = "raid1"
+    raid = annotations.get(config.Constants.RAID_ANNOTATION_KEY, raid)
+
+    if raid and raid not in config.Constants.LVM_RAID_TYPES:
+        raise ValueError(f"invalid raid type '{raid}'. Must be one of: {', '.join(config.Constants.LVM_RAID_TYPES)}")
+
+    min_stripes = config.Constants.LVM_RAID_TYPES.get(raid, 1)
+    stripes = int(sc_params.get("stripes", min_stripes))
+    if stripes < min_stripes:
+        raise ValueError(f"invalid stripe count {stripes}. Must be at least {min_stripes}")
+    if raid == "raid1" and stripes > 1:
+        raise ValueError("raid1 volumes can't be striped. Use raid10 instead")
+    if not raid and stripes == 1:
+        return None
+
+    if sc_params.get("thin_pool"):
+        raise ValueError("thin volumes can't be striped or mirrored. Use a striped or mirrored thin pool instead")
+
+    stripe_size = sc_params.get("stripe_size", "64Ki")
+    stripe_bytes = size_to_bytes(format_volume_size(stripe_size)) if re.match(r"^\d+[KMG]i?$", stripe_size) else None
+    if not stripe_bytes or stripe_bytes < 4096 or stripe_bytes & (stripe_bytes - 1):
+        raise ValueError(f"invalid stripe size '{stripe_size}'. Must be a power of 2 of at least 4Ki")
+
+    # per disk resync and rebuild speed limits (ex: 100M for 100MiB/s)
+    recovery_rates = { key: sc_params[key] for key in [ "min_recovery_rate", "max_recovery_rate" ] if sc_params.get(key) }
+    for key, rate in recovery_rates.items():
+        if not raid:
+            raise ValueError(f"{key} only applies to raid volumes")
+        if not re.match(r"^\d+[kKmMgG]?$", rate):
+            raise ValueError(f"invalid {key} '{rate}'")
+
+    return { "raid": raid, "stripes": stripes, "stripe_size": stripe_bytes, **recovery_rates }
+
+def _align_size(pool_name, size_bytes, layout):
+    """Round a size up to a whole number of extents on every stripe so the volume keeps its layout when extended"""
+    if not layout:
+        return size_bytes
+
+    group = get_volume_group(pool_name)
+    unit = group["extent_size"] * layout["stripes"] if group else 1
+    return -(-size_bytes // unit) * unit
+
+def _raw_bytes(size_bytes, layout):
+    """Space taken up in the volume group by a volume of size_bytes, including mirrors and parity"""
+    if not layout or not layout["raid"]:
+        return size_bytes
+    if layout["raid"] in [ "raid1", "raid10" ]:
+        return size_bytes * 2
+
+    parity = 1 if layout["raid"] == "raid5" else 2
+    return size_bytes * (layout["stripes"] + parity) // layout["stripes"]
+
+def _layout_args(layout):
+    """lvcreate arguments for a layout. The raid arguments are only understood by lvcreate, not lvextend"""
+    if not layout:
+        return []
+
+    args = []
+    if layout["raid"]:
+        args.extend([ "--type", layout["raid"] ])
+        if layout["raid"] in [ "raid1", "raid10" ]:
+            args.extend([ "--mirrors", "1" ])
+        if layout.get("min_recovery_rate"):
+            args.extend([ "--minrecoveryrate", layout["min_recovery_rate"] ])
+        if layout.get("max_recovery_rate"):
+            args.extend([ "--maxrecoveryrate", layout["max_recovery_rate"] ])
+
+    return args + _stripe_args(layout)
+
+def _stripe_args(layout):
+    if not layout or layout["stripes"] < 2:
+        return []
+    return [ "--stripes", str(layout["stripes"]), "--stripesize", f"{layout['stripe_size'] // 1024}k" ]
+
+def _mkfs_args(fs_type, mkfs_options, layout):
+    """The storage class mkfs arguments plus the ones that line the filesystem up with the stripes,
+    unless the storage class already sets them"""
+    args = list(mkfs_options)
+    if not layout or layout["stripes"] < 2 or any("su=" in arg or "sunit=" in arg or "stride=" in arg for arg in args):
+        return args
+
+    if fs_type == "xfs":
+        args.extend([ "-d", f"su={layout['stripe_size']},sw={layout['stripes']}" ])
+    elif fs_type.startswith("ext"):
+        stride = layout["stripe_size"] // 4096 # ext4 blocks
+        hint = f"stride={stride},stripe_width={stride * layout['stripes']}"
+        # mke2fs only uses the last -E
+        if "-E" in args:
+            idx = args.index("-E") + 1
+            args[idx] = f"{args[idx]},{hint}"
+        else:
+            args.extend([ "-E", hint ])
+
+    return args
+
+def get_physical_volumes(pool_name):
+    """The physical volumes of a volume group"""
+    report = _run_report("pvs", "pv_name,vg_name", "-S", f"vg_name={pool_name}")
+    return [ row["pv_name"] for row in report["pv"] ]
+
+def _cache_bytes(volume_bytes, cache):
+    if cache["size"].endswith("%"):
+        return volume_bytes * int(cache["size"][:-1]) // 100
+    return size_to_bytes(format_volume_size(cache["size"]))
+
+async def _attach_cache(pool_name, volume_name, volume_bytes, cache):
+    """Put a cache pool on the cache PV in front of a volume"""
+    cache_pool = f"{volume_name}_cache"
+    cache_size = f"{_cache_bytes(volume_bytes, cache)}b"
+
+    await util.run_process_async("lvcreate", "--type", "cache-pool", "--size", cache_size, "--name", cache_pool, pool_name, cache["pv"])
+    try:
+        await util.run_process_async("lvconvert", "--yes", "--type", "cache", "--cachepool", f"{pool_name}/{cache_pool}", "--cachemode", cache["mode"], f"{pool_name}/{volume_name}")
+    except Exception:
+        await util.run_process_async("lvremove", f"{pool_name}/{cache_pool}", "--yes")
+        raise
+
+    await asyncio.to_thread(update_inventory, pool_name, volume_name)
+
+async def _detach_cache(pool_name, volume_name):
+    """Write back any dirty blocks and remove the cache pool of a volume"""
+    await util.run_process_async("lvconvert", "--yes", "--uncache", f"{pool_name}/{volume_name}")
+    await asyncio.to_thread(update_inventory, pool_name, volume_name)
+
+    with inventory_lock:
+        cache_stats.pop((pool_name, volume_name), None)
+
+def list_volumes(pool_name):
+    with inventory_lock:
+        _ensure_inventory()
+        return { lv_name: dict(entry) for (vg_name, lv_name), entry in logical_volumes.items() if vg_name == pool_name }
+
+def get_free_bytes(pool_name):
+    group = get_volume_group(pool_name)
+    return group["free"] if group else None
+
+def get_available_bytes(pool_name):
+    """Free space in a volume group that is not reserved by another operation"""
+    with inventory_lock:
+        free_bytes = get_free_bytes(pool_name)
+        return free_bytes - reserved_bytes.get(pool_name, 0) if free_bytes is not None else None
+
+def reserve_space(pool_name, requested_bytes):
+    """Set aside space in a volume group for a volume that is about to be created or extended so
+    concurrent operations can't promise the same free space twice. Raises a PermanentError if it doesn't fit."""
+    with inventory_lock:
+        free_bytes = get_free_bytes(pool_name)
+        if free_bytes is None:
+            raise kopf.PermanentError(f"Cannot find volume group '{pool_name}'")
+
+        reserved = reserved_bytes.get(pool_name, 0)
+        if reserved + requested_bytes > free_bytes:
+            raise kopf.PermanentError(f"Cannot allocate {requested_bytes} bytes in volume group '{pool_name}'. It has {free_bytes} bytes free and {reserved} bytes of that are reserved for other volumes. There is insufficent disk space!")
+
+        reserved_bytes[pool_name] = reserved + requested_bytes
+
+def release_space(pool_name, released_bytes, volume_name=None):
+    """Give reserved space back. When the volume that used it is given, it is re-read in the same step
+    so the space it now takes up is never counted twice."""
+    with inventory_lock:
+        if volume_name:
+            update_inventory(pool_name, volume_name)
+
+        remaining = reserved_bytes.get(pool_name, 0) - released_bytes
+        if remaining > 0:
+            reserved_bytes[pool_name] = remaining
+        else:
+            reserved_bytes.pop(pool_name, None)
 
-def create_volume(pool_name, volume_name, fs_type, mirror_disk, volume_size, mount_point=None):
-    if volume_exists(pool_name, volume_name):
+def volume_exists(pool_name, volume_name):
+    return get_volume(pool_name, volume_name) is not None
+
+def format_volume_size(volume_size):
+    return volume_size.replace("Ki", "K").replace("Mi", "M").replace("Gi", "G").replace("Ti", "T").lower()
+
+def size_to_bytes(formatted_size):
+    extracted = int(formatted_size[:-1])
+    if "k" in formatted_size:
+        return 1024 * extracted
+    if "m" in formatted_size:
+        return 1024 * 1024 * extracted
+    if "g" in formatted_size:
+        return 1024 * 1024 * 1024 * extracted
+    if "t" in formatted_size:
+        return 1024 * 1024 * 1024 * 1024 * extracted
+
+def parse_mkfs_options(value):
+    """Split the mkfs_options storage class parameter into arguments for mkfs.
+    Values have to follow a flag so nothing can be passed in as the device to format."""
+    args = shlex.split(value or "")
+    for idx, arg in enumerate(args):
+        if not OPTION_PATTERN.match(arg):
+            raise ValueError(f"invalid mkfs option '{arg}'")
+        if not arg.startswith("-") and (idx == 0 or not args[idx - 1].startswith("-") or arg.startswith("/")):
+            raise ValueError(f"mkfs option value '{arg}' does not follow a flag")
+
+    return args
+
+def validate_mount_options(value):
+    """Check the fs_mount_options storage class parameter, which is written to fstab as is"""
+    options = value or config.Constants.FS_MOUNT_FLAGS
+    for option in options.split(","):
+        if not OPTION_PATTERN.match(option) or option.startswith("-"):
+            raise ValueError(f"invalid mount option '{option}'")
+
+    return options
+
+async def _mount_volume(block_device, mount_point, fs_type, unroll, mount_options=None):
+    mount_options = mount_options or config.Constants.FS_MOUNT_FLAGS
+    os.makedirs(mount_point, exist_ok=True)
+    unroll.append("mkdir")
+
+    await util.run_process_async("mount", "-t", fs_type, "-o", mount_options, block_device, mount_point)
+    unroll.append("mount")
+
+    # save our mount with the same options so it comes back the same way after a reboot
+    with tracing.span("fstab"):
+        await asyncio.to_thread(fstab.add_entry, block_device, mount_point, fs_type, mount_options)
+    unroll.append("fstab")
+
+@tracing.traced("lvm.create_volume")
+async def create_volume(pool_name, volume_name, fs_type, mirror_disk, volume_size, mount_point=None, thin_pool=None, mkfs_options=(), mount_options=None, cache=None, layout=None):
+    if await asyncio.to_thread(volume_exists, pool_name, volume_name):
         return
 
-    formatted_volume_size = volume_size.replace("Ki", "K").replace("Mi", "M").replace("Gi", "G").lower()
+    formatted_volume_size = format_volume_size(volume_size)
     block_device = f"/dev/{pool_name}/{volume_name}"
 
+    # the mirror flag is a shorthand for a raid1 layout
+    if mirror_disk and not layout:
+        layout = parse_layout_options({ "raid": "raid1" })
+
+    if thin_pool:
+        if layout:
+            raise kopf.PermanentError("Thin volumes can't be mirrored or striped. Use a mirrored or striped thin pool instead.")
+        if cache:
+            raise kopf.PermanentError("Thin volumes can't be cached. Cache the thin pool instead.")
+
+        thin_reserved_bytes = size_to_bytes(formatted_volume_size)
+        await asyncio.to_thread(reserve_thin_pool_space, pool_name, thin_pool, thin_reserved_bytes)
+        lv_bytes = volume_reserved_bytes = cache_reserved_bytes = 0
+    else:
+        thin_reserved_bytes = 0
+        lv_bytes = await asyncio.to_thread(_align_size, pool_name, size_to_bytes(formatted_volume_size), layout)
+        volume_reserved_bytes = _raw_bytes(lv_bytes, layout)
+        cache_reserved_bytes = _cache_bytes(size_to_bytes(formatted_volume_size), cache) if cache else 0
+        await asyncio.to_thread(reserve_space, pool_name, volume_reserved_bytes + cache_reserved_bytes)
+
     unroll = []
 
     try:
-        create_cmd = [ "lvcreate", "--zero", "n", "--size", formatted_volume_size, "--name", volume_name, pool_name ]
-        if mirror_disk:
-            create_cmd.extend(config.Constants.LVM_RAID1_FLAGS)
-
-        util.run_process(*create_cmd)
+        if thin_pool:
+            create_cmd = [ "lvcreate", "--type", "thin", "--virtualsize", formatted_volume_size, "--thinpool", thin_pool, "--name", volume_name, pool_name ]
+        else:
+            lv_size = f"{lv_bytes}b" if layout else formatted_volume_size
+            create_cmd = [ "lvcreate", "--zero", "n", "--size", lv_size, *_layout_args(layout), "--name", volume_name, pool_name ]
+        if cache:
+            # keep the volume itself off of the cache disk
+            create_cmd.extend(pv for pv in await asyncio.to_thread(get_physical_volumes, pool_name) if pv != cache["pv"])
+
+        await util.run_process_async(*create_cmd)
         unroll.append("lvcreate")
+        if thin_pool:
+            await asyncio.to_thread(release_thin_pool_space, pool_name, thin_pool, thin_reserved_bytes, volume_name)
+            thin_reserved_bytes = 0
+        else:
+            await asyncio.to_thread(release_space, pool_name, volume_reserved_bytes, volume_name)
+            volume_reserved_bytes = 0
+
+        if cache:
+            await _attach_cache(pool_name, volume_name, size_to_bytes(formatted_volume_size), cache)
+            await asyncio.to_thread(release_space, pool_name, cache_reserved_bytes)
+            cache_reserved_bytes = 0
 
         # wait for the device to be created
-        time.sleep(1.0)
+        with tracing.span("wait_for_device"):
+            await util.wait_for_device(block_device, config.get().device_timeout)
 
-        util.run_process(f"mkfs.{fs_type}", "-f", block_device)
+        await util.run_process_async(f"mkfs.{fs_type}", "-f", *_mkfs_args(fs_type, mkfs_options, layout), block_device)
         unroll.append("mkfs")
 
         if mount_point:
-            os.makedirs(mount_point, exist_ok=True)
-            unroll.append("mkdir")
-
-            util.run_process("mount", "-t", fs_type, block_device, mount_point)
-            unroll.append("mount")
-
-            # save our mount
-            options = f"defaults,noatime"
-            with open("/app/hostetc/fstab", "a") as f:
-                f.write(f"{block_device} {mount_point} {fs_type} {options} 0 0\n") # dump and fsck disabled
+            await _mount_volume(block_device, mount_point, fs_type, unroll, mount_options)
 
     except Exception as ex:
+        await asyncio.to_thread(release_space, pool_name, volume_reserved_bytes + cache_reserved_bytes)
+        if thin_reserved_bytes:
+            await asyncio.to_thread(release_thin_pool_space, pool_name, thin_pool, thin_reserved_bytes)
+
         try:
+            if "fstab" in unroll:
+                await asyncio.to_thread(fstab.remove_entry, mount_point)
             if "mount" in unroll:
-                util.run_process("umount", mount_point)
+                await util.run_process_async("umount", mount_point)
             
             if "mkdir" in unroll:
                 os.rmdir(mount_point)
 
             if "lvcreate" in unroll and config.get().allow_destructive_actions:
-                util.run_process("lvremove", f"{pool_name}/{volume_name}", "--yes")
+                await util.run_process_async("lvremove", f"{pool_name}/{volume_name}", "--yes")
+                await asyncio.to_thread(forget_volume, pool_name, volume_name)
+            elif "lvcreate" not in unroll:
+                # lvcreate may have failed because of something we didn't know about
+                invalidate_inventory()
         except Exception as ex2:
             msg = "Fatal Error encountered unrolling volume creation. Disk will be left in a intermediate state!"
             logger.error(msg, exc_info=ex2)
@@ -73,45 +649,120 @@ def create_volume(pool_name, volume_name, fs_type, mirror_disk, volume_size, mou
         logger.warn("Failed to create volume!", exc_info=ex)
         raise kopf.TemporaryError(f"Error creating volume: {repr(ex)}")
 
-def resize_volume(pool_name, volume_name, volume_size, new_volume_size):
-    formatted_volume_size = volume_size.replace("Ki", "K").replace("Mi", "M").replace("Gi", "G").lower()
-    new_formatted_volume_size = new_volume_size.replace("Ki", "K").replace("Mi", "M").replace("Gi", "G").lower()
-    block_device = f"/dev/{pool_name}/{volume_name}"
+@tracing.traced("lvm.rename_volume")
+async def rename_volume(pool_name, volume_name, new_name, fs_type, mount_point=None, mount_options=None):
+    """Rename an existing formatted volume and optionally mount it under its new name"""
+    block_device = f"/dev/{pool_name}/{new_name}"
+    await util.run_process_async("lvrename", pool_name, volume_name, new_name)
+
+    with inventory_lock:
+        if logical_volumes is not None:
+            entry = logical_volumes.pop((pool_name, volume_name), None)
+            if entry:
+                logical_volumes[(pool_name, new_name)] = entry
+
+    unroll = []
+    try:
+        # udev recreates the device link under the new name
+        with tracing.span("wait_for_device"):
+            await util.wait_for_device(block_device, config.get().device_timeout)
 
-    def name_to_bytes(name):
-        extracted = int(name[:-1])
-        if "k" in name:
-            return 1024 * extracted
-        if "m" in name:
-            return 1024 * 1024 * extracted
-        if "g" in name:
-            return 1024 * 1024 * 1024 * extracted
+        if mount_point:
+            await _mount_volume(block_device, mount_point, fs_type, unroll, mount_options)
+    except Exception:
+        if "fstab" in unroll:
+            await asyncio.to_thread(fstab.remove_entry, mount_point)
+        if "mount" in unroll:
+            await util.run_process_async("umount", mount_point)
+        if "mkdir" in unroll:
+            os.rmdir(mount_point)
+
+        await util.run_process_async("lvrename", pool_name, new_name, volume_name)
+        await asyncio.to_thread(refresh_inventory)
+        raise
+
+@tracing.traced("lvm.resize_volume")
+async def resize_volume(pool_name, volume_name, volume_size, new_volume_size, cache=None, layout=None):
+    formatted_volume_size = format_volume_size(volume_size)
+    new_formatted_volume_size = format_volume_size(new_volume_size)
+    block_device = f"/dev/{pool_name}/{volume_name}"
 
     try:
-        report = json.loads(" ".join(util.run_process("vgs", "vg-kube", "--units", "b", "--reportformat", "json")))
+        volume = await asyncio.to_thread(get_volume, pool_name, volume_name)
     except Exception as ex:
         logger.warn("Failed to get remaining space!", exc_info=ex)
         raise kopf.TemporaryError(f"Failed to retrieve remaining space in the volume group: {repr(ex)}")
 
-    remaining_bytes = int(report["report"]["vg"][0]["vg_free"][:-1])
-    increased_bytes = name_to_bytes(new_formatted_volume_size) - name_to_bytes(formatted_volume_size)
+    # striped volumes are extended by whole extents on every stripe
+    new_bytes = await asyncio.to_thread(_align_size, pool_name, size_to_bytes(new_formatted_volume_size), layout)
+    extend_size = f"{new_bytes}b" if layout else new_formatted_volume_size
 
-    if increased_bytes < 0:
-        raise kopf.PermenentError("The new volume size must be larger than the current volume size.")
+    increased_bytes = size_to_bytes(new_formatted_volume_size) - size_to_bytes(formatted_volume_size)
+
+    if volume and volume["origin"] and not volume["pool"]:
+        raise kopf.PermanentError(f"{pool_name}/{volume_name} is a classic snapshot and can't be resized")
 
-    if increased_bytes > remaining_bytes:
-        raise kopf.PermenentError(f"Cannot increase size of volume from {volume_size} to {new_volume_size}. There is insufficent disk space!")
+    if increased_bytes < 0:
+        raise kopf.PermanentError("The new volume size must be larger than the current volume size.")
+
+    resize_reserved_bytes = thin_reserved_bytes = 0
+    if volume and volume["pool"]:
+        # thin volumes only grow their virtual size
+        thin_reserved_bytes = increased_bytes
+        await asyncio.to_thread(reserve_thin_pool_space, pool_name, volume["pool"], thin_reserved_bytes)
+    else:
+        # the volume can already be bigger than requested when it was aligned or resized before
+        current_bytes = volume["size"] if volume else size_to_bytes(formatted_volume_size)
+        resize_reserved_bytes = _raw_bytes(max(new_bytes - current_bytes, 0), layout)
+        await asyncio.to_thread(reserve_space, pool_name, resize_reserved_bytes)
+
+    # the cache is taken off while the volume is extended and put back afterwards, sized for the new volume
+    cached = volume and volume["segtype"] == "cache"
 
     try:
-        util.run_process("lvextend", "--size", new_formatted_volume_size, "--resizefs", block_device)
+        if cached:
+            await _detach_cache(pool_name, volume_name)
+        # raid volumes keep their layout on their own
+        extend_args = _stripe_args(layout) if layout and not layout["raid"] else []
+        extend_cmd = [ "lvextend", "--size", extend_size, *extend_args, "--resizefs", block_device ]
+        if cache:
+            # keep the volume itself off of the cache disk
+            extend_cmd.extend(pv for pv in await asyncio.to_thread(get_physical_volumes, pool_name) if pv != cache["pv"])
+        await util.run_process_async(*extend_cmd)
     except Exception as ex:
         logger.warn("Failed to resize the volume!", exc_info=ex)
+        await asyncio.to_thread(release_space, pool_name, resize_reserved_bytes)
+        if thin_reserved_bytes:
+            await asyncio.to_thread(release_thin_pool_space, pool_name, volume["pool"], thin_reserved_bytes)
+        invalidate_inventory()
         raise kopf.TemporaryError(f"Error resizing volume: {repr(ex)}")
 
-def unmount_volume(mount_point, pool_name, volume_name):
+    if thin_reserved_bytes:
+        await asyncio.to_thread(release_thin_pool_space, pool_name, volume["pool"], thin_reserved_bytes, volume_name)
+    else:
+        await asyncio.to_thread(release_space, pool_name, resize_reserved_bytes, volume_name)
+
+    if cache:
+        cache_bytes = _cache_bytes(size_to_bytes(new_formatted_volume_size), cache)
+        cache_reserved_bytes = 0
+        try:
+            # the new cache pool can be bigger than the old one, so its space is reserved like on create
+            await asyncio.to_thread(reserve_space, pool_name, cache_bytes)
+            cache_reserved_bytes = cache_bytes
+            await _attach_cache(pool_name, volume_name, size_to_bytes(new_formatted_volume_size), cache)
+        except Exception as ex:
+            logger.warn(f"Failed to re-attach the cache of {pool_name}/{volume_name}. It will stay uncached.", exc_info=ex)
+            invalidate_inventory()
+        finally:
+            await asyncio.to_thread(release_space, pool_name, cache_reserved_bytes)
+    elif cached:
+        logger.warning(f"{pool_name}/{volume_name} was cached but its storage class has no cache settings anymore. It will stay uncached.")
+
+@tracing.traced("lvm.unmount_volume")
+async def unmount_volume(mount_point, pool_name, volume_name):
     # unmount right now
     try:
-        util.run_process("umount", mount_point)
+        await util.run_process_async("umount", mount_point)
     except:
         pass
 
@@ -121,48 +772,55 @@ def unmount_volume(mount_point, pool_name, volume_name):
     except:
         pass
     
-    # remove any entires in fstab
-    block_device = f"/dev/{pool_name}/{volume_name}"
+    # remove the entry in fstab
+    await asyncio.to_thread(fstab.remove_entry, mount_point)
 
-    with open("/app/hostetc/fstab", "r") as f:
-        lines = f.readlines()
+def get_classic_snapshots(pool_name, volume_name):
+    with inventory_lock:
+        _ensure_inventory()
+        return [ lv_name for (vg_name, lv_name), entry in logical_volumes.items() if vg_name == pool_name and entry["origin"] == volume_name and not entry["pool"] ]
 
-    with open("/app/hostetc/fstab", "w") as f:
-        for line in lines:
-            if not line.lstrip().startswith(block_device):
-                f.write(line)
+@tracing.traced("lvm.delete_volume")
+async def delete_volume(pool_name, volume_name):
+    # lvremove takes classic snapshots down with their origin. thin snapshots are independent
+    snapshots = await asyncio.to_thread(get_classic_snapshots, pool_name, volume_name)
+    if snapshots:
+        raise kopf.TemporaryError(f"Cannot delete {pool_name}/{volume_name} while it has snapshots ({', '.join(snapshots)}). Delete them first.")
 
-def delete_volume(pool_name, volume_name):
     if config.get().allow_destructive_actions:
-        util.run_process("lvremove", f"{pool_name}/{volume_name}", "--yes")
+        volume = await asyncio.to_thread(get_volume, pool_name, volume_name)
+        if volume and volume["segtype"] == "cache":
+            await _detach_cache(pool_name, volume_name)
+
+        await util.run_process_async("lvremove", f"{pool_name}/{volume_name}", "--yes")
+        await asyncio.to_thread(forget_volume, pool_name, volume_name)
 
-def import_volume(pool_name, volume_name, mount_point=None):
+@tracing.traced("lvm.import_volume")
+async def import_volume(pool_name, volume_name, mount_point=None, mount_options=None):
     if volume_name is None and config.get().import_mode:
         raise kopf.TemporaryError(f"Cannot create volume because import mode is enabled!")
     
-    if not volume_exists(pool_name, volume_name):
+    # volumes to import were created outside of LabDisk so make sure the inventory is current
+    if not await asyncio.to_thread(volume_exists, pool_name, volume_name):
+        await asyncio.to_thread(refresh_inventory)
+
+    if not await asyncio.to_thread(volume_exists, pool_name, volume_name):
         raise kopf.PermanentError(f"Cannot find lvm volume to import named '{volume_name}'")
     
     if mount_point:
         unroll = []
         block_device = f"/dev/{pool_name}/{volume_name}"
-        fs_type = util.run_process("blkid", "-o", "value", "-s", "TYPE", block_device)
+        await util.wait_for_device(block_device, config.get().device_timeout)
+        fs_type = (await util.run_process_async("blkid", "-o", "value", "-s", "TYPE", block_device))[0]
         try:
-            os.makedirs(mount_point, exist_ok=True)
-            unroll.append("mkdir")
-
-            util.run_process("mount", "-t", fs_type, block_device, mount_point)
-            unroll.append("mount")
-
-            # save our mount
-            options = f"defaults,noatime"
-            with open("/app/hostetc/fstab", "a") as f:
-                f.write(f"{block_device} {mount_point} {fs_type} {options} 0 0\n") # dump and fsck disabled
+            await _mount_volume(block_device, mount_point, fs_type, unroll, mount_options)
 
         except Exception as ex:
             try:
+                if "fstab" in unroll:
+                    await asyncio.to_thread(fstab.remove_entry, mount_point)
                 if "mount" in unroll:
-                    util.run_process("umount", mount_point)
+                    await util.run_process_async("umount", mount_point)
                 
                 if "mkdir" in unroll:
                     os.rmdir(mount_point)
@@ -174,4 +832,187 @@ def import_volume(pool_name, volume_name, mount_point=None):
             logger.warn("Failed to create volume!", exc_info=ex)
             raise kopf.TemporaryError(f"Error creating volume: {repr(ex)}")
     
-    return volume_name
\ No newline at end of file
+    return volume_name
+
+def get_mounted_devices(mounts):
+    """Map the device node of every mounted block device to its mount points. Volumes show up as
+    /dev/mapper/<vg>-<lv> in the mount table so both sides are resolved to the dm device first."""
+    result = {}
+    for mount_point, (source, _, _) in mounts.items():
+        if source.startswith("/dev/"):
+            result.setdefault(os.path.realpath(source), set()).add(mount_point)
+    return result
+
+def is_mounted(pool_name, volume_name, mount_point, mounted_devices):
+    return mount_point in mounted_devices.get(os.path.realpath(f"/dev/{pool_name}/{volume_name}"), ())
+
+@tracing.traced("lvm.remount_volume")
+async def remount_volume(pool_name, volume_name, mount_point, mount_options=None):
+    """Mount an existing volume again, ex: when its fstab entry was lost or the mount failed on boot"""
+    block_device = f"/dev/{pool_name}/{volume_name}"
+    await util.wait_for_device(block_device, config.get().device_timeout)
+    fs_type = (await util.run_process_async("blkid", "-o", "value", "-s", "TYPE", block_device))[0]
+
+    unroll = []
+    try:
+        await _mount_volume(block_device, mount_point, fs_type, unroll, mount_options)
+    except Exception:
+        if "fstab" in unroll:
+            await asyncio.to_thread(fstab.remove_entry, mount_point)
+        if "mount" in unroll:
+            await util.run_process_async("umount", mount_point)
+        raise
+
+@tracing.traced("lvm.snapshot_volume")
+async def snapshot_volume(pool_name, volume_name, snapshot_name):
+    """Take a point in time snapshot of a volume. Thin volumes get a thin snapshot in the same pool.
+    Other volumes get a classic snapshot with snapshot_reserve_percent of their size set aside for changes."""
+    if await asyncio.to_thread(volume_exists, pool_name, snapshot_name):
+        return
+
+    origin = await asyncio.to_thread(get_volume, pool_name, volume_name)
+    if origin is None:
+        raise kopf.PermanentError(f"Cannot find volume {pool_name}/{volume_name} to snapshot")
+    if origin["origin"] and not origin["pool"]:
+        raise kopf.PermanentError(f"{pool_name}/{volume_name} is a classic snapshot and can't be snapshotted")
+
+    snapshot_cmd = [ "lvcreate", "--snapshot", "--setactivationskip", "n", "--name", snapshot_name, f"{pool_name}/{volume_name}" ]
+    snapshot_bytes = 0
+    if not origin["pool"]:
+        snapshot_bytes = int(origin["size"] * config.get().snapshot_reserve_percent / 100)
+        snapshot_cmd[1:1] = [ "--size", f"{snapshot_bytes}b" ]
+        await asyncio.to_thread(reserve_space, pool_name, snapshot_bytes)
+
+    try:
+        await util.run_process_async(*snapshot_cmd)
+    except Exception as ex:
+        logger.warn("Failed to snapshot volume!", exc_info=ex)
+        await asyncio.to_thread(release_space, pool_name, snapshot_bytes)
+        invalidate_inventory()
+        raise kopf.TemporaryError(f"Error creating snapshot: {repr(ex)}")
+
+    await asyncio.to_thread(release_space, pool_name, snapshot_bytes, snapshot_name)
+
+async def _regenerate_xfs_uuid(block_device):
+    """Give a cloned xfs filesystem its own UUID so it can be mounted next to its source.
+    Mounting once replays the log, which xfs_admin requires to be clean."""
+    with tempfile.TemporaryDirectory() as mount_point:
+        await util.run_process_async("mount", "-t", "xfs", "-o", "nouuid", block_device, mount_point)
+        await util.run_process_async("umount", mount_point)
+
+    await util.run_process_async("xfs_admin", "-U", "generate", block_device)
+
+@tracing.traced("lvm.clone_volume")
+async def clone_volume(pool_name, source_name, volume_name, volume_size, mount_point=None, mount_options=None):
+    """Create a volume with the contents of another volume or snapshot and return its filesystem type.
+    Thin sources are cloned with a thin snapshot, which is instant. Other sources are copied block by block,
+    which takes O(size), from a temporary classic snapshot if the source is not a snapshot itself, so the source can stay in use."""
+    source = await asyncio.to_thread(get_volume, pool_name, source_name)
+    if source is None:
+        raise kopf.PermanentError(f"Cannot find volume {pool_name}/{source_name} to clone")
+
+    requested_bytes = size_to_bytes(format_volume_size(volume_size))
+    if requested_bytes < source["size"]:
+        raise kopf.PermanentError(f"The clone of {source_name} must be at least as large as its source ({source['size']} bytes)")
+
+    source_device = f"/dev/{pool_name}/{source_name}"
+    block_device = f"/dev/{pool_name}/{volume_name}"
+    fs_type = (await util.run_process_async("blkid", "-o", "value", "-s", "TYPE", source_device))[0]
+
+    if await asyncio.to_thread(volume_exists, pool_name, volume_name):
+        return fs_type
+
+    unroll = []
+    copy_source = f"{volume_name}-source"
+
+    # clones are created at the size of their source and extended to the requested size at the end
+    clone_reserved_bytes = thin_reserved_bytes = 0
+    if source["pool"]:
+        thin_reserved_bytes = requested_bytes
+        await asyncio.to_thread(reserve_thin_pool_space, pool_name, source["pool"], thin_reserved_bytes)
+    else:
+        clone_reserved_bytes = requested_bytes
+        await asyncio.to_thread(reserve_space, pool_name, clone_reserved_bytes)
+
+    try:
+        if source["pool"]:
+            await snapshot_volume(pool_name, source_name, volume_name)
+            unroll.append("lvcreate")
+            await asyncio.to_thread(release_thin_pool_space, pool_name, source["pool"], source["size"], volume_name)
+            thin_reserved_bytes -= source["size"]
+        else:
+            await util.run_process_async("lvcreate", "--zero", "n", "--size", f"{source['size']}b", "--name", volume_name, pool_name)
+            unroll.append("lvcreate")
+            await asyncio.to_thread(release_space, pool_name, source["size"], volume_name)
+            clone_reserved_bytes -= source["size"]
+
+            # copy from a snapshot so the data is consistent while the source is in use
+            if not source["origin"]:
+                await snapshot_volume(pool_name, source_name, copy_source)
+                unroll.append("snapshot")
+                source_device = f"/dev/{pool_name}/{copy_source}"
+
+            with tracing.span("wait_for_device"):
+                await util.wait_for_device(block_device, config.get().device_timeout)
+                await util.wait_for_device(source_device, config.get().device_timeout)
+
+            # the copy takes as long as the volume is big, so it gets more time than other commands
+            copy_timeout = max(util.process_timeout or 0, source["size"] / CLONE_COPY_MIN_RATE)
+            await util.run_process_async("dd", f"if={source_device}", f"of={block_device}", "bs=4M", "iflag=direct", "oflag=direct", "conv=fsync", "status=none", timeout=copy_timeout)
+
+            if "snapshot" in unroll:
+                await util.run_process_async("lvremove", f"{pool_name}/{copy_source}", "--yes")
+                await asyncio.to_thread(forget_volume, pool_name, copy_source)
+                unroll.remove("snapshot")
+
+        with tracing.span("wait_for_device"):
+            await util.wait_for_device(block_device, config.get().device_timeout)
+
+        if fs_type == "xfs":
+            await _regenerate_xfs_uuid(block_device)
+
+        if mount_point:
+            await _mount_volume(block_device, mount_point, fs_type, unroll, mount_options)
+
+        if requested_bytes > source["size"]:
+            await util.run_process_async("lvextend", "--size", f"{requested_bytes}b", "--resizefs", block_device)
+            if source["pool"]:
+                await asyncio.to_thread(release_thin_pool_space, pool_name, source["pool"], thin_reserved_bytes, volume_name)
+                thin_reserved_bytes = 0
+            else:
+                await asyncio.to_thread(release_space, pool_name, clone_reserved_bytes, volume_name)
+                clone_reserved_bytes = 0
+
+    except Exception as ex:
+        await asyncio.to_thread(release_space, pool_name, clone_reserved_bytes)
+        if thin_reserved_bytes:
+            await asyncio.to_thread(release_thin_pool_space, pool_name, source["pool"], thin_reserved_bytes)
+
+        try:
+            if "fstab" in unroll:
+                await asyncio.to_thread(fstab.remove_entry, mount_point)
+            if "mount" in unroll:
+                await util.run_process_async("umount", mount_point)
+
+            if "mkdir" in unroll:
+                os.rmdir(mount_point)
+
+            # the temporary snapshot holds no data of its own
+            if "snapshot" in unroll:
+                await util.run_process_async("lvremove", f"{pool_name}/{copy_source}", "--yes")
+                await asyncio.to_thread(forget_volume, pool_name, copy_source)
+
+            if "lvcreate" in unroll and config.get().allow_destructive_actions:
+                await util.run_process_async("lvremove", f"{pool_name}/{volume_name}", "--yes")
+                await asyncio.to_thread(forget_volume, pool_name, volume_name)
+        except Exception as ex2:
+            msg = "Fatal Error encountered unrolling volume clone. Disk will be left in a intermediate state!"
+            logger.error(msg, exc_info=ex2)
+            raise kopf.PermanentError(msg)
+
+        if isinstance(ex, kopf.PermanentError):
+            raise
+        logger.warn("Failed to clone volume!", exc_info=ex)
+        raise kopf.TemporaryError(f"Error cloning volume: {repr(ex)}")
+
+    return fs_type
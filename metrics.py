@@ -0,0 +1,193 @@
+import logging
+import time
+import functools
+
+from prometheus_client import Counter, Gauge, Histogram, start_http_server, REGISTRY
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
+
+logger = logging.getLogger(__name__)
+
+HANDLER_DURATION = Histogram(
+    "labdisk_handler_duration_seconds",
+    "Time spent running a LabDisk handler",
+    [ "handler" ],
+    buckets=(0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+)
+
+HANDLER_FAILURES = Counter(
+    "labdisk_handler_failures_total",
+    "Number of LabDisk handler invocations that raised an error",
+    [ "handler" ]
+)
+
+HANDLERS_IN_PROGRESS = Gauge(
+    "labdisk_handlers_in_progress",
+    "Number of LabDisk handler invocations currently running or waiting for an operation slot",
+    [ "handler" ]
+)
+
+PROCESS_DURATION = Histogram(
+    "labdisk_process_duration_seconds",
+    "Time spent running external commands",
+    [ "command" ],
+    buckets=(0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+)
+
+PROCESS_FAILURES = Counter(
+    "labdisk_process_failures_total",
+    "Number of external commands that exited with an error or timed out",
+    [ "command" ]
+)
+
+def observe_process(command, duration, failed):
+    PROCESS_DURATION.labels(command).observe(duration)
+    if failed:
+        PROCESS_FAILURES.labels(command).inc()
+
+def handlers_in_progress():
+    """Number of handler invocations running on this instance right now"""
+    return int(sum(sample.value for metric in HANDLERS_IN_PROGRESS.collect() for sample in metric.samples))
+
+def timed(handler_name):
+    """Record the latency (and failures) of an async handler"""
+    def decorator(fn):
+        @functools.wraps(fn)
+        async def wrapper(*args, **kwargs):
+            start_time = time.monotonic()
+            try:
+                with HANDLERS_IN_PROGRESS.labels(handler_name).track_inprogress():
+                    return await fn(*args, **kwargs)
+            except Exception:
+                HANDLER_FAILURES.labels(handler_name).inc()
+                raise
+            finally:
+                HANDLER_DURATION.labels(handler_name).observe(time.monotonic() - start_time)
+
+        return wrapper
+    return decorator
+
+class StorageCollector:
+    """Reports the storage state of this node from the in-memory lvm, nfs, and iscsi indexes on every scrape"""
+
+    def collect(self):
+        # imported here since those modules depend on util, which depends on this module
+        import lvm
+        import nfs
+        import iscsi
+        import nfsd
+        import warmpool
+
+        vg_size = GaugeMetricFamily("labdisk_volume_group_size_bytes", "Total size of the volume group", labels=[ "volume_group" ])
+        vg_free = GaugeMetricFamily("labdisk_volume_group_free_bytes", "Unallocated space in the volume group", labels=[ "volume_group" ])
+        vg_reserved = GaugeMetricFamily("labdisk_volume_group_reserved_bytes", "Free space in the volume group set aside for volumes being created or resized", labels=[ "volume_group" ])
+        lv_count = GaugeMetricFamily("labdisk_logical_volumes", "Number of logical volumes in the volume group", labels=[ "volume_group" ])
+
+        with lvm.inventory_lock:
+            volume_groups = dict(lvm.volume_groups or {})
+            logical_volumes = { key: dict(entry) for key, entry in (lvm.logical_volumes or {}).items() }
+            reserved_bytes = dict(lvm.reserved_bytes)
+
+        for vg_name, group in volume_groups.items():
+            vg_size.add_metric([ vg_name ], group["size"])
+            vg_free.add_metric([ vg_name ], group["free"])
+            vg_reserved.add_metric([ vg_name ], reserved_bytes.get(vg_name, 0))
+            lv_count.add_metric([ vg_name ], len([ key for key in logical_volumes if key[0] == vg_name ]))
+
+        yield vg_size
+        yield vg_free
+        yield vg_reserved
+        yield lv_count
+
+        thin_data = GaugeMetricFamily("labdisk_thin_pool_data_percent", "Data usage of the thin pool", labels=[ "volume_group", "thin_pool" ])
+        thin_metadata = GaugeMetricFamily("labdisk_thin_pool_metadata_percent", "Metadata usage of the thin pool", labels=[ "volume_group", "thin_pool" ])
+        thin_allocated = GaugeMetricFamily("labdisk_thin_pool_allocated_bytes", "Total virtual size of the thin volumes in the thin pool", labels=[ "volume_group", "thin_pool" ])
+
+        allocated = {}
+        for (vg_name, _), volume in logical_volumes.items():
+            if volume["pool"]:
+                allocated[(vg_name, volume["pool"])] = allocated.get((vg_name, volume["pool"]), 0) + volume["size"]
+
+        for (vg_name, lv_name), volume in logical_volumes.items():
+            if volume["segtype"] != "thin-pool":
+                continue
+
+            thin_data.add_metric([ vg_name, lv_name ], volume["data_percent"] or 0)
+            thin_metadata.add_metric([ vg_name, lv_name ], volume["metadata_percent"] or 0)
+            thin_allocated.add_metric([ vg_name, lv_name ], allocated.get((vg_name, lv_name), 0))
+
+        yield thin_data
+        yield thin_metadata
+        yield thin_allocated
+
+        spares = GaugeMetricFamily("labdisk_warm_pool_spares", "Number of ready spare volumes in the warm pool", labels=[ "volume_group", "filesystem", "size_bytes", "profile" ])
+        spare_targets = GaugeMetricFamily("labdisk_warm_pool_target", "Number of spare volumes the warm pool is kept filled to", labels=[ "volume_group", "filesystem", "size_bytes", "profile" ])
+        for (vg_name, thin_pool, fs_type, size_bytes, mkfs_options), count in list(warmpool.targets.items()):
+            profile = warmpool.spare_profile(mkfs_options)
+            prefix = f"{warmpool.SPARE_PREFIX}-{fs_type}-{size_bytes}-{profile}-"
+            ready = len([ lv_name for (vg, lv_name), entry in logical_volumes.items() if vg == vg_name and lv_name.startswith(prefix) and entry["pool"] == thin_pool ])
+            spares.add_metric([ vg_name, fs_type, str(size_bytes), profile ], ready)
+            spare_targets.add_metric([ vg_name, fs_type, str(size_bytes), profile ], count)
+
+        yield spares
+        yield spare_targets
+
+        with lvm.inventory_lock:
+            cache_stats = dict(lvm.cache_stats)
+            raid_status = dict(lvm.raid_status)
+
+        raid_sync = GaugeMetricFamily("labdisk_raid_sync_percent", "How much of a raid volume is in sync", labels=[ "volume_group", "volume", "type", "action" ])
+        raid_degraded = GaugeMetricFamily("labdisk_raid_degraded", "1 if a raid volume is missing a disk or has a failed disk", labels=[ "volume_group", "volume", "type" ])
+        raid_mismatches = GaugeMetricFamily("labdisk_raid_mismatches", "Number of mismatches the last scrub of a raid volume found", labels=[ "volume_group", "volume", "type" ])
+        for (vg_name, lv_name), volume in raid_status.items():
+            raid_sync.add_metric([ vg_name, lv_name, volume["type"], volume["sync_action"] ], volume["sync_percent"] or 0)
+            raid_degraded.add_metric([ vg_name, lv_name, volume["type"] ], 1 if volume["degraded"] else 0)
+            raid_mismatches.add_metric([ vg_name, lv_name, volume["type"] ], volume["mismatches"])
+
+        yield raid_sync
+        yield raid_degraded
+        yield raid_mismatches
+
+        cache_hits = CounterMetricFamily("labdisk_cache_hits", "Number of reads and writes served by the cache of a volume", labels=[ "volume_group", "volume", "operation" ])
+        cache_misses = CounterMetricFamily("labdisk_cache_misses", "Number of reads and writes that went to the origin disks of a cached volume", labels=[ "volume_group", "volume", "operation" ])
+        cache_used = GaugeMetricFamily("labdisk_cache_used_blocks", "Number of cache blocks in use", labels=[ "volume_group", "volume", "mode" ])
+        cache_dirty = GaugeMetricFamily("labdisk_cache_dirty_blocks", "Number of cache blocks that have not been written to the origin disks yet", labels=[ "volume_group", "volume", "mode" ])
+        cache_total = GaugeMetricFamily("labdisk_cache_total_blocks", "Size of the cache in blocks", labels=[ "volume_group", "volume", "mode" ])
+        for (vg_name, lv_name), cache in cache_stats.items():
+            for operation in [ "read", "write" ]:
+                cache_hits.add_metric([ vg_name, lv_name, operation ], cache[f"{operation}_hits"])
+                cache_misses.add_metric([ vg_name, lv_name, operation ], cache[f"{operation}_misses"])
+            cache_used.add_metric([ vg_name, lv_name, cache["mode"] ], cache["used_blocks"])
+            cache_dirty.add_metric([ vg_name, lv_name, cache["mode"] ], cache["dirty_blocks"])
+            cache_total.add_metric([ vg_name, lv_name, cache["mode"] ], cache["total_blocks"])
+
+        yield cache_hits
+        yield cache_misses
+        yield cache_used
+        yield cache_dirty
+        yield cache_total
+
+        with nfs.export_table_lock:
+            exports = len(nfs.export_table or ())
+        yield GaugeMetricFamily("labdisk_nfs_exports", "Number of exported NFS shares", value=exports)
+
+        if nfsd.current_threads is not None:
+            yield GaugeMetricFamily("labdisk_nfsd_threads", "Number of kernel nfsd threads", value=nfsd.current_threads)
+        if nfsd.queued_ratio is not None:
+            yield GaugeMetricFamily("labdisk_nfsd_queued_ratio", "Share of NFS requests that waited for a free nfsd thread in the last sample", value=nfsd.queued_ratio)
+            yield GaugeMetricFamily("labdisk_nfsd_requests_per_second", "Rate of NFS requests in the last sample", value=nfsd.rpc_rate)
+
+        with iscsi.lun_index_lock:
+            lun_count = len(iscsi.used_lun_indexes)
+            mapped_luns = { initiator: len(mapped) for initiator, mapped in iscsi.mapped_luns_by_acl.items() }
+
+        yield GaugeMetricFamily("labdisk_iscsi_luns", "Number of LUNs on the iSCSI target", value=lun_count)
+
+        mapped_lun_count = GaugeMetricFamily("labdisk_iscsi_mapped_luns", "Number of LUNs mapped for an initiator", labels=[ "initiator" ])
+        for initiator, count in mapped_luns.items():
+            mapped_lun_count.add_metric([ initiator ], count)
+        yield mapped_lun_count
+
+def start_metrics_server(port):
+    REGISTRY.register(StorageCollector())
+    start_http_server(port)
+    logger.info(f"Serving metrics on port {port}")
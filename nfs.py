@@ -1,61 +1,163 @@
 import logging
 import re
 import subprocess
+import threading
 
 import kubernetes
 
-import config
 from config import Constants
 import util
+import tracing
 
 logger = logging.getLogger(__name__)
 
-def get_exported_filesystems():
-    cur_node = config.get().current_node_ip
-    logger.debug(f"Listing mounts on {cur_node}")
-    mounts = util.run_process("showmount", "--no-headers", "-e", cur_node)
-
-    result = []
-    for line in mounts:
-        found = re.findall(r"(.*?)[^\S]+(\d.*)", line)
-        if len(found) == 1:
-            mount, clients = found[0]
-            split_clients = clients.split(",")
-            result.extend([(mount, client) for client in split_clients])
-        else:
-            raise RuntimeError(f"failed to parse mount: {line}")
-
-    logger.debug(f"Got mounts: {result}")
-    
+ETAB_PATH = "/var/lib/nfs/etab"
+VOLUME_ROOT = "/srv/nfs"
+
+# indexed view of the kernel export table as (path, client) pairs. loaded from etab and
+# kept up to date in place after each successful exportfs call
+export_table_lock = threading.Lock()
+export_table = None
+
+def read_export_table():
+    result = set()
+    with open(ETAB_PATH, "r") as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+
+            found = re.findall(r"(\S+)\s+([^\s(]+)\(", line)
+            if len(found) == 1:
+                path, client = found[0]
+                # etab escapes whitespace in paths as octal sequences (ex: \040)
+                path = re.sub(r"\\([0-7]{3})", lambda m: chr(int(m.group(1), 8)), path)
+                result.add((path, client))
+            else:
+                raise RuntimeError(f"failed to parse export: {line}")
+
     return result
 
-def export_share(mount, client):
+def refresh_exported_filesystems():
+    global export_table
+
+    table = read_export_table()
+    with export_table_lock:
+        export_table = table
+
+    logger.debug(f"Loaded {len(table)} exports from {ETAB_PATH}")
+    return table
+
+def get_exported_filesystems():
+    with export_table_lock:
+        table = export_table
+
+    if table is None:
+        table = refresh_exported_filesystems()
+
+    return table
+
+# export options that can't be combined
+CONFLICTING_EXPORT_OPTIONS = [ ("sync", "async"), ("rw", "ro"), ("wdelay", "no_wdelay"), ("root_squash", "no_root_squash"), ("secure", "insecure") ]
+
+def validate_export_options(value):
+    """Check the nfs_export_options storage class parameter and return the options to export with"""
+    options = value or Constants.NFS_MOUNT_FLAGS
+    names = set()
+    for option in options.split(","):
+        if not re.match(r"^[A-Za-z0-9_=:.@/-]+$", option):
+            raise ValueError(f"invalid export option '{option}'")
+        names.add(option.split("=")[0])
+
+    # every volume of the storage class is exported with the same options
+    if "fsid" in names:
+        raise ValueError("fsid has to be unique per export so it can't be set on a storage class")
+
+    for first, second in CONFLICTING_EXPORT_OPTIONS:
+        if first in names and second in names:
+            raise ValueError(f"export options '{first}' and '{second}' conflict")
+
+    return options
+
+@tracing.traced("nfs.export_share")
+async def export_share(mount, client, options=None):
     if (mount, client) in get_exported_filesystems():
         return # share already mounted
 
     logger.info(f"Exporting fs '{mount}'")
     try:
-        util.run_process("exportfs", "-o", Constants.NFS_MOUNT_FLAGS, f"{client}:{mount}")
+        await util.run_process_async("exportfs", "-o", options or Constants.NFS_MOUNT_FLAGS, f"{client}:{mount}")
     except subprocess.CalledProcessError as ex:
         # exportfs doesn't like us running from inside a container
         # check after we exported it to see if to happened or not and then error out then
-        if ex.returncode == 1 and (mount, client) not in get_exported_filesystems():
+        if ex.returncode == 1 and (mount, client) not in refresh_exported_filesystems():
             raise ex
 
-def un_export_share(mount, client):
+    with export_table_lock:
+        export_table.add((mount, client))
+
+@tracing.traced("nfs.un_export_share")
+async def un_export_share(mount, client):
     if (mount, client) not in get_exported_filesystems():
         return # share already unmounted
 
     logger.info(f"Unmounting fs '{mount}'")
     try:
-        util.run_process("exportfs", "-u", f"{client}:{mount}")
+        await util.run_process_async("exportfs", "-u", f"{client}:{mount}")
     except subprocess.CalledProcessError as ex:
         # exportfs doesn't like us running from inside a container
         # check after we exported it to see if to happened or not and then error out then
-        if ex.returncode == 1 and (mount, client) in get_exported_filesystems():
+        if ex.returncode == 1 and (mount, client) in refresh_exported_filesystems():
             raise ex
 
+    with export_table_lock:
+        export_table.discard((mount, client))
+
+async def reconcile_exports(mounts, client):
+    """Bring every export under VOLUME_ROOT in line with the desired mounts, given as a
+    dict of mount -> export options (None for the default options).
+
+    Additions are applied in one exportfs invocation per set of options and removals in a
+    single one instead of one call per volume. Exports outside of VOLUME_ROOT are never touched.
+    Returns (added, removed, missing) where missing lists the mounts that failed to export.
+    """
+    desired = set((mount, client) for mount in mounts)
+    current = set(export for export in refresh_exported_filesystems() if export[0].startswith(f"{VOLUME_ROOT}/"))
+
+    to_add = sorted(desired - current)
+    to_remove = sorted(export for export in current - desired if export[1] == client)
+
+    if to_add:
+        logger.info(f"Exporting {len(to_add)} filesystems")
+        by_options = {}
+        for mount, client in to_add:
+            by_options.setdefault(mounts[mount] or Constants.NFS_MOUNT_FLAGS, []).append((mount, client))
+
+        for options, exports in by_options.items():
+            await _run_bulk_exportfs([ "-o", options ], exports)
+
+    if to_remove:
+        logger.info(f"Unexporting {len(to_remove)} stale filesystems")
+        await _run_bulk_exportfs([ "-u" ], to_remove)
+
+    # verify against the real table since exportfs may exit non-zero inside a container
+    table = refresh_exported_filesystems()
+    missing = [ mount for mount, client in to_add if (mount, client) not in table ]
+    if missing:
+        # one bad mount shouldn't keep every other volume from being exported
+        logger.error(f"Failed to export {len(missing)} filesystems: {', '.join(missing)}")
+
+    return len(to_add) - len(missing), len(to_remove), missing
+
+async def _run_bulk_exportfs(args, exports):
+    try:
+        await util.run_process_async("exportfs", *args, *[ f"{client}:{mount}" for mount, client in exports ])
+    except subprocess.CalledProcessError as ex:
+        # exportfs doesn't like us running from inside a container. the caller checks the result
+        if ex.returncode != 1:
+            raise ex
 
+@tracing.traced("nfs.create_persistent_volume")
 def create_persistent_volume(pv_name, node_name, access_modes, desired_capacity, nfs_server, volume_path, sc_name, volume_mode):
 
     pv = {
@@ -0,0 +1,113 @@
+import asyncio
+import logging
+import time
+
+import config
+
+logger = logging.getLogger(__name__)
+
+# the host's procfs, mounted into the container. the nfsd statistics are per network namespace
+# so they are read through the host's init process
+RPC_STATS_PATH = "/app/hostproc/1/net/rpc/nfsd"
+POOL_STATS_PATH = "/app/hostproc/fs/nfsd/pool_stats"
+THREADS_PATH = "/app/hostproc/fs/nfsd/threads"
+
+# number of quiet samples in a row before threads are removed again
+SCALE_DOWN_SAMPLES = 5
+
+# last sample, reported as metrics
+current_threads = None
+rpc_rate = None
+queued_ratio = None
+
+def read_stats():
+    """Read the thread count and the request counters of the kernel nfs server.
+
+    Returns (threads, requests, queued) where queued is the number of requests that had to
+    wait because every nfsd thread was busy. The per-pool counters are used when the kernel
+    has them since newer kernels always report 0 for the busy counter in the "th" line."""
+    threads = full_count = rpc_calls = None
+    with open(RPC_STATS_PATH, "r") as f:
+        for line in f:
+            fields = line.split()
+            if fields[0] == "th":
+                threads, full_count = int(fields[1]), int(fields[2])
+            elif fields[0] == "rpc":
+                rpc_calls = int(fields[1])
+
+    if threads is None or rpc_calls is None:
+        raise RuntimeError(f"failed to parse {RPC_STATS_PATH}")
+
+    try:
+        with open(POOL_STATS_PATH, "r") as f:
+            # pool packets-arrived sockets-enqueued threads-woken threads-timedout
+            pools = [ line.split() for line in f if not line.startswith("#") and line.strip() ]
+        return threads, sum(int(pool[1]) for pool in pools), sum(int(pool[2]) for pool in pools)
+    except FileNotFoundError:
+        return threads, rpc_calls, full_count
+
+def read_threads():
+    with open(THREADS_PATH, "r") as f:
+        return int(f.read().strip())
+
+def write_threads(count):
+    with open(THREADS_PATH, "w") as f:
+        f.write(f"{count}\n")
+
+def next_thread_count(threads, ratio, quiet_samples):
+    """Decide the thread count for the next interval. Threads are added as soon as requests
+    queue up but only removed after SCALE_DOWN_SAMPLES quiet samples so the count doesn't flap."""
+    cfg = config.get()
+    if ratio * 100 >= cfg.nfsd_scale_up_threshold:
+        threads += max(1, threads // 2)
+    elif quiet_samples >= SCALE_DOWN_SAMPLES:
+        threads -= max(1, threads // 4)
+
+    return min(max(threads, cfg.nfsd_min_threads), cfg.nfsd_max_threads)
+
+async def autoscale_threads(interval):
+    """Periodically resize the nfsd thread pool between nfsd_min_threads and nfsd_max_threads"""
+    global current_threads, rpc_rate, queued_ratio
+
+    last_sample = None
+    quiet_samples = 0
+    while True:
+        await asyncio.sleep(interval)
+
+        try:
+            threads, requests, queued = await asyncio.to_thread(read_stats)
+        except Exception as ex:
+            logger.warning("Failed to read nfsd statistics", exc_info=ex)
+            continue
+
+        sample = (time.monotonic(), requests, queued)
+        previous, last_sample = last_sample, sample
+        current_threads = threads
+
+        # writing a thread count would start the nfs server if it is stopped
+        if threads == 0 or previous is None or requests < previous[1] or queued < previous[2]:
+            quiet_samples = 0
+            continue
+
+        new_requests = requests - previous[1]
+        queued_ratio = (queued - previous[2]) / new_requests if new_requests else 0
+        rpc_rate = new_requests / (sample[0] - previous[0])
+
+        if queued_ratio * 100 <= config.get().nfsd_scale_down_threshold:
+            quiet_samples += 1
+        else:
+            quiet_samples = 0
+
+        target = next_thread_count(threads, queued_ratio, quiet_samples)
+        if target == threads:
+            continue
+
+        try:
+            await asyncio.to_thread(write_threads, target)
+            current_threads = await asyncio.to_thread(read_threads)
+        except Exception as ex:
+            logger.warning(f"Failed to set the nfsd thread count to {target}", exc_info=ex)
+            continue
+
+        quiet_samples = 0
+        logger.info(f"Changed nfsd threads from {threads} to {current_threads} ({queued_ratio:.1%} of {rpc_rate:.0f} requests/s waited for a thread)")
@@ -0,0 +1,116 @@
+import hashlib
+import json
+import logging
+import math
+import time
+
+import kubernetes
+
+import config
+from config import Constants
+import lvm
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# node name -> the capacity record that node published. kept current from the node watch
+node_capacity = {}
+# uid -> (namespace, name) of claims without a node that this instance could place
+unplaced_claims = {}
+
+def build_capacity_record():
+    """Capacity and load of this node as published on its Node object"""
+    cfg = config.get()
+    record = {
+        "updated": time.time(),
+        "shared": cfg.shared_volumes_enabled,
+        "operations": metrics.handlers_in_progress(),
+        "volume_groups": {},
+    }
+
+    if cfg.individual_volumes_enabled:
+        with lvm.inventory_lock:
+            lvm._ensure_inventory()
+            for vg_name, group in lvm.volume_groups.items():
+                volumes = len([ key for key in lvm.logical_volumes if key[0] == vg_name ])
+                record["volume_groups"][vg_name] = { "size": group["size"], "free": lvm.get_available_bytes(vg_name), "volumes": volumes }
+
+    return record
+
+def publish_capacity():
+    record = build_capacity_record()
+    core_api = kubernetes.client.CoreV1Api()
+    core_api.patch_node(config.get().current_node_name, { "metadata": { "annotations": { Constants.NODE_CAPACITY_ANNOTATION_KEY: json.dumps(record) } } })
+    node_capacity[config.get().current_node_name] = record
+
+def update_node(name, annotations):
+    value = (annotations or {}).get(Constants.NODE_CAPACITY_ANNOTATION_KEY)
+    if not value:
+        node_capacity.pop(name, None)
+        return
+
+    try:
+        node_capacity[name] = json.loads(value)
+    except ValueError as ex:
+        logger.warning(f"Ignoring invalid capacity published on node '{name}'", exc_info=ex)
+
+def forget_node(name):
+    node_capacity.pop(name, None)
+
+def _hash_fraction(claim_uid, node_name):
+    digest = hashlib.sha256(f"{claim_uid}/{node_name}".encode()).digest()
+    return (int.from_bytes(digest[:8], "big") + 1) / (2 ** 64 + 1)
+
+def score_nodes(claim_uid, sc_params, requested_bytes):
+    """Score every node that can take a claim. Uses weighted rendezvous hashing so every instance
+    scores a claim the same way, and claims spread out over the nodes in proportion to their free
+    space (divided by the operations already running there) instead of all going to the emptiest one."""
+    allowed_nodes = sc_params.get("nodes", "").split(",") if sc_params.get("nodes") else None
+    lvm_group = sc_params.get("lvm_group", config.get().lvm_group)
+    stale_time = time.time() - config.get().capacity_publish_interval * 3
+
+    scores = {}
+    for node_name, record in list(node_capacity.items()):
+        if allowed_nodes and node_name not in allowed_nodes:
+            continue
+        # the instance on that node stopped publishing. it can't provision anything
+        if record.get("updated", 0) < stale_time:
+            continue
+
+        if sc_params["type"] == Constants.VOLUME_TYPE_SHARED:
+            if not record.get("shared"):
+                continue
+            weight = 1.0
+        else:
+            group = record.get("volume_groups", {}).get(lvm_group)
+            if not group or (not sc_params.get("thin_pool") and group["free"] < requested_bytes):
+                continue
+            weight = float(group["free"] or 1)
+
+        weight /= 1 + record.get("operations", 0)
+        scores[node_name] = -weight / math.log(_hash_fraction(claim_uid, node_name))
+
+    return scores
+
+def choose_node(claim_uid, sc_params, requested_bytes):
+    scores = score_nodes(claim_uid, sc_params, requested_bytes)
+    if not scores:
+        return None
+    return max(scores, key=lambda node_name: (scores[node_name], node_name))
+
+def claim_for_node(name, namespace, resource_version, node_name):
+    """Assign a claim to a node. The patch only applies if nobody changed the claim since it was read,
+    so two instances can never both claim it. Returns False if another instance got there first."""
+    core_api = kubernetes.client.CoreV1Api()
+    try:
+        core_api.patch_namespaced_persistent_volume_claim(name, namespace, { "metadata": {
+            "resourceVersion": resource_version,
+            # without a diffbase the instance on that node sees the claim as created and provisions it
+            "annotations": { Constants.PVC_NODE_SELECTOR_ANNOTATION_KEY: node_name, Constants.LAST_HANDLED_ANNOTATION_KEY: None },
+        } })
+    except kubernetes.client.ApiException as ex:
+        if ex.status == 409:
+            return False
+        raise
+
+    return True
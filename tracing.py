@@ -0,0 +1,183 @@
+import asyncio
+import contextvars
+import functools
+import json
+import logging
+import queue
+import secrets
+import threading
+import time
+import urllib.request
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+slow_logger = logging.getLogger("labdisk.slow")
+
+# the trace (pvc uid) and span that the current handler is running under
+current_trace = contextvars.ContextVar("labdisk_trace", default=None)
+current_span = contextvars.ContextVar("labdisk_span", default=None)
+
+exporter = None
+slow_process_threshold = None
+
+class SpanExporter:
+    """Writes finished spans to a JSONL file and/or an OTLP/HTTP collector from a background thread"""
+
+    BATCH_SIZE = 256
+    FLUSH_INTERVAL = 2.0
+
+    def __init__(self, trace_file=None, otlp_endpoint=None, node_name=None):
+        self.trace_file = trace_file
+        self.otlp_endpoint = otlp_endpoint.rstrip("/") + "/v1/traces" if otlp_endpoint else None
+        self.node_name = node_name
+        self.spans = queue.Queue(maxsize=10000)
+        self.thread = threading.Thread(target=self._export_loop, name="trace-exporter", daemon=True)
+        self.thread.start()
+
+    def submit(self, span):
+        try:
+            self.spans.put_nowait(span)
+        except queue.Full:
+            logger.debug("Dropping span because the export queue is full")
+
+    def _export_loop(self):
+        while True:
+            batch = [ self.spans.get() ]
+            deadline = time.monotonic() + self.FLUSH_INTERVAL
+            while len(batch) < self.BATCH_SIZE:
+                try:
+                    batch.append(self.spans.get(timeout=max(0, deadline - time.monotonic())))
+                except queue.Empty:
+                    break
+
+            try:
+                if self.trace_file:
+                    self._write_file(batch)
+                if self.otlp_endpoint:
+                    self._send_otlp(batch)
+            except Exception as ex:
+                logger.warning(f"Failed to export {len(batch)} spans", exc_info=ex)
+
+    def _write_file(self, batch):
+        with open(self.trace_file, "a") as f:
+            for span in batch:
+                f.write(json.dumps(span) + "\n")
+
+    def _send_otlp(self, batch):
+        def attribute(key, value):
+            if isinstance(value, bool):
+                return { "key": key, "value": { "boolValue": value } }
+            if isinstance(value, int):
+                return { "key": key, "value": { "intValue": str(value) } }
+            return { "key": key, "value": { "stringValue": str(value) } }
+
+        spans = []
+        for span in batch:
+            otlp_span = {
+                "traceId": span["trace_id"],
+                "spanId": span["span_id"],
+                "name": span["name"],
+                "kind": 1,
+                "startTimeUnixNano": str(int(span["start"] * 1e9)),
+                "endTimeUnixNano": str(int(span["end"] * 1e9)),
+                "attributes": [ attribute(key, value) for key, value in span["attributes"].items() ],
+                "status": { "code": 2 if span["error"] else 1, "message": span["error"] or "" },
+            }
+            if span["parent_id"]:
+                otlp_span["parentSpanId"] = span["parent_id"]
+            spans.append(otlp_span)
+
+        body = {
+            "resourceSpans": [{
+                "resource": { "attributes": [ attribute("service.name", "labdisk"), attribute("host.name", self.node_name or "") ] },
+                "scopeSpans": [{ "scope": { "name": "labdisk" }, "spans": spans }],
+            }]
+        }
+
+        request = urllib.request.Request(self.otlp_endpoint, data=json.dumps(body).encode(), headers={ "Content-Type": "application/json" })
+        with urllib.request.urlopen(request, timeout=10):
+            pass
+
+def setup(trace_file=None, otlp_endpoint=None, node_name=None, slow_threshold=None, slow_log=None):
+    global exporter, slow_process_threshold
+
+    if trace_file or otlp_endpoint:
+        exporter = SpanExporter(trace_file, otlp_endpoint, node_name)
+        logger.info(f"Exporting traces to {trace_file or otlp_endpoint}")
+
+    slow_process_threshold = slow_threshold
+    if slow_log:
+        handler = logging.FileHandler(slow_log)
+        handler.setFormatter(logging.Formatter("%(asctime)s %(message)s"))
+        slow_logger.addHandler(handler)
+
+@contextmanager
+def trace(name, pvc_uid, **attributes):
+    """Start a new trace for an operation on a PVC. Every span started inside it is tagged with the PVC uid"""
+    token = current_trace.set(pvc_uid)
+    try:
+        with span(name, **attributes) as root_span:
+            yield root_span
+    finally:
+        current_trace.reset(token)
+
+@contextmanager
+def span(name, **attributes):
+    """Record a step of the current trace. Does nothing outside of a trace or if no exporter is configured"""
+    pvc_uid = current_trace.get()
+    if pvc_uid is None or exporter is None:
+        yield None
+        return
+
+    parent = current_span.get()
+    record = {
+        "trace_id": pvc_uid.replace("-", ""),
+        "span_id": secrets.token_hex(8),
+        "parent_id": parent["span_id"] if parent else None,
+        "name": name,
+        "start": time.time(),
+        "end": None,
+        "attributes": { "pvc.uid": pvc_uid, **attributes },
+        "error": None,
+    }
+
+    token = current_span.set(record)
+    try:
+        yield record
+    except BaseException as ex:
+        record["error"] = repr(ex)
+        raise
+    finally:
+        current_span.reset(token)
+        record["end"] = time.time()
+        exporter.submit(record)
+
+def traced(name):
+    """Record every call of a function (sync or async) as a span of the current trace"""
+    def decorator(fn):
+        if asyncio.iscoroutinefunction(fn):
+            @functools.wraps(fn)
+            async def async_wrapper(*args, **kwargs):
+                with span(name):
+                    return await fn(*args, **kwargs)
+            return async_wrapper
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def record_process(args, duration, exit_status):
+    """Log any command that took longer than the slow process threshold"""
+    if slow_process_threshold is None or duration < slow_process_threshold:
+        return
+
+    pvc_uid = current_trace.get()
+    slow_logger.warning(json.dumps({
+        "argv": list(args),
+        "exit_status": exit_status,
+        "duration": round(duration, 3),
+        "pvc_uid": pvc_uid,
+    }))
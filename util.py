@@ -1,17 +1,174 @@
+import asyncio
+import ctypes
+import ctypes.util
+import os
 import subprocess
 import logging
+import time
+from contextlib import contextmanager, suppress
 from kubernetes import client, config
 
+import metrics
+import tracing
+
 logger = logging.getLogger(__name__)
 
+# limits for processes started by run_process_async. set from the LabDisk config on startup
+process_timeout = None
+process_semaphore = None
+
+def setup_process_limits(max_concurrent_processes, timeout):
+    global process_timeout, process_semaphore
+    process_timeout = timeout
+    process_semaphore = asyncio.Semaphore(max_concurrent_processes) if max_concurrent_processes else None
+
+@contextmanager
+def measure_process(args):
+    """Record the duration, outcome, and trace span of a command. The caller fills in the exit status"""
+    result = { "exit_status": None }
+    start_time = time.monotonic()
+    with tracing.span(args[0], argv=" ".join(args)) as process_span:
+        try:
+            yield result
+        finally:
+            duration = time.monotonic() - start_time
+            metrics.observe_process(args[0], duration, failed=result["exit_status"] != 0)
+            tracing.record_process(args, duration, result["exit_status"])
+            if process_span is not None and result["exit_status"] is not None:
+                process_span["attributes"]["exit_status"] = result["exit_status"]
+
 def run_process(*args):
-    process = subprocess.run(args, 
-        stdout=subprocess.PIPE, 
-        universal_newlines=True,
-        check=True
-    )
+    with measure_process(args) as result:
+        try:
+            process = subprocess.run(args, 
+                stdout=subprocess.PIPE, 
+                universal_newlines=True,
+                check=True
+            )
+        except subprocess.CalledProcessError as ex:
+            result["exit_status"] = ex.returncode
+            raise
+
+        result["exit_status"] = 0
+        return process.stdout.splitlines()
+
+async def run_process_async(*args, timeout=None):
+    """Run a process without blocking the event loop and return its output lines.
+
+    Raises CalledProcessError (including the captured stderr) if the process fails and
+    TimeoutExpired if it runs longer than the timeout. The process is killed if it times
+    out or the calling task is cancelled.
+    """
+    if timeout is None:
+        timeout = process_timeout
+
+    if process_semaphore:
+        async with process_semaphore:
+            return await _run_process_async(args, timeout)
+
+    return await _run_process_async(args, timeout)
+
+async def _run_process_async(args, timeout):
+    with measure_process(args) as result:
+        process = await asyncio.create_subprocess_exec(*args,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE
+        )
+
+        try:
+            stdout, stderr = await asyncio.wait_for(process.communicate(), timeout)
+        except (asyncio.TimeoutError, asyncio.CancelledError) as ex:
+            with suppress(ProcessLookupError):
+                process.kill()
+            await asyncio.shield(process.wait())
+
+            if isinstance(ex, asyncio.TimeoutError):
+                raise subprocess.TimeoutExpired(args, timeout) from ex
+            raise
+
+        result["exit_status"] = process.returncode
+        stdout = stdout.decode()
+        stderr = stderr.decode()
+
+        if process.returncode != 0:
+            logger.debug(f"Process {args[0]} exited with {process.returncode}: {stderr.strip()}")
+            raise subprocess.CalledProcessError(process.returncode, args, output=stdout, stderr=stderr)
+
+        return stdout.splitlines()
+
+# inotify flags from <sys/inotify.h>
+IN_CREATE = 0x00000100
+IN_MOVED_TO = 0x00000080
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = os.O_CLOEXEC
+
+try:
+    libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+    libc.inotify_init1
+except (OSError, AttributeError):
+    libc = None
+
+async def wait_for_device(device_path, timeout):
+    """Wait until a device node (ex: /dev/<vg>/<lv>) exists.
+
+    Watches the device's directory (or the closest parent that exists yet) with inotify
+    so we return as soon as udev creates the node. Falls back to polling if inotify
+    isn't available. Raises TimeoutError if the device doesn't show up in time.
+    """
+    if os.path.exists(device_path):
+        return
+
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+
+    inotify_fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC) if libc else -1
+    if inotify_fd < 0:
+        logger.debug(f"inotify is unavailable. Polling for {device_path}")
+
+    changed = asyncio.Event()
+    watched = set()
+
+    def on_inotify_event():
+        # we don't care what changed, just that something did
+        with suppress(BlockingIOError):
+            while os.read(inotify_fd, 4096):
+                pass
+        changed.set()
+
+    if inotify_fd >= 0:
+        loop.add_reader(inotify_fd, on_inotify_event)
+
+    try:
+        while True:
+            changed.clear()
+
+            if inotify_fd >= 0:
+                # the vg directory may not exist yet, so watch the closest parent that does
+                directory = os.path.dirname(device_path)
+                while not os.path.isdir(directory):
+                    directory = os.path.dirname(directory)
+
+                if directory not in watched:
+                    if libc.inotify_add_watch(inotify_fd, directory.encode(), IN_CREATE | IN_MOVED_TO) < 0:
+                        raise OSError(ctypes.get_errno(), f"Failed to watch {directory}")
+                    watched.add(directory)
+
+            if os.path.exists(device_path):
+                return
+
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                raise TimeoutError(f"Timed out after {timeout}s waiting for the device {device_path} to be created")
 
-    return process.stdout.splitlines()
+            if inotify_fd >= 0:
+                with suppress(asyncio.TimeoutError):
+                    await asyncio.wait_for(changed.wait(), remaining)
+            else:
+                await asyncio.sleep(min(0.1, remaining))
+    finally:
+        if inotify_fd >= 0:
+            loop.remove_reader(inotify_fd)
+            os.close(inotify_fd)
 
 def setup_kube_client():
     import urllib3
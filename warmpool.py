@@ -0,0 +1,118 @@
+import asyncio
+import hashlib
+import logging
+import uuid
+from contextlib import suppress
+
+import config
+import lvm
+
+logger = logging.getLogger(__name__)
+
+# spares are named after what they can serve so they are found again after a restart
+SPARE_PREFIX = "spare"
+
+# (vg_name, thin_pool, fs_type, size_bytes, mkfs_options) -> number of spares to keep. set from the storage classes
+targets = {}
+# spares that are being handed out to a volume right now
+claimed_spares = set()
+# set when spares are used up or the targets change. created on startup
+refill_event = None
+
+def parse_warm_pool(value):
+    """Parse the warm_pool storage class parameter ("<size>:<filesystem>:<count>,...")"""
+    result = []
+    for entry in value.split(","):
+        size, fs_type, count = entry.strip().split(":")
+        result.append((lvm.size_to_bytes(lvm.format_volume_size(size)), fs_type, int(count)))
+    return result
+
+def register_storage_class(name, sc_params):
+    if not sc_params.get("warm_pool"):
+        return
+
+    try:
+        entries = parse_warm_pool(sc_params["warm_pool"])
+    except Exception as ex:
+        logger.error(f"Invalid warm_pool parameter '{sc_params['warm_pool']}' on storage class '{name}'", exc_info=ex)
+        return
+
+    lvm_group = sc_params.get("lvm_group", config.get().lvm_group)
+    mkfs_options = tuple(lvm.parse_mkfs_options(sc_params.get("mkfs_options")))
+    for size_bytes, fs_type, count in entries:
+        key = (lvm_group, sc_params.get("thin_pool"), fs_type, size_bytes, mkfs_options)
+        targets[key] = max(targets.get(key, 0), count)
+        logger.info(f"Keeping {targets[key]} spare {fs_type} volumes of {size_bytes} bytes in {lvm_group} for storage class '{name}'")
+
+    if refill_event:
+        refill_event.set()
+
+def spare_profile(mkfs_options):
+    """Short tag for the mkfs options a spare was formatted with"""
+    if not mkfs_options:
+        return "default"
+    return hashlib.sha1(" ".join(mkfs_options).encode()).hexdigest()[:8]
+
+def spare_name(fs_type, size_bytes, mkfs_options=()):
+    return f"{SPARE_PREFIX}-{fs_type}-{size_bytes}-{spare_profile(mkfs_options)}-{uuid.uuid4().hex[:8]}"
+
+def find_spares(lvm_group, thin_pool, fs_type, size_bytes, mkfs_options=()):
+    prefix = f"{SPARE_PREFIX}-{fs_type}-{size_bytes}-{spare_profile(mkfs_options)}-"
+    return [ lv_name for lv_name, entry in lvm.list_volumes(lvm_group).items()
+        if lv_name.startswith(prefix) and entry["pool"] == thin_pool and lv_name not in claimed_spares ]
+
+async def take_spare(lvm_group, thin_pool, volume_name, fs_type, volume_size, mount_point=None, mkfs_options=(), mount_options=None):
+    """Hand a matching spare out as the new volume. Returns False if there is none"""
+    size_bytes = lvm.size_to_bytes(lvm.format_volume_size(volume_size))
+    spares = await asyncio.to_thread(find_spares, lvm_group, thin_pool, fs_type, size_bytes, tuple(mkfs_options))
+    # another claim could have taken one of them while the inventory was read
+    spares = [ spare for spare in spares if spare not in claimed_spares ]
+    if not spares:
+        return False
+
+    spare = spares[0]
+    claimed_spares.add(spare)
+    try:
+        await lvm.rename_volume(lvm_group, spare, volume_name, fs_type, mount_point, mount_options)
+    except Exception as ex:
+        logger.warning(f"Failed to use spare volume {lvm_group}/{spare} for {volume_name}", exc_info=ex)
+        return False
+    finally:
+        claimed_spares.discard(spare)
+        if refill_event:
+            refill_event.set()
+
+    logger.info(f"Served {volume_name} from spare volume {lvm_group}/{spare}")
+    return True
+
+async def refill_spares(interval):
+    """Keep the warm pool topped up, creating at most one spare every interval seconds"""
+    while True:
+        refill_event.clear()
+
+        for (lvm_group, thin_pool, fs_type, size_bytes, mkfs_options), count in list(targets.items()):
+            spares = await asyncio.to_thread(find_spares, lvm_group, thin_pool, fs_type, size_bytes, mkfs_options)
+            for _ in range(count - len(spares)):
+                name = spare_name(fs_type, size_bytes, mkfs_options)
+
+                # not ready to hand out until it has been formatted
+                claimed_spares.add(name)
+                try:
+                    await lvm.create_volume(lvm_group, name, fs_type, False, f"{size_bytes // 1024}Ki", thin_pool=thin_pool, mkfs_options=mkfs_options)
+                except Exception as ex:
+                    logger.warning(f"Failed to create spare volume {lvm_group}/{name}", exc_info=ex)
+                    break
+                finally:
+                    claimed_spares.discard(name)
+
+                logger.debug(f"Created spare volume {lvm_group}/{name}")
+                await asyncio.sleep(interval)
+
+        # re-check every so often in case the spares were changed outside of LabDisk
+        with suppress(TimeoutError):
+            await asyncio.wait_for(refill_event.wait(), 60)
+
+def start_refill(interval):
+    global refill_event
+    refill_event = asyncio.Event()
+    return asyncio.create_task(refill_spares(interval))